@@ -0,0 +1,297 @@
+'''
+This script contains our benchmark suite of representative Fake Anglican
+workloads. Run it with `python bench.py`, save the results with --output and
+compare two runs with --compare to flag regressions. --backend cek runs the
+workloads with the explicit-stack evaluator instead of the recursive one
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+SUM_SQUARES = '(let ((stop {n})) (loop smsquares ((i 0), (sm 0)) (if (= i, stop) sm (smsquares (+ i, 1), (+ sm, (* i, i))))))'
+DEEP_RECURSION = '(let ((f (lambda depth (n) (if (= n, 0) 0 (+ 1, (depth (+ n, (- 1)))))))) (f {n}))'
+VECTOR_OPS = '(sum (filter (lambda (a) (> a, 10)), (map (lambda (a) (* a, a)), xs)))'
+COMPOSED_SAMPLING = '(let ((d (+ (normal 0, 1), (* (exponential 1), (uniform 0, 1))))) (loop draw ((i 0), (total 0)) (if (= i, {n}) total (draw (+ i, 1), (+ total, (sample d))))))'
+
+# The directory of the repository, so the suite can be run from anywhere
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+# The evaluator the workloads run with, one of the shell's backends
+evalBackend = "tree"
+
+class Workload:
+    '''
+    A Workload is a named family of benchmark programs. setup(n) prepares the
+    program of size n outside of the timed region and returns a function
+    running it once
+    '''
+    def __init__(self, name, sizes, quickSizes, setup):
+        self.name = name
+        self.sizes = sizes
+        self.quickSizes = quickSizes
+        self.setup = setup
+
+def evaluator(source, env=None):
+    '''
+    Returns a function evaluating the already parsed source in env with
+    the selected backend
+    '''
+    e = parse(source)
+    if env is None:
+        env = newEnv()
+    run = backends[evalBackend]
+    return lambda: run(e, env)
+
+def setupSumSquares(n):
+    '''
+    Sets up the print-free loop of sum_squares_loop.func up to n
+    '''
+    return evaluator(SUM_SQUARES.format(n=n))
+
+def setupBinomial(n):
+    '''
+    Sets up binomial_test.func with n trials instead of 10
+    '''
+    content = readFile(os.path.join(repoDir, "binomial_test.func"))
+    return evaluator(re.sub(r'\), *10, *0\.5', '), {}, 0.5'.format(n), content))
+
+def setupDeepRecursion(n):
+    '''
+    Sets up a non-tail recursive procedure recursing n times
+    '''
+    return evaluator(DEEP_RECURSION.format(n=n))
+
+def setupVectorOps(n):
+    '''
+    Sets up map, filter and sum over a vector of n floats
+    '''
+    xs = VVector([VFloat(i) for i in range(n)])
+    return evaluator(VECTOR_OPS, newEnv().push("xs", xs))
+
+def setupComposedSampling(n):
+    '''
+    Sets up n draws from a composed distribution
+    '''
+    return evaluator(COMPOSED_SAMPLING.format(n=n))
+
+def setupParse(n):
+    '''
+    Sets up parsing a vector literal of n arithmetic expressions
+    '''
+    source = "(vector " + ", ".join(["(+ {}, (* 2, {}))".format(i, i) for i in range(n)]) + ")"
+    return lambda: parse(source)
+
+workloads = [
+    Workload("sum_squares", [1000, 10000, 100000, 1000000], [1000, 10000], setupSumSquares),
+    Workload("binomial", [100, 1000, 10000], [100], setupBinomial),
+    Workload("deep_recursion", [100, 1000, 5000], [100], setupDeepRecursion),
+    Workload("vector_ops", [1000, 10000, 100000], [1000], setupVectorOps),
+    Workload("composed_sampling", [1000, 10000, 100000], [1000], setupComposedSampling),
+    Workload("parse", [100, 1000, 5000], [100], setupParse),
+]
+
+def runWithStack(fn):
+    '''
+    Runs fn in a thread with a large stack so that deep recursion in the
+    recursive evaluator does not overflow, and returns its result
+    '''
+    output = {}
+    def target():
+        try:
+            output["value"] = fn()
+        except BaseException as e:
+            output["error"] = e
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in output:
+        raise output["error"]
+    return output["value"]
+
+def measure(workload, n, repeat):
+    '''
+    Times repeat runs of the workload of size n and measures its peak memory
+    in one extra traced run. Returns a dictionary of results
+    '''
+    def timed():
+        np.random.seed(0)
+        run = workload.setup(n)
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return times, peak
+    times, peak = runWithStack(timed)
+    wall = sorted(times)[len(times) // 2]
+    return {
+        "n": n,
+        "wall": wall,
+        "min": min(times),
+        "ops_per_sec": n / wall if wall > 0 else None,
+        "peak_bytes": peak,
+    }
+
+def readUntil(stream, marker):
+    '''
+    Reads from the binary stream one byte at a time until marker was read
+    '''
+    seen = b""
+    while not seen.endswith(marker):
+        byte = stream.read(1)
+        if not byte:
+            runtimeError("process exited before printing " + repr(marker))
+        seen += byte
+    return seen
+
+def measureStartup(repeat):
+    '''
+    Measures, in fresh python processes, the latency until the shell shows its
+    first prompt, until it prints its first result, and until `shell.py run`
+    finishes a trivial program. Returns the median of each in seconds
+    '''
+    prompts = []
+    results = []
+    batches = []
+    shellPath = os.path.join(repoDir, "shell.py")
+    f = tempfile.NamedTemporaryFile("w", suffix=".func", delete=False)
+    f.write("(+ 1, 2)\n")
+    f.close()
+    program = f.name
+    try:
+        for i in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, shellPath], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            readUntil(process.stdout, b"PROB> ")
+            prompts.append(time.perf_counter() - start)
+            process.stdin.write(b"(+ 1, 2)\n")
+            process.stdin.flush()
+            readUntil(process.stdout, b"3.0")
+            results.append(time.perf_counter() - start)
+            process.stdin.write(b"#quit\n")
+            process.stdin.close()
+            process.wait()
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, shellPath, "run", program], stdout=subprocess.DEVNULL)
+            batches.append(time.perf_counter() - start)
+    finally:
+        os.remove(program)
+    median = lambda xs: sorted(xs)[len(xs) // 2]
+    return {
+        "first_prompt": median(prompts),
+        "first_result": median(results),
+        "batch_run": median(batches),
+    }
+
+def gitCommit():
+    '''
+    Returns the current git commit hash, or None outside of a git checkout
+    '''
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repoDir, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def runSuite(quick=False, only=None, repeat=3):
+    '''
+    Runs the selected workloads and returns the results as a dictionary
+    keyed by "workload[size]". The "startup" workload measures the latency
+    of fresh interpreter processes; a quick run skips it unless it is asked
+    for with only, and then starts a single process of each kind
+    '''
+    results = {}
+    if (only and "startup" in only) or (not only and not quick):
+        startup = measureStartup(1 if quick else max(repeat, 3))
+        for name, seconds in startup.items():
+            key = "startup[" + name + "]"
+            results[key] = {"n": 1, "wall": seconds, "ops_per_sec": 1 / seconds, "peak_bytes": 0}
+            print("%-30s %10.4f s" % (key, seconds))
+    for workload in workloads:
+        if only and workload.name not in only:
+            continue
+        for n in (workload.quickSizes if quick else workload.sizes):
+            key = "{}[{}]".format(workload.name, n)
+            results[key] = measure(workload, n, repeat)
+            r = results[key]
+            print("%-30s %10.4f s %14.1f ops/s %10.1f KiB" % (key, r["wall"], r["ops_per_sec"], r["peak_bytes"] / 1024))
+            sys.stdout.flush()
+    return {
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "backend": evalBackend,
+        "timestamp": time.time(),
+        "results": results,
+    }
+
+def compare(baseline, current, threshold):
+    '''
+    Prints the ratio of current to baseline wall time for each workload both
+    runs share and returns the keys that slowed down by more than threshold
+    '''
+    regressions = []
+    print("%-30s %10s %10s %8s" % ("workload", "base (s)", "new (s)", "ratio"))
+    for key, r in current["results"].items():
+        if key not in baseline["results"]:
+            continue
+        old = baseline["results"][key]["wall"]
+        ratio = r["wall"] / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print("%-30s %10.4f %10.4f %8.2f%s" % (key, old, r["wall"], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    '''
+    Parses the command line, runs the suite and returns the exit status,
+    which is 1 when a regression was found
+    '''
+    parser = argparse.ArgumentParser(description="Run the Fake Anglican benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="only run the smallest sizes")
+    parser.add_argument("--only", nargs="+", help="names of the workloads to run")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per workload size")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown flagged as a regression")
+    parser.add_argument("--backend", default="tree", choices=sorted(backends), help="evaluator the workloads run with")
+    args = parser.parse_args(argv)
+    global evalBackend
+    evalBackend = args.backend
+    sys.setrecursionlimit(1000000)
+    threading.stack_size(512 * 1024 * 1024)
+    current = runSuite(args.quick, args.only, args.repeat)
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(current, f, indent=2)
+        f.close()
+    if args.compare:
+        f = open(args.compare, "r")
+        baseline = json.load(f)
+        f.close()
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(str(len(regressions)) + " regression(s): " + ", ".join(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+'''
+This script contains our explicit-stack evaluator, a CEK machine: the control
+is the expression being evaluated (or the value being returned), the
+environment is an Env and the continuation is a linked list of frames on the
+heap. It runs in constant python stack depth and can suspend at sample and
+observe, so many executions can be interleaved without threads
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+
+# A continuation is a linked list of (frame, rest) pairs, None when the
+# program is done. Frames are tuples starting with one of these tags.
+# Continuations are never mutated, so a suspended execution can be resumed
+# several times, e.g. once by each copy of a particle after resampling
+IF = 0         # (IF, eif, env): picks a branch with the value of the condition
+ARG = 1        # (ARG, eapply, env, values): the function and arguments evaluated so far
+LOOPINIT = 2   # (LOOPINIT, eloop, env, values): the initial loop values evaluated so far
+LOOP = 3       # (LOOP, eloop, env): an iteration of eloop, which a call to its name restarts
+DEFINE = 4     # (DEFINE, edefine, env): binds the value in the global environment
+SAMPLED = 5    # (SAMPLED,): a defdist body returned, a procedure is applied to get the sample
+
+# Expressions evaluated directly, without a frame, when they are arguments
+constantExps = (EFloat, ERational, EBoolean, EString, EPrimitive, EProcedure, EDistribution)
+
+class Suspension:
+    '''
+    A Suspension is an execution stopped at a sample or observe. kind is
+    "sample" or "observe", dist is the distribution and args the arguments of
+    the sample or the observed value. resume carries on with the value the
+    sample or observe returns, and can be called several times
+    '''
+    def __init__(self, kind, dist, args, k, suspendOn, site):
+        self.kind = kind
+        self.dist = dist
+        self.args = args
+        self.k = k
+        self.suspendOn = suspendOn
+        self.site = site
+    def resume(self, value=None):
+        '''
+        Runs the execution until its next suspension or its end. The value of
+        an observe is true when value is not given. Returns a Suspension or
+        the value of the program
+        '''
+        if value is None:
+            if self.kind == "sample":
+                runtimeError("A suspended sample needs a value to resume with")
+            value = VBoolean(True)
+        return execute(None, None, value, self.k, self.suspendOn)
+
+def isLeaf(dist):
+    '''
+    Returns true if sampling dist draws directly from python (a primitive or
+    composed primitive distribution) rather than running a defdist body
+    '''
+    return isinstance(dist.body, (EPrimitive, EMultiple))
+
+def bindArgs(fn, args):
+    '''
+    Returns the environment the body of the procedure or distribution fn
+    runs in when applied to args
+    '''
+    if len(fn.params) != len(args):
+        arityError(len(args), len(fn.params), fn)
+    env = fn.env
+    for (p, v) in zip(fn.params, args):
+        env = env.push(p, v)
+    return env.push(fn.name, fn)
+
+def iterationEnv(eloop, env, values):
+    '''
+    Returns the environment of an iteration of eloop, started in env, with
+    its loop variables set to values
+    '''
+    env = env.push(eloop.name, VLoop(eloop.name))
+    for ((n, _), v) in zip(eloop.init, values):
+        env = env.push(n, v)
+    return env
+
+def execute(exp, env, value, k, suspendOn=()):
+    '''
+    Runs the machine from exp in env, or, when exp is None, from value
+    returned to the continuation k, until the program ends or reaches a
+    sample or observe whose kind is in suspendOn. Returns the value of the
+    program or a Suspension. Expression types the machine does not know
+    (e.g. instrumented nodes) and primitive operations are evaluated by
+    their own python code
+    '''
+    suspendSample = "sample" in suspendOn
+    suspendObserve = "observe" in suspendOn
+    app = None
+    values = None
+    fn = None
+    args = None
+    current = exp
+    try:
+        while True:
+            if app is not None:
+                # evaluate the rest of the function and arguments of app,
+                # directly while they are identifiers or constants
+                parts = app.args
+                n = len(parts)
+                i = len(values)
+                while True:
+                    if i > n:
+                        current = app
+                        fn = values[0]
+                        args = list(values[1:])
+                        break
+                    part = app.fn if i == 0 else parts[i - 1]
+                    cls = type(part)
+                    if cls is EId:
+                        current = part
+                        values += (env.lookup(part.id),)
+                        i += 1
+                    elif cls in constantExps:
+                        values += (part.eval(env),)
+                        i += 1
+                    else:
+                        k = ((ARG, app, env, values), k)
+                        exp = part
+                        break
+                app = None
+            if exp is not None:
+                current = exp
+                cls = type(exp)
+                if cls is EApply:
+                    app = exp
+                    values = ()
+                    exp = None
+                    continue
+                elif cls is EId:
+                    value = env.lookup(exp.id)
+                elif cls is EIf:
+                    k = ((IF, exp, env), k)
+                    exp = exp.ec
+                    continue
+                elif cls is ELoop:
+                    if exp.init:
+                        k = ((LOOPINIT, exp, env, ()), k)
+                        exp = exp.init[0][1]
+                        continue
+                    k = ((LOOP, exp, env), k)
+                    env = iterationEnv(exp, env, [])
+                    exp = exp.body
+                    continue
+                elif cls is EDefine:
+                    k = ((DEFINE, exp, env), k)
+                    exp = exp.exp
+                    continue
+                else:
+                    try:
+                        value = exp.eval(env)
+                    except NextIteration as e:
+                        # a loop of the machine called from python code, see below
+                        exp = None
+                        fn = VLoop(e.name)
+                        args = e.values
+                        continue
+                exp = None
+            elif fn is not None:
+                cls = type(fn)
+                if cls is VProcedure or cls is VDistribution:
+                    env = bindArgs(fn, args)
+                    exp = fn.body
+                    fn = None
+                    continue
+                elif cls is VPrimitive:
+                    name = fn.oper.__name__
+                    if name == "operSample":
+                        if len(args) < 1:
+                            runtimeError("0 arguments applied to sample")
+                        dist = args[0]
+                        checkDistribution(dist)
+                        if not isLeaf(dist):
+                            # run the defdist body in the machine, as sampleDistribution would
+                            env = bindArgs(dist, args[1:])
+                            k = ((SAMPLED,), k)
+                            exp = dist.body
+                            fn = None
+                            continue
+                        if suspendSample:
+                            return Suspension("sample", dist, args[1:], k, suspendOn, current)
+                        value = fn.oper(args)
+                    elif name == "operObserve":
+                        checkNumberArgs(args, 2)
+                        checkDistribution(args[0])
+                        if suspendObserve:
+                            return Suspension("observe", args[0], args[1], k, suspendOn, current)
+                        value = fn.oper(args)
+                    else:
+                        try:
+                            value = fn.oper(args)
+                        except NextIteration as e:
+                            # a procedure the primitive applied with the recursive
+                            # evaluator called a loop of the machine, which moves
+                            # on to its next iteration as the VLoop case below
+                            fn = VLoop(e.name)
+                            args = e.values
+                            continue
+                elif cls is VLoop:
+                    # like NextIteration, drop the frames up to the iteration of the loop
+                    while k is not None and not (k[0][0] == LOOP and k[0][1].name == fn.name):
+                        k = k[1]
+                    if k is None:
+                        runtimeError("Loop " + str(fn.name) + " called outside of its body")
+                    frame = k[0]
+                    env = iterationEnv(frame[1], frame[2], args)
+                    exp = frame[1].body
+                    fn = None
+                    continue
+                else:
+                    value = fn.apply(args)
+                fn = None
+            if k is None:
+                return value
+            frame, k = k
+            tag = frame[0]
+            if tag == ARG:
+                app = frame[1]
+                env = frame[2]
+                values = frame[3] + (value,)
+            elif tag == IF:
+                if not value.isBoolean():
+                    current = frame[1]
+                    runtimeError("condition not a Boolean")
+                env = frame[2]
+                exp = frame[1].et if value.getBoolean() else frame[1].ee
+            elif tag == LOOPINIT:
+                eloop = frame[1]
+                values = frame[3] + (value,)
+                env = frame[2]
+                if len(values) < len(eloop.init):
+                    k = ((LOOPINIT, eloop, env, values), k)
+                    exp = eloop.init[len(values)][1]
+                    continue
+                k = ((LOOP, eloop, env), k)
+                env = iterationEnv(eloop, env, values)
+                exp = eloop.body
+            elif tag == DEFINE:
+                frame[2].define(frame[1].name, value)
+            elif tag == SAMPLED:
+                if value.isProcedure():
+                    fn = value
+                    args = []
+            # a LOOP frame returns the value of its iteration as it is
+    except LanguageError as err:
+        if current is not None and current.span is not None:
+            err.atSpan(current.span)
+        raise
+
+def evaluate(exp, env):
+    '''
+    Evaluates exp in env with the machine. Samples and observes are handled
+    as by the recursive evaluator, including by the current ChoiceHandler
+    '''
+    return execute(exp, env, None, None)
+
+def start(exp, env, suspendOn=("sample", "observe")):
+    '''
+    Starts evaluating exp in env and returns the Suspension at its first
+    sample or observe of a kind in suspendOn, or its value if it has none
+    '''
+    return execute(exp, env, None, None, suspendOn)
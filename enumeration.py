@@ -0,0 +1,291 @@
+'''
+This script contains our exact enumeration inference engine for discrete models
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+import math
+
+class Jump:
+    '''
+    A Jump is the outcome of an expression that calls a loop's name: the loop
+    starts its next iteration with values instead of returning a value
+    '''
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+class EnumerationHandler:
+    '''
+    EnumerationHandler is the ChoiceHandler while a program is enumerated. The
+    enumerator handles sample and observe itself, so a random choice reaching
+    the handler was made inside a primitive (e.g. the procedure given to map),
+    where its alternatives cannot be explored
+    '''
+    def sample(self, dist, args):
+        runtimeError("Cannot enumerate a sample made inside a primitive operation")
+    def observe(self, dist, value):
+        runtimeError("Cannot enumerate an observe made inside a primitive operation")
+
+def valueKey(v):
+    '''
+    Returns a hashable key such that two values with the same key are the same
+    outcome. Values without a structural key (procedures, distributions...)
+    are only the same outcome as themselves
+    '''
+    if isinstance(v, Jump):
+        return ("jump", v.name, tuple(valueKey(x) for x in v.values))
+    elif v.isFloat():
+        return ("float", v.getFloat())
+    elif v.isBoolean():
+        return ("boolean", v.getBoolean())
+    elif v.isString():
+        return ("string", v.getString())
+    elif v.isRational():
+        return ("rational", v.getNumerator(), v.getDenominator())
+    elif v.isNil():
+        return ("nil",)
+    elif v.isVector():
+        return ("vector",) + tuple(valueKey(x) for x in v.getList())
+    elif v.isMatrix():
+        return ("matrix", v.getMatrix().shape) + tuple(v.getMatrix().ravel().tolist())
+    return ("object", id(v))
+
+def isPrimitive(fn, oper):
+    '''
+    Returns true if fn is the primitive operation oper. Operations are
+    compared by name, because the shell's primitives come from the __main__
+    module when shell.py is run as a script
+    '''
+    return isinstance(fn, VPrimitive) and getattr(fn.oper, "__name__", None) == oper.__name__
+
+def support(dist):
+    '''
+    Returns the list of (value, probability) pairs of a primitive discrete
+    distribution, or raises an error for other distributions
+    '''
+    family = dist.family
+    args = dist.familyArgs
+    if family == "bernoulli":
+        return [(VFloat(1), args[0]), (VFloat(0), 1 - args[0])]
+    elif family == "binomial":
+        # in log space, as the binomial coefficients of large n overflow floats
+        return [(VFloat(k), math.exp(logProbBinomial(args, VFloat(k)))) for k in range(args[0] + 1)]
+    elif family == "randelm":
+        return [(elm, 1 / len(args[0])) for elm in args[0]]
+    elif family == "categorical":
+        return list(zip(args[0], args[1]))
+    elif family is None:
+        runtimeError("Cannot enumerate a composed distribution, only defdist and discrete primitive distributions")
+    runtimeError("Cannot enumerate the " + family + " distribution, its support is not finite")
+
+# Expressions that evaluate without running any code that could make a choice
+simpleExps = (EId, EFloat, ERational, EBoolean, EString, EPrimitive, EProcedure, EDistribution)
+
+class Enumerator:
+    '''
+    The Enumerator class evaluates an expression to the exact (unnormalized)
+    distribution of its outcomes instead of one outcome. A distribution is a
+    dict from valueKey to [outcome, weight]; observes scale the weights.
+    Loop iterations and procedure calls are memoized on their loop variables
+    or arguments, so executions reaching the same state are only explored
+    once from there. At most maxStates states are memoized
+    '''
+    def __init__(self, maxStates=100000):
+        self.maxStates = maxStates
+        self.memo = {}
+        self.steps = 0
+        # objects whose id is part of a memo key are kept alive for the run
+        self.keep = []
+    def remember(self, key, dist):
+        if len(self.memo) >= self.maxStates:
+            runtimeError("Enumeration exceeded " + str(self.maxStates) + " states, the model may have unbounded executions")
+        self.memo[key] = dist
+        return dist
+    def run(self, e, env):
+        saved = choiceHandler.current
+        choiceHandler.current = EnumerationHandler()
+        try:
+            return self.enum(e, env)
+        finally:
+            choiceHandler.current = saved
+    def enum(self, e, env):
+        if isinstance(e, EIf):
+            result = {}
+            for key, (cond, weight) in self.enum(e.ec, env).items():
+                if isinstance(cond, Jump):
+                    addOutcome(result, cond, weight, key)
+                    continue
+                branch = e.et if cond.getBoolean() else e.ee
+                for key, (v, w) in self.enum(branch, env).items():
+                    addOutcome(result, v, weight * w, key)
+            return result
+        elif isinstance(e, EApply):
+            result = {}
+            for vs, weight in self.enumSequence([e.fn] + e.args, env, result):
+                for key, (v, w) in self.apply(vs[0], vs[1:]).items():
+                    addOutcome(result, v, weight * w, key)
+            return result
+        elif isinstance(e, ELoop):
+            result = {}
+            for values, weight in self.enumSequence([init for _, init in e.init], env, result):
+                for key, (v, w) in self.loop(e, env, values).items():
+                    addOutcome(result, v, weight * w, key)
+            return result
+        elif isinstance(e, EDefine):
+            dist = self.enum(e.exp, env)
+            if len(dist) != 1:
+                runtimeError("Cannot enumerate a define whose value is random")
+            v, weight = next(iter(dist.values()))
+            env.define(e.name, v)
+            return {valueKey(v): [v, weight]}
+        elif isinstance(e, EMultiple):
+            runtimeError("Cannot enumerate a composed distribution, only defdist and discrete primitive distributions")
+        # the other expressions evaluate deterministically
+        v = e.eval(env)
+        return {valueKey(v): [v, 1.0]}
+    def enumSequence(self, es, env, result):
+        '''
+        Yields the (values, weight) combinations of evaluating es from left
+        to right. An outcome that jumps to a loop stops the evaluation of the
+        remaining expressions and goes straight to result
+        '''
+        partials = [([], 1.0)]
+        for e in es:
+            if isinstance(e, simpleExps):
+                # no choice can happen, evaluate once for every combination
+                partials = [(vs + [e.eval(env)], weight) for vs, weight in partials]
+                continue
+            extended = []
+            for vs, weight in partials:
+                for v, w in self.enum(e, env).values():
+                    if isinstance(v, Jump):
+                        addOutcome(result, v, weight * w)
+                    elif weight * w > 0:
+                        extended.append((vs + [v], weight * w))
+            partials = extended
+        return partials
+    def apply(self, fn, args):
+        if isPrimitive(fn, operSample):
+            if len(args) < 1:
+                runtimeError("0 arguments applied to sample")
+            checkDistribution(args[0])
+            return self.sample(args[0], args[1:])
+        elif isPrimitive(fn, operObserve):
+            checkNumberArgs(args, 2)
+            checkDistribution(args[0])
+            logProb = distLogProb(args[0], args[1])
+            if logProb is None:
+                runtimeError("Cannot observe a distribution without a known density")
+            return {valueKey(VBoolean(True)): [VBoolean(True), math.exp(logProb)]}
+        elif isPrimitive(fn, operPutRefCell):
+            runtimeError("Cannot enumerate a program that updates reference cells")
+        elif isinstance(fn, VLoop):
+            jump = Jump(fn.name, args)
+            return {valueKey(jump): [jump, 1.0]}
+        elif isinstance(fn, VProcedure):
+            if len(fn.params) != len(args):
+                arityError(len(args), len(fn.params), fn)
+            key = ("call", id(fn)) + tuple(valueKey(v) for v in args)
+            if key in self.memo:
+                return self.memo[key]
+            self.keep.append(fn)
+            new_env = fn.env
+            for (p, v) in zip(fn.params, args):
+                new_env = new_env.push(p, v)
+            return self.remember(key, self.enum(fn.body, new_env.push(fn.name, fn)))
+        v = fn.apply(args)
+        return {valueKey(v): [v, 1.0]}
+    def sample(self, dist, args):
+        '''
+        Returns the distribution of the samples of dist given args, exploring
+        the body of a defdist or the support of a primitive distribution
+        '''
+        if not isinstance(dist.body, (EPrimitive, EMultiple)):
+            key = ("sample", id(dist)) + tuple(valueKey(v) for v in args)
+            if key in self.memo:
+                return self.memo[key]
+            self.keep.append(dist)
+            if len(dist.params) != len(args):
+                arityError(len(args), len(dist.params), dist)
+            new_env = dist.env
+            for (p, v) in zip(dist.params, args):
+                new_env = new_env.push(p, v)
+            result = {}
+            for v, weight in self.enum(dist.body, new_env.push(dist.name, dist)).values():
+                if v.isProcedure():
+                    for v2, w in self.apply(v, []).values():
+                        addOutcome(result, v2, weight * w)
+                else:
+                    addOutcome(result, v, weight)
+            return self.remember(key, result)
+        result = {}
+        for v, p in support(dist):
+            if p > 0:
+                addOutcome(result, v, p)
+        return result
+    def loop(self, e, env, values):
+        '''
+        Returns the distribution of the value of the loop e started with the
+        loop variables set to values. The probability mass is pushed forward
+        from one iteration state to the next; paths reaching the same state
+        are merged and the outcomes of each state's iteration are memoized.
+        A loop whose executions are unbounded exhausts maxStates
+        '''
+        start = tuple(valueKey(v) for v in values)
+        frontier = {start: [values, 1.0]}
+        result = {}
+        self.keep.append(env)
+        while frontier:
+            following = {}
+            for state, (values, weight) in frontier.items():
+                for key, (v, w) in self.iteration(e, env, state, values).items():
+                    if isinstance(v, Jump) and v.name == e.name:
+                        addOutcome(following, v.values, weight * w, key[2])
+                    else:
+                        addOutcome(result, v, weight * w, key)
+            frontier = following
+        return result
+    def iteration(self, e, env, state, values):
+        '''
+        Returns the distribution of the outcomes of one iteration of the body
+        of the loop e with the loop variables set to values
+        '''
+        self.steps += 1
+        if self.steps > self.maxStates:
+            runtimeError("Enumeration exceeded " + str(self.maxStates) + " states, the model may have unbounded executions")
+        key = ("loop", id(e), id(env)) + state
+        if key in self.memo:
+            return self.memo[key]
+        newEnv = env.push(e.name, VLoop(e.name))
+        for ((n, _), v) in zip(e.init, values):
+            newEnv = newEnv.push(n, v)
+        return self.remember(key, self.enum(e.body, newEnv))
+
+def addOutcome(dist, v, weight, key=None):
+    '''
+    Adds weight to the outcome v, whose valueKey is key if already known,
+    of the distribution dist
+    '''
+    if key is None:
+        key = valueKey(v)
+    if key in dist:
+        dist[key][1] += weight
+    else:
+        dist[key] = [v, weight]
+
+def enumerateModel(exp, env, maxStates=100000):
+    '''
+    Computes the exact distribution of the values of exp by exploring every
+    execution path, and returns it as a list of (value, probability) pairs
+    sorted by decreasing probability, normalized over the observations
+    '''
+    dist = Enumerator(maxStates).run(exp, env)
+    total = sum(weight for _, weight in dist.values())
+    if not total > 0:
+        runtimeError("Every execution of the program has probability zero")
+    outcomes = [(v, weight / total) for v, weight in dist.values()]
+    outcomes.sort(key=lambda pair: -pair[1])
+    return outcomes
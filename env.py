@@ -8,10 +8,13 @@ from value import *
 class Env:
     '''
     The Env class keeps track of our language's environment
-    The content attribute is a list of tuples mapping names to values
+    The content attribute is a list of tuples mapping names to values for the
+    lexical frames, and the globals attribute is a dictionary, shared by every
+    environment pushed from this one, holding the primitives and top-level defines
     '''
-    def __init__(self, content=[]):
+    def __init__(self, content=[], globals=None):
         self.content = content
+        self.globals = globals
     def __str__(self):
         if not self.content:
             return ''
@@ -21,9 +24,18 @@ class Env:
         output_str = output_str[:-2] + '}'
         return output_str
     def push(self, id, v):
-        return Env(self.content + [(id, v)])
+        return Env(self.content + [(id, v)], self.globals)
     def lookup(self, id):
         for entry in self.content:
             if entry[0] == id:
                 return entry[1]
-        runtimeError("Runtime error : unbound identifier " + id)
+        if self.globals is not None and id in self.globals:
+            return self.globals[id]
+        raise UnboundIdentifierError(id)
+    def define(self, id, v):
+        if self.globals is None:
+            runtimeError("Runtime error : no global environment to define " + id + " in")
+        if not isinstance(self.globals, dict):
+            # e.g. the initial environment, shared by every run
+            runtimeError("Runtime error : cannot define " + id + " in a read-only global environment")
+        self.globals[id] = v
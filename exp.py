@@ -8,14 +8,40 @@ from value import *
 class Exp:
     '''
     The Exp class is the parent class for all types of expressions in our language
-    Expressions represent the source code of our language
+    Expressions represent the source code of our language. The parser sets
+    the span of the source an expression comes from; expressions built
+    otherwise have no span
     '''
+    span = None
+    # the compiled float Region of a loop, and of a procedure whose body this
+    # is, see specialize.py, or False once it is known they cannot be specialized
+    specialized = None
+    specializedCall = None
     def __init__(self):
         pass
     def __str__(self):
         pass
     def eval(self, env):
         pass
+    def mapChildren(self, f):
+        '''
+        Returns a copy of this expression whose sub-expressions have been
+        replaced by the result of calling f on them. Leaves return themselves
+        '''
+        return self
+    def unwrapped(self):
+        '''
+        Returns the expression this one stands for. Wrappers that only observe
+        evaluation, like the nodes of the profiler, return what they wrap
+        '''
+        return self
+    def __reduce__(self):
+        '''
+        Pickles expressions in the format of serialize.py, in which primitive
+        operations are referenced by name
+        '''
+        from serialize import dumps, loads
+        return (loads, (dumps(self),))
 
 class EBoolean(Exp):
     '''
@@ -66,10 +92,13 @@ class EFloat(Exp):
 class EPrimitive(Exp):
     '''
     EPrimitive is a wrapper for a primitive operation or python function
-    and evaluates to a VPrimitive
+    and evaluates to a VPrimitive. The body of a primitive distribution also
+    remembers the family and parameters its python function samples from
     '''
-    def __init__(self, oper):
+    def __init__(self, oper, family=None, familyArgs=None):
         self.val = oper
+        self.family = family
+        self.familyArgs = familyArgs
     def __str__(self):
         return "EPrimitive[" + str(self.val) + "]"
     def eval(self, env):
@@ -94,6 +123,8 @@ class EIf(Exp):
             else:
                 return self.et.eval(env)
         runtimeError("condition not a Boolean")
+    def mapChildren(self, f):
+        return EIf(f(self.ec), f(self.et), f(self.ee))
 
 class EId(Exp):
     '''
@@ -105,7 +136,13 @@ class EId(Exp):
     def __str__(self):
         return "EId[" + str(self.id) + "]"
     def eval(self, env):
-        return env.lookup(self.id)
+        try:
+            return env.lookup(self.id)
+        except LanguageError as err:
+            # costs nothing unless an error is raised
+            if self.span is not None:
+                err.atSpan(self.span)
+            raise
 
 class EApply(Exp):
     '''
@@ -114,6 +151,11 @@ class EApply(Exp):
     evaluating each argument expression, and then applying the arguments to the
     procedure
     '''
+    # the inline cache of this call site: (VPrimitive,), (VLoop,) or
+    # (VProcedure, body, params) for the kind of callee applied last time.
+    # A procedure is cached once its arity has been checked against the
+    # arguments of this site and its body is known not to be specialized
+    cache = (None,)
     def __init__(self, fn, args):
         self.fn = fn
         self.args = args
@@ -125,11 +167,39 @@ class EApply(Exp):
             sArgs += str(arg) + ", "
         return "EApply[" + str(self.fn) + ", " + sArgs[:-2] + "]"
     def eval(self, env):
-        vfn = self.fn.eval(env)
-        vargs = []
-        for arg in self.args:
-            vargs.append(arg.eval(env))
-        return vfn.apply(vargs)
+        try:
+            vfn = self.fn.eval(env)
+            vargs = []
+            for arg in self.args:
+                vargs.append(arg.eval(env))
+            cls = type(vfn)
+            cache = self.cache
+            if cls is cache[0]:
+                if cls is VPrimitive:
+                    return vfn.oper(vargs)
+                elif cls is VProcedure:
+                    if vfn.body is cache[1] and vfn.params is cache[2]:
+                        # the arguments, then the procedure itself, as in VProcedure.apply
+                        content = vfn.env.content + list(zip(cache[2], vargs))
+                        content.append((vfn.name, vfn))
+                        return cache[1].eval(Env(content, vfn.env.globals))
+                elif cls is VLoop:
+                    raise NextIteration(vfn.name, vargs)
+            if cls is VProcedure:
+                result = vfn.apply(vargs)
+                if vfn.body.specializedCall is False:
+                    self.cache = (cls, vfn.body, vfn.params)
+                return result
+            elif cls is VPrimitive or cls is VLoop:
+                self.cache = (cls,)
+            return vfn.apply(vargs)
+        except LanguageError as err:
+            # the innermost application with a span locates the error
+            if self.span is not None:
+                err.atSpan(self.span)
+            raise
+    def mapChildren(self, f):
+        return EApply(f(self.fn), [f(arg) for arg in self.args])
 
 class EProcedure(Exp):
     '''
@@ -148,6 +218,8 @@ class EProcedure(Exp):
         return output_str
     def eval(self, env):
         return VProcedure(self.recName, self.params, self.body, env)
+    def mapChildren(self, f):
+        return EProcedure(self.recName, self.params, f(self.body))
 
 class EDistribution(Exp):
     '''
@@ -166,6 +238,8 @@ class EDistribution(Exp):
         return output_str
     def eval(self, env):
         return VDistribution(self.name, self.params, self.body, env)
+    def mapChildren(self, f):
+        return EDistribution(self.name, self.params, f(self.body))
 
 class ELoop(Exp):
     '''
@@ -192,6 +266,13 @@ class ELoop(Exp):
         newEnv = env
         vars = [x for x,_ in self.init]
         values = [y.eval(env) for _,y in self.init]
+        if self.specialized is None:
+            from specialize import specializeLoop
+            self.specialized = specializeLoop(self, env) or False
+        if self.specialized:
+            result = self.specialized.run(env, values)
+            if result is not None:
+                return result
         while True:
             # always create a new env from the _original_ env
             newEnv = env.push(self.name, VLoop(self.name))
@@ -205,6 +286,25 @@ class ELoop(Exp):
                 else:
                     raise e
         return VBoolean(False) # to satisfy the type checker
+    def mapChildren(self, f):
+        return ELoop(self.name, [(n, f(e)) for (n, e) in self.init], f(self.body))
+
+class EDefine(Exp):
+    '''
+    EDefine represents a top-level definition. It evaluates its expression,
+    binds the result to its name in the global environment and returns it
+    '''
+    def __init__(self, name, exp):
+        self.name = name
+        self.exp = exp
+    def __str__(self):
+        return "EDefine[" + str(self.name) + ", " + str(self.exp) + "]"
+    def eval(self, env):
+        v = self.exp.eval(env)
+        env.define(self.name, v)
+        return v
+    def mapChildren(self, f):
+        return EDefine(self.name, f(self.exp))
 
 class EMultiple(Exp):
     '''
@@ -225,3 +325,5 @@ class EMultiple(Exp):
                 res = res.apply([])
             results.append(res)
         return self.oper(results)
+    def mapChildren(self, f):
+        return EMultiple([f(body) for body in self.bodies], self.oper)
@@ -0,0 +1,89 @@
+'''
+This script contains our parsita grammar, which is built when the module is
+first imported by our_parser.getGrammar
+'''
+from helper import *
+from exp import *
+from our_parser import *
+from parsita import *
+from parsita.state import Continue
+
+LP = reg(r'(\s*)\((\s*)')
+RP = reg(r'(\s*)\)(\s*)')
+SEP = reg(r'\s*,\s*')
+SPACE = reg(r'\s*')
+
+class SpanParser(Parser):
+    '''
+    SpanParser wraps the parser of an expression and sets the span of the
+    source it matched, leaving out surrounding whitespace, on the expression
+    it returns
+    '''
+    def __init__(self, parser):
+        super().__init__()
+        self.parser = parser
+    def consume(self, reader):
+        status = self.parser.consume(reader)
+        source = getattr(parsing, "source", None)
+        if isinstance(status, Continue) and source is not None and source.text is reader.source:
+            text = source.text
+            start = reader.position
+            end = status.remainder.position
+            while start < end and text[start].isspace():
+                start += 1
+            while end > start and text[end - 1].isspace():
+                end -= 1
+            status.value.span = Span(source, start, end)
+        return status
+    def __repr__(self):
+        return self.name_or_nothing() + repr(self.parser)
+
+def spanned(parser):
+    '''
+    Returns a parser setting the source span of the expressions of parser
+    '''
+    return SpanParser(parser)
+
+class AtomicParser(TextParsers):
+    '''
+    AtomicParser contains all of the parsers that match a sequence of tokens
+    to an atomic expression, returning an abstract representation of what was matched
+    '''
+    atomic_float = reg(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?') > (lambda x: EFloat(float(x)))
+    integer = reg(r'[-+]?[0-9]+') > int
+    atomic_id = reg(r"""[a-zA-Z_*+~%=>^</?-][a-zA-Z0-9_*+~%=>^</?-]*""") > (lambda x: EId(x))
+    atomic_rational = integer << lit('_') & integer > (lambda x: ERational(x[0], x[1]))
+    atomic_string = reg(r"""\"[^"]*\"""") > (lambda x: EString(str(x[1:-1])))
+    atomic_true = lit('true') > (lambda x: EBoolean(True)) #EBoolean[True]
+    atomic_false = lit('false') > (lambda x: EBoolean(False))
+    atomic = atomic_rational | atomic_float | atomic_true | atomic_false | atomic_id | atomic_string
+
+class ExpParser(TextParsers):
+    '''
+    ExpParser contains all of the parsers that match a sequence of tokens
+    to an expression (including atomic expressions), returning an abstract
+    representation of what was matched.
+    '''
+    atomic = AtomicParser.atomic
+    id = reg(r"""[a-zA-Z_*+=</?-][a-zA-Z0-9_*+=</?-]*""")
+    bindings_one = LP >> id & expr << RP > (lambda x: (x[0], x[1]))
+    bindings = repsep(bindings_one, SEP)
+    params_one = SPACE >> id > str
+    params = repsep(params_one, SEP)
+    conditions_one = LP >> expr & expr << RP > (lambda x: (x[0], x[1]))
+    conditions = repsep(conditions_one, SEP)
+    expr_if = LP >> lit('if') >> expr & SPACE >> expr & SPACE >> expr << RP > (lambda x: EIf(x[0], x[1], x[2]))
+    expr_let = LP >> lit('let') >> LP >> bindings & RP >> expr << RP > (lambda x: mkLet(x[0], x[1]))
+    expr_fun = LP >> lit('lambda') >> LP >> params << RP & expr << RP > (lambda x: EProcedure(gensym() , x[0], x[1]))
+    expr_rec_fun = LP >> lit('lambda') >> id & LP >> params << RP & expr << RP > (lambda x: EProcedure(x[0], x[1], x[2]))
+    expr_dist = LP >> lit('defdist') >> LP >> id & SPACE >> params << RP & expr << RP > (lambda x: EDistribution(x[0], x[1], x[2]))
+    expr_apply = LP >> expr & SPACE >> exprs << RP > (lambda x: EApply(x[0], x[1]))
+    expr_cond = LP >> lit('cond') >> conditions << RP > (lambda x: mkCond(x))
+    expr_do = LP >> lit('begin') >> exprs << RP > (lambda x: mkBegin(x))
+    expr_and = LP >> lit('and') >> exprs << RP > (lambda x: mkAnd(x))
+    expr_or = LP >> lit('or') >> exprs << RP > (lambda x: mkOr(x))
+    expr_loop = LP >> lit('loop') >> id & LP >> bindings & RP >> expr << RP > (lambda x: ELoop(x[0], x[1], x[2]))
+    expr = spanned(atomic | expr_if | expr_let| expr_loop | expr_dist | expr_fun | expr_rec_fun | expr_do | expr_and | expr_or | expr_cond | expr_apply)
+    exprs = repsep(expr, SEP)
+    expr_define = spanned(LP >> reg(r'define(?=\s)') >> id & expr << RP > (lambda x: EDefine(x[0], x[1])))
+    program = rep1(expr_define | expr) > mkProgram
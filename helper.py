@@ -1,5 +1,166 @@
+import importlib
+import threading
+
+class LanguageError(Exception):
+    '''
+    LanguageError is the parent class of the errors raised by our language.
+    Subclasses keep references to the values involved and only render their
+    message, truncating every value, when it is displayed. The line and column
+    of the expression being evaluated or parsed are added when known
+    '''
+    def __init__(self, message=""):
+        Exception.__init__(self)
+        self.message = message
+        self.line = None
+        self.column = None
+        self.sourceName = None
+    def render(self):
+        return self.message
+    def at(self, line, column, sourceName=None):
+        '''
+        Records where the error happened, unless a more precise location has
+        already been recorded, and returns the error
+        '''
+        if self.line is None:
+            self.line = line
+            self.column = column
+            self.sourceName = sourceName
+        return self
+    def atSpan(self, span):
+        '''
+        Records the source span of the expression where the error happened
+        '''
+        if self.line is None:
+            line, column = span.source.position(span.start)
+            self.at(line, column, span.source.name)
+        return self
+    def __str__(self):
+        text = self.render()
+        if self.line is not None:
+            where = "line " + str(self.line) + ", column " + str(self.column)
+            if self.sourceName is not None and not self.sourceName.startswith("<"):
+                where = self.sourceName + ", " + where
+            text += " (" + where + ")"
+        return text
+
+class ArityError(LanguageError):
+    '''
+    ArityError is raised when a procedure, distribution or primitive operation
+    gets the wrong number of arguments
+    '''
+    def __init__(self, got, expected, fn=None):
+        LanguageError.__init__(self)
+        self.got = got
+        self.expected = expected
+        self.fn = fn
+    def render(self):
+        text = "Wrong number of arguments " + str(self.got) + " - expected " + str(self.expected)
+        if self.fn is not None:
+            text += "\n  Function " + describeValue(self.fn)
+        return text
+
+class ValueTypeError(LanguageError):
+    '''
+    ValueTypeError is raised when values are not of the type an operation expects
+    '''
+    def __init__(self, values, expected):
+        LanguageError.__init__(self)
+        self.values = values
+        self.expected = expected
+    def render(self):
+        return "Value " + " and/or ".join([describeValue(v) for v in self.values]) + " is not of type " + self.expected
+
+class UnboundIdentifierError(LanguageError):
+    '''
+    UnboundIdentifierError is raised when looking up an identifier that is not
+    bound in the environment
+    '''
+    def __init__(self, name):
+        LanguageError.__init__(self)
+        self.name = name
+    def render(self):
+        return "Runtime error : unbound identifier " + self.name
+
+class ParseError(LanguageError):
+    '''
+    ParseError is raised when a program cannot be parsed. detail is the
+    explanation given by the parser
+    '''
+    def __init__(self, source, detail, line=None, column=None, sourceName=None):
+        LanguageError.__init__(self)
+        self.source = source
+        self.detail = detail
+        self.at(line, column, sourceName)
+    def render(self):
+        return "Cannot parse " + truncate(" ".join(self.source.split())) + ": " + self.detail
+
+def truncate(text, limit=80):
+    '''
+    Returns text cut down to at most limit characters
+    '''
+    if len(text) > limit:
+        return text[:limit - 3] + "..."
+    return text
+
+def describeValue(v, limit=80):
+    '''
+    Returns a description of the value v of at most limit characters. Values
+    describe themselves without their environment, so this stays cheap
+    '''
+    describe = getattr(v, "describe", None)
+    return truncate(describe() if describe is not None else str(v), limit)
+
 def runtimeError(msg):
     '''
     Just raises an exception with an inputted error message
     '''
-    raise Exception(msg)
+    raise LanguageError(msg)
+
+def arityError(got, expected, fn=None):
+    '''
+    Raises an ArityError for got arguments where expected were expected
+    '''
+    raise ArityError(got, expected, fn)
+
+def typeError(values, expected):
+    '''
+    Raises a ValueTypeError for the value, or list of values, values
+    '''
+    if not isinstance(values, list):
+        values = [values]
+    raise ValueTypeError(values, expected)
+
+class ChoiceHandler(threading.local):
+    '''
+    ChoiceHandler keeps track, for each thread, of the inference engine, if
+    any, that the sample and observe primitives should hand their random
+    choices to. When current is None, sample draws directly from the
+    distribution and observe does nothing
+    '''
+    current = None
+
+choiceHandler = ChoiceHandler()
+
+class LazyModule:
+    '''
+    LazyModule stands in for a module that is only imported the first time one
+    of its attributes is used. Attributes are cached on the instance, so later
+    uses cost a normal attribute lookup
+    '''
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        value = getattr(module, attr)
+        setattr(self, attr, value)
+        return value
+
+class RandomSource(threading.local):
+    '''
+    RandomSource holds, for each thread, the interpreter whose random number
+    generator the sampling primitives draw from. When current is None they use
+    numpy's global one
+    '''
+    current = None
+
+randomSource = RandomSource()
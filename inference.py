@@ -0,0 +1,263 @@
+'''
+This script contains our lightweight Metropolis-Hastings (lmh) inference engine
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+from array import array
+import math
+import multiprocessing
+import numpy as np
+
+class ETracedApply(EApply):
+    '''
+    ETracedApply is an EApply that records its call site on the current
+    handler's address path while it is being evaluated, so that random choices
+    made inside it get a stable address
+    '''
+    def __init__(self, fn, args, site):
+        EApply.__init__(self, fn, args)
+        self.site = site
+    def eval(self, env):
+        handler = choiceHandler.current
+        if handler is None:
+            # e.g. a closure returned by lmh, applied after inference
+            return EApply.eval(self, env)
+        saved = handler.path
+        handler.path = (self.site, saved)
+        try:
+            return EApply.eval(self, env)
+        finally:
+            handler.path = saved
+
+class ETracedLoop(ELoop):
+    '''
+    ETracedLoop is an ELoop that records its iteration number on the current
+    handler's address path while evaluating its body
+    '''
+    def __init__(self, name, init, body, site):
+        ELoop.__init__(self, name, init, body)
+        self.site = site
+    def eval(self, env):
+        handler = choiceHandler.current
+        if handler is None:
+            return ELoop.eval(self, env)
+        vars = [x for x,_ in self.init]
+        values = [y.eval(env) for _,y in self.init]
+        iteration = 0
+        while True:
+            newEnv = env.push(self.name, VLoop(self.name))
+            for (n, v) in zip(vars, values):
+                newEnv = newEnv.push(n, v)
+            saved = handler.path
+            handler.path = (self.site, iteration, saved)
+            try:
+                return self.body.eval(newEnv)
+            except NextIteration as e:
+                if e.name == self.name:
+                    values = e.values
+                    iteration += 1
+                else:
+                    raise e
+            finally:
+                handler.path = saved
+
+def instrument(exp):
+    '''
+    Returns a copy of exp in which every application and loop is traced.
+    Sites are numbered in a fixed traversal order, so the same program
+    always gets the same addresses
+    '''
+    counter = [0]
+    def visit(e):
+        copy = e.mapChildren(visit)
+        if isinstance(copy, EApply):
+            counter[0] += 1
+            copy = ETracedApply(copy.fn, copy.args, counter[0])
+        elif isinstance(copy, ELoop):
+            counter[0] += 1
+            copy = ETracedLoop(copy.name, copy.init, copy.body, counter[0])
+        copy.span = e.span
+        return copy
+    return visit(exp)
+
+class Trace:
+    '''
+    The Trace class stores the random choices of one execution as parallel
+    arrays of addresses, values and log-probabilities, along with the total
+    log-likelihood of its observations
+    '''
+    def __init__(self):
+        self.addresses = []
+        self.values = []
+        self.logProbs = array('d')
+        self.index = {}
+        self.logLikelihood = 0.0
+    def __len__(self):
+        return len(self.addresses)
+    def record(self, address, value, logProb):
+        self.index[address] = len(self.addresses)
+        self.addresses.append(address)
+        self.values.append(value)
+        self.logProbs.append(logProb)
+
+class LMHHandler:
+    '''
+    LMHHandler receives the sample and observe calls of one execution. Choices
+    whose address is in the previous trace are reused and rescored, except the
+    one being resampled; all other choices are drawn fresh from the prior
+    '''
+    def __init__(self, previous, resample):
+        self.previous = previous
+        self.resample = resample
+        self.trace = Trace()
+        self.path = None
+        self.counts = {}
+        self.reusedLogProb = 0.0
+        self.reusedPreviousLogProb = 0.0
+    def address(self):
+        n = self.counts.get(self.path, 0)
+        self.counts[self.path] = n + 1
+        return (self.path, n)
+    def sample(self, dist, args):
+        if dist.family is None:
+            if isinstance(dist.body, EMultiple):
+                if len(dist.params) != len(args):
+                    arityError(len(args), len(dist.params), dist)
+                env = dist.env
+                for (p, v) in zip(dist.params, args):
+                    env = env.push(p, v)
+                return self.sampleComposed(dist.body, env.push(dist.name, dist))
+            # the samples of a defdist body reach the handler by themselves
+            return sampleDistribution(dist, args)
+        address = self.address()
+        if address != self.resample and self.previous is not None and address in self.previous.index:
+            i = self.previous.index[address]
+            value = self.previous.values[i]
+            logProb = distLogProb(dist, value)
+            self.reusedLogProb += logProb
+            self.reusedPreviousLogProb += self.previous.logProbs[i]
+        else:
+            value = sampleDistribution(dist, args)
+            logProb = distLogProb(dist, value)
+        self.trace.record(address, value, logProb)
+        return value
+    def sampleComposed(self, e, env):
+        '''
+        Samples the body e of a composed distribution. Each primitive
+        distribution it combines is drawn through sample, so that every draw
+        is a choice of the trace with an address of its own
+        '''
+        if isinstance(e, EMultiple):
+            return e.oper([self.sampleComposed(body, env) for body in e.bodies])
+        elif isinstance(e, EPrimitive) and e.family is not None:
+            return self.sample(VDistribution("", [], e, Env(), e.family, e.familyArgs), [])
+        res = e.eval(env)
+        if res.isProcedure():
+            res = res.apply([])
+        return res
+    def observe(self, dist, value):
+        logProb = distLogProb(dist, value)
+        if logProb is None:
+            runtimeError("Cannot observe a distribution without a known density")
+        self.trace.logLikelihood += logProb
+
+def runTraced(exp, env, previous=None, resample=None):
+    '''
+    Evaluates the instrumented expression exp once, reusing the choices of the
+    previous trace, and returns the handler together with the result
+    '''
+    handler = LMHHandler(previous, resample)
+    saved = choiceHandler.current
+    choiceHandler.current = handler
+    try:
+        result = exp.eval(env)
+    finally:
+        choiceHandler.current = saved
+    return handler, result
+
+class LMHChain:
+    '''
+    The LMHChain class holds the output of one Metropolis-Hastings chain: the
+    result of the model at each step, the log-likelihood at each step and the
+    number of accepted proposals
+    '''
+    def __init__(self):
+        self.results = []
+        self.logLikelihoods = array('d')
+        self.accepted = 0
+    def acceptanceRate(self):
+        if not self.results:
+            return 0.0
+        return self.accepted / len(self.results)
+    def getVector(self):
+        return VVector(self.results)
+
+def lmh(exp, env, numSteps, burn=0):
+    '''
+    Runs single-site Metropolis-Hastings on the expression exp for numSteps
+    steps (after burn discarded steps). Each step picks one recorded choice,
+    draws it fresh from its prior and re-executes the model, reusing every
+    other choice from the current trace
+    '''
+    exp = instrument(exp)
+    chain = LMHChain()
+    current, result = runTraced(exp, env)
+    for step in range(burn + numSteps):
+        n = len(current.trace)
+        if n == 0:
+            # no random choices to perturb: propose an independent run, which
+            # is accepted on its likelihood like any other proposal
+            proposal, proposed = runTraced(exp, env)
+            logAlpha = proposal.trace.logLikelihood - current.trace.logLikelihood
+            accepted = math.log(getRandom().uniform()) < logAlpha
+            if accepted:
+                current, result = proposal, proposed
+        else:
+            resample = current.trace.addresses[getRandom().randint(0, n)]
+            proposal, proposed = runTraced(exp, env, current.trace, resample)
+            logAlpha = (proposal.trace.logLikelihood - current.trace.logLikelihood
+                        + proposal.reusedLogProb - proposal.reusedPreviousLogProb
+                        + math.log(n) - math.log(max(len(proposal.trace), 1)))
+            accepted = math.log(getRandom().uniform()) < logAlpha
+            if accepted:
+                current, result = proposal, proposed
+        if step >= burn:
+            chain.results.append(result)
+            chain.logLikelihoods.append(current.trace.logLikelihood)
+            if accepted:
+                chain.accepted += 1
+    return chain
+
+def runChain(job):
+    '''
+    Runs one lmh chain of a serialized program in a worker process. Only the
+    results, log-likelihoods and acceptance count are sent back
+    '''
+    from serialize import loads
+    program, numSteps, burn, seed = job
+    np.random.seed(seed)
+    chain = lmh(loads(program), newEnv(), numSteps, burn)
+    return chain.results, chain.logLikelihoods, chain.accepted
+
+def lmhChains(source, numSteps, numChains, burn=0, seed=0, processes=None):
+    '''
+    Runs numChains independent lmh chains of the program source across a pool
+    of worker processes, seeding chain i with seed + i, and returns the chains.
+    The program is parsed once and sent to the workers serialized
+    '''
+    from serialize import dumps
+    program = dumps(parse(source))
+    jobs = [(program, numSteps, burn, seed + i) for i in range(numChains)]
+    with multiprocessing.Pool(processes) as pool:
+        outputs = pool.map(runChain, jobs)
+    chains = []
+    for results, logLikelihoods, accepted in outputs:
+        chain = LMHChain()
+        chain.results = results
+        chain.logLikelihoods = logLikelihoods
+        chain.accepted = accepted
+        chains.append(chain)
+    return chains
@@ -0,0 +1,122 @@
+'''
+This script contains our embeddable Interpreter class, which owns everything
+one evaluation context needs, and a pool for reusing interpreters
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+from collections import OrderedDict
+from contextlib import contextmanager
+import queue
+
+class Interpreter:
+    '''
+    The Interpreter class owns an environment, a random number generator, a
+    cache of parsed programs and its configuration, so that several
+    independent interpreters can live in one process
+    '''
+    def __init__(self, seed=None, backend="tree", cacheSize=128):
+        if backend not in backends:
+            runtimeError("Unknown backend " + backend + ", expected one of " + ", ".join(sorted(backends)))
+        self.backend = backends[backend]
+        self.cacheSize = cacheSize
+        self.programs = OrderedDict()
+        # the random number generator is created by the first draw, so that
+        # programs which never sample do not import numpy
+        self.random = None
+        self.initialSeed = seed
+        self.env = newEnv()
+    def seed(self, seed):
+        '''
+        Reseeds the random number generator of this interpreter
+        '''
+        if self.random is None:
+            self.initialSeed = seed
+        else:
+            self.random.seed(seed)
+    def randomState(self):
+        '''
+        Returns the random number generator of this interpreter, creating it
+        the first time it is needed
+        '''
+        if self.random is None:
+            self.random = np.random.RandomState(self.initialSeed)
+        return self.random
+    def parse(self, source, name="<input>"):
+        '''
+        Returns the parsed expression of source, called name in its spans,
+        reusing it if this interpreter has parsed source recently
+        '''
+        if source in self.programs:
+            self.programs.move_to_end(source)
+            return self.programs[source]
+        e = parse(source, name)
+        self.programs[source] = e
+        if len(self.programs) > self.cacheSize:
+            self.programs.popitem(last=False)
+        return e
+    @contextmanager
+    def activate(self):
+        '''
+        Makes sampling in the current thread draw from this interpreter's
+        random number generator for the duration of a with block
+        '''
+        saved = randomSource.current
+        randomSource.current = self
+        try:
+            yield self
+        finally:
+            randomSource.current = saved
+    def evalExp(self, e):
+        '''
+        Evaluates an already parsed expression with this interpreter
+        '''
+        with self.activate():
+            return self.backend(e, self.env)
+    def eval(self, source):
+        '''
+        Parses (or reuses) and evaluates source, returning its value
+        '''
+        return self.evalExp(self.parse(source))
+    def eval_many(self, sources):
+        '''
+        Evaluates each of the sources in turn and returns the list of values
+        '''
+        with self.activate():
+            return [self.backend(self.parse(source), self.env) for source in sources]
+    def sample(self, source, n):
+        '''
+        Returns a VVector of n samples. If source evaluates to a distribution
+        it is sampled n times, otherwise source itself is evaluated n times
+        '''
+        e = self.parse(source)
+        if n < 1:
+            return VVector([])
+        with self.activate():
+            v = self.backend(e, self.env)
+            if v.isDistribution():
+                return VVector([sampleDistribution(v, []) for i in range(n)])
+            return VVector([v] + [self.backend(e, self.env) for i in range(n - 1)])
+
+class InterpreterPool:
+    '''
+    The InterpreterPool class keeps a fixed number of interpreters built with
+    the same configuration and hands them out one request at a time
+    '''
+    def __init__(self, size, **config):
+        self.interpreters = queue.Queue()
+        for i in range(size):
+            self.interpreters.put(Interpreter(**config))
+    @contextmanager
+    def acquire(self, timeout=None):
+        '''
+        Lends an interpreter for the duration of a with block, waiting up to
+        timeout seconds for one to be free
+        '''
+        interpreter = self.interpreters.get(timeout=timeout)
+        try:
+            yield interpreter
+        finally:
+            self.interpreters.put(interpreter)
@@ -5,13 +5,11 @@ from helper import *
 from exp import *
 from value import *
 from env import *
-from parsita import *
-from parsita.util import constant
+import bisect
+import re
 import string
 import random
-
-LP = reg(r'([ ]*)\(([ ]*)')
-RP = reg(r'([ ]*)\)([ ]*)')
+import threading
 
 def gensym():
     '''
@@ -42,6 +40,15 @@ def mkBegin(es):
         result = mkLet([(gensym(), e)], result)
     return result
 
+def mkProgram(es):
+    '''
+    A parser transformation for a whole program (a series of top-level
+    expressions and defines evaluated in order, giving the last value)
+    '''
+    if len(es) == 1:
+        return es[0]
+    return mkBegin(es)
+
 def mkLet(bindings, e2):
     '''
     A parser transformation for let (used to locally define a variable)
@@ -77,60 +84,85 @@ def mkOr(es):
         result = EIf(e, EBoolean(True), result)
     return result
 
-class AtomicParser(TextParsers):
-    '''
-    AtomicParser contains all of the parsers that match a sequence of tokens
-    to an atomic expression, returning an abstract representation of what was matched
-    '''
-    atomic_float = reg(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?') > (lambda x: EFloat(float(x)))
-    integer = reg(r'[-+]?[0-9]+') > int
-    atomic_id = reg(r"""[a-zA-Z_*+~%=>^</?-][a-zA-Z0-9_*+~%=>^</?-]*""") > (lambda x: EId(x))
-    atomic_rational = integer << lit('_') & integer > (lambda x: ERational(x[0], x[1]))
-    atomic_string = reg(r"""\"[^"]*\"""") > (lambda x: EString(str(x[1:-1])))
-    atomic_true = lit('true') > (lambda x: EBoolean(True)) #EBoolean[True]
-    atomic_false = lit('false') > (lambda x: EBoolean(False))
-    atomic = atomic_rational | atomic_float | atomic_true | atomic_false | atomic_id | atomic_string
+class SourceFile:
+    '''
+    SourceFile is a piece of parsed source text and the name it came from
+    (a file name, or <input> for the shell). The offsets at which its lines
+    start are only computed when a position is first asked for
+    '''
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.lineStarts = None
+    def position(self, offset):
+        '''
+        Returns the line and column, both counting from 1, of offset
+        '''
+        if self.lineStarts is None:
+            self.lineStarts = [0] + [m.end() for m in re.finditer("\n", self.text)]
+        line = bisect.bisect_right(self.lineStarts, offset)
+        return line, offset - self.lineStarts[line - 1] + 1
 
-class ExpParser(TextParsers):
-    '''
-    ExpParser contains all of the parsers that match a sequence of tokens
-    to an expression (including atomic expressions), returning an abstract
-    representation of what was matched.
-    '''
-    atomic = AtomicParser.atomic
-    id = reg(r"""[a-zA-Z_*+=</?-][a-zA-Z0-9_*+=</?-]*""")
-    bindings_one = LP >> id & expr << RP > (lambda x: (x[0], x[1]))
-    bindings = repsep(bindings_one, ', ')
-    params_one = reg(r'[ ]*') >> id > str
-    params = repsep(params_one, ', ')
-    conditions_one = LP >> expr & expr << RP > (lambda x: (x[0], x[1]))
-    conditions = repsep(conditions_one, ', ')
-    expr_if = LP >> lit('if') >> expr & reg(r'[ ]*') >> expr & reg(r'[ ]*') >> expr << RP > (lambda x: EIf(x[0], x[1], x[2]))
-    expr_let = LP >> lit('let') >> LP >> bindings & RP >> expr << RP > (lambda x: mkLet(x[0], x[1]))
-    expr_fun = LP >> lit('lambda') >> LP >> params << RP & expr << RP > (lambda x: EProcedure(gensym() , x[0], x[1]))
-    expr_rec_fun = LP >> lit('lambda') >> id & LP >> params << RP & expr << RP > (lambda x: EProcedure(x[0], x[1], x[2]))
-    expr_dist = LP >> lit('defdist') >> LP >> id & reg(r'[ ]*') >> params << RP & expr << RP > (lambda x: EDistribution(x[0], x[1], x[2]))
-    expr_apply = LP >> expr & reg(r'[ ]*') >> exprs << RP > (lambda x: EApply(x[0], x[1]))
-    expr_cond = LP >> lit('cond') >> conditions << RP > (lambda x: mkCond(x))
-    expr_do = LP >> lit('begin') >> exprs << RP > (lambda x: mkBegin(x))
-    expr_and = LP >> lit('and') >> exprs << RP > (lambda x: mkAnd(x))
-    expr_or = LP >> lit('or') >> exprs << RP > (lambda x: mkOr(x))
-    expr_loop = LP >> lit('loop') >> id & LP >> bindings & RP >> expr << RP > (lambda x: ELoop(x[0], x[1], x[2]))
-    expr = atomic | expr_if | expr_let| expr_loop | expr_dist | expr_fun | expr_rec_fun | expr_do | expr_and | expr_or | expr_cond | expr_apply
-    exprs = repsep(expr, ', ')
+class Span:
+    '''
+    Span is the part of a SourceFile, from offset start to offset end, that
+    an expression was parsed from. Spans are set on expressions by the parser
+    and are never looked at while evaluating
+    '''
+    __slots__ = ("source", "start", "end")
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+    def line(self):
+        return self.source.position(self.start)[0]
+    def column(self):
+        return self.source.position(self.start)[1]
+    def text(self):
+        return self.source.text[self.start:self.end]
+    def __str__(self):
+        line, column = self.source.position(self.start)
+        return self.source.name + ":" + str(line) + ":" + str(column)
+
+# The SourceFile being parsed by the current thread, read by the grammar
+# to build the spans of expressions
+parsing = threading.local()
+
+def getGrammar():
+    '''
+    Returns the ExpParser grammar. The grammar (and parsita) are only
+    imported the first time something is parsed, which keeps startup fast
+    '''
+    from grammar import ExpParser
+    return ExpParser
 
-def parse(input):
+def parse(input, name="<input>"):
     '''
-    Parse an input and returns its abstract representation.
+    Parse an input and returns its abstract representation, whose nodes
+    have spans into the source called name.
     If there is no match, it raises a parsing error
     '''
+    grammar = getGrammar()
+    from parsita import Failure
+    parsing.source = SourceFile(name, input)
     try:
-        return ExpParser.expr.parse(input).value
-    except Exception as e:
-        runtimeError("Cannot parse "+input+": "+str(e))
+        result = grammar.program.parse(input)
+    finally:
+        parsing.source = None
+    if isinstance(result, Failure):
+        # a parsita failure, whose message is the expected tokens followed
+        # by a "Line N, character M" line and the offending source line
+        message = str(result.failure())
+        position = re.search(r'Line (\d+), character (\d+)', message)
+        detail = message.split("\n")[0]
+        if position is None:
+            raise ParseError(input, detail)
+        raise ParseError(input, detail, int(position.group(1)), int(position.group(2)), name)
+    return result.value
 
 if __name__ == "__main__":
     # Some parsing test functions
+    ExpParser = getGrammar()
     print(ExpParser.expr.parse('(let ((var1 true), (var2 false)) var1)').value, '\n')
     print(ExpParser.expr.parse('(lambda (val1, val2) true)').value, '\n')
     print(ExpParser.expr.parse('(cond (false 1), (true 2))').value, '\n')
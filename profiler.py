@@ -0,0 +1,226 @@
+'''
+This script contains our evaluation profiler, used by the #profile shell command
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+import time
+
+class NodeStats:
+    '''
+    NodeStats accumulates the number of evaluations and the inclusive and
+    exclusive time spent in one expression node
+    '''
+    def __init__(self, exp, label, location):
+        self.exp = exp
+        self.label = label
+        self.location = location
+        self.count = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+class StackFrame:
+    '''
+    StackFrame is one interned stack of node labels: the frames entered from
+    it are kept by label, so a stack is found again without comparing paths.
+    It accumulates the exclusive time spent with exactly this stack
+    '''
+    def __init__(self, label, parent):
+        self.label = label
+        self.parent = parent
+        self.children = {}
+        self.exclusive = 0.0
+    def child(self, label):
+        frame = self.children.get(label)
+        if frame is None:
+            frame = self.children[label] = StackFrame(label, self)
+        return frame
+    def labels(self):
+        '''
+        Returns the labels of the stack, outermost first
+        '''
+        labels = []
+        frame = self
+        while frame.parent is not None:
+            labels.append(frame.label)
+            frame = frame.parent
+        labels.reverse()
+        return labels
+
+class EProfiled(Exp):
+    '''
+    EProfiled wraps an expression and times its evaluation. The time spent in
+    wrapped sub-expressions is subtracted to get the exclusive time
+    '''
+    def __init__(self, exp, stats, profiler):
+        self.exp = exp
+        self.stats = stats
+        self.profiler = profiler
+    def __str__(self):
+        return str(self.exp)
+    def eval(self, env):
+        profiler = self.profiler
+        profiler.enter(self.stats.label)
+        start = time.perf_counter()
+        try:
+            return self.exp.eval(env)
+        finally:
+            profiler.leave(self.stats, time.perf_counter() - start)
+    def unwrapped(self):
+        return self.exp.unwrapped()
+
+class EProfiledApply(EApply):
+    '''
+    EProfiledApply is an application that times the primitive operations it
+    calls. The primitives themselves are left untouched, so that the fast
+    paths which recognize them, such as vectorized map, still apply
+    '''
+    def __init__(self, fn, args, profiler):
+        self.fn = fn
+        self.args = args
+        self.profiler = profiler
+    def eval(self, env):
+        try:
+            vfn = self.fn.eval(env)
+            vargs = []
+            for arg in self.args:
+                vargs.append(arg.eval(env))
+            if type(vfn) is VPrimitive:
+                return self.profiler.callPrimitive(vfn.oper, vargs)
+            return vfn.apply(vargs)
+        except LanguageError as err:
+            if self.span is not None:
+                err.atSpan(self.span)
+            raise
+    def unwrapped(self):
+        return EApply(self.fn, self.args)
+    def mapChildren(self, f):
+        return EProfiledApply(f(self.fn), [f(arg) for arg in self.args], self.profiler)
+
+def nodeLabel(exp):
+    '''
+    Returns a short label for an expression node, naming the function
+    it calls when it is an application of an identifier
+    '''
+    name = type(exp).__name__
+    if isinstance(exp, EApply) and isinstance(exp.fn, EProfiled) and isinstance(exp.fn.exp, EId):
+        return name + " " + exp.fn.exp.id
+    return name
+
+def nodeLocation(exp):
+    '''
+    Returns a printable location for an expression node, using its source
+    span when it has one and a truncated rendering of the node otherwise
+    '''
+    span = getattr(exp, "span", None)
+    if span is not None:
+        return str(span)
+    text = str(exp)
+    if len(text) > 60:
+        text = text[:57] + "..."
+    return text
+
+class Profiler:
+    '''
+    The Profiler class instruments a copy of an expression, then gathers
+    timings per node, per node type, per primitive operation called by the
+    program and per stack of node labels (for flamegraphs)
+    '''
+    def __init__(self):
+        self.nodes = []
+        self.primitives = {}
+        self.root = StackFrame(None, None)
+        self.frame = self.root
+        self.childTimes = [0.0]
+    def enter(self, label):
+        self.frame = self.frame.child(label)
+        self.childTimes.append(0.0)
+    def leave(self, stats, elapsed):
+        childTime = self.childTimes.pop()
+        exclusive = elapsed - childTime
+        self.childTimes[-1] += elapsed
+        stats.count += 1
+        stats.inclusive += elapsed
+        stats.exclusive += exclusive
+        self.frame.exclusive += exclusive
+        self.frame = self.frame.parent
+    def instrument(self, exp):
+        '''
+        Returns a copy of exp where every node is wrapped in an EProfiled and
+        applications time the primitives they call
+        '''
+        def visit(e):
+            copy = e.mapChildren(visit)
+            copy.span = e.span
+            e = copy
+            stats = NodeStats(e, nodeLabel(e), nodeLocation(e))
+            self.nodes.append(stats)
+            if type(e) is EApply:
+                e = EProfiledApply(e.fn, e.args, self)
+                e.span = copy.span
+            return EProfiled(e, stats, self)
+        return visit(exp)
+    def callPrimitive(self, oper, vs):
+        '''
+        Calls the primitive operation oper on vs, counting and timing the call
+        '''
+        name = getattr(oper, "__name__", str(oper))
+        stats = self.primitives.get(name)
+        if stats is None:
+            stats = self.primitives[name] = [0, 0.0]
+        start = time.perf_counter()
+        try:
+            return oper(vs)
+        finally:
+            stats[0] += 1
+            stats[1] += time.perf_counter() - start
+    def run(self, exp, env):
+        '''
+        Evaluates exp with profiling on in a copy of env, including its
+        global table, so that defines made while profiling go to the copy.
+        Returns its value
+        '''
+        globals = None
+        if env.globals is not None:
+            globals = dict(env.globals)
+        return self.instrument(exp).eval(Env(list(env.content), globals))
+    def report(self, limit=20):
+        '''
+        Returns the profile as text tables sorted by exclusive time
+        '''
+        byType = {}
+        for stats in self.nodes:
+            name = type(stats.exp).__name__
+            entry = byType.setdefault(name, [0, 0.0])
+            entry[0] += stats.count
+            entry[1] += stats.exclusive
+        lines = ["%-40s %10s %12s" % ("node type", "evals", "excl (ms)")]
+        for name, (count, excl) in sorted(byType.items(), key=lambda x: -x[1][1]):
+            lines.append("%-40s %10d %12.3f" % (name, count, excl * 1000))
+        lines.append("")
+        lines.append("%-40s %10s %12s" % ("primitive", "calls", "incl (ms)"))
+        for name, (count, incl) in sorted(self.primitives.items(), key=lambda x: -x[1][1]):
+            if count > 0:
+                lines.append("%-40s %10d %12.3f" % (name, count, incl * 1000))
+        lines.append("")
+        lines.append("%-60s %10s %12s %12s" % ("location", "evals", "incl (ms)", "excl (ms)"))
+        top = sorted([s for s in self.nodes if s.count > 0], key=lambda s: -s.exclusive)[:limit]
+        for stats in top:
+            lines.append("%-60s %10d %12.3f %12.3f" % (stats.location, stats.count, stats.inclusive * 1000, stats.exclusive * 1000))
+        return "\n".join(lines)
+    def foldedStacks(self):
+        '''
+        Returns the exclusive times in microseconds as folded stacks, one
+        "frame;frame;frame count" line per stack, as read by flamegraph.pl
+        '''
+        stacks = []
+        frames = list(self.root.children.values())
+        while frames:
+            frame = frames.pop()
+            stacks.append((frame.labels(), frame.exclusive))
+            frames.extend(frame.children.values())
+        lines = []
+        for labels, seconds in sorted(stacks):
+            lines.append(";".join(labels) + " " + str(int(round(seconds * 1e6))))
+        return "\n".join(lines)
@@ -0,0 +1,347 @@
+'''
+This script contains our serialization format for expressions and values.
+dumps turns an Exp or a Value into bytes and loads turns them back, so parsed
+programs and results can be sent to worker processes or saved to disk. Trees
+are encoded as nested tuples written with marshal: primitive operations are
+referenced by name, primitive distributions by family and parameters, and
+closures keep only the values of their free variables
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+import marshal
+import numpy as np
+import shell as shellModule
+
+# Bumped whenever the encoding changes, loads refuses other versions
+formatVersion = 1
+
+# The constructors of the primitive distributions, by family
+familyConstructors = {
+    "normal": makeNormal,
+    "poisson": makePoisson,
+    "exponential": makeExponential,
+    "beta": makeBeta,
+    "uniform": makeUniform,
+    "randelm": makeRandelm,
+    "bernoulli": makeBernoulli,
+    "binomial": makeBinomial,
+    "categorical": makeCategorical,
+    "mvnormal": makeMvnormal,
+}
+
+def operName(oper):
+    '''
+    Returns the name a primitive operation is serialized as, or raises an
+    error if it cannot be found again by name when loading
+    '''
+    name = getattr(oper, "__name__", None)
+    if name is None or not callable(getattr(shellModule, name, None)):
+        runtimeError("Cannot serialize the python function " + str(oper) + ", only named primitive operations")
+    return name
+
+def freeVariables(e, bound, found):
+    '''
+    Adds to the set found the identifiers used in e that are not in the set
+    bound, i.e. that e looks up in the environment it is evaluated in
+    '''
+    if isinstance(e, EId):
+        if e.id not in bound:
+            found.add(e.id)
+    elif isinstance(e, (EProcedure, EDistribution)):
+        name = e.recName if isinstance(e, EProcedure) else e.name
+        freeVariables(e.body, bound | set(e.params) | {name}, found)
+    elif isinstance(e, ELoop):
+        for (_, init) in e.init:
+            freeVariables(init, bound, found)
+        freeVariables(e.body, bound | {n for (n, _) in e.init} | {e.name}, found)
+    else:
+        # the other expressions bind nothing, visit their sub-expressions
+        def visit(child):
+            freeVariables(child, bound, found)
+            return child
+        e.mapChildren(visit)
+
+class Encoder:
+    '''
+    The Encoder class turns expressions and values into nested tuples. Reference
+    cells, procedures and distributions are numbered when first encoded and
+    referred to by number afterwards, which keeps sharing and cycles
+    '''
+    def __init__(self):
+        self.objects = {}
+        # objects whose id is a key of self.objects are kept alive until the end
+        self.keep = []
+        self.freeVars = {}
+    def share(self, v):
+        '''
+        Returns the number of v and whether v was already encoded
+        '''
+        if id(v) in self.objects:
+            return self.objects[id(v)], True
+        self.objects[id(v)] = len(self.objects)
+        self.keep.append(v)
+        return self.objects[id(v)], False
+    def exp(self, e):
+        cls = type(e)
+        if cls is EFloat:
+            return ("f", e.val)
+        elif cls is ERational:
+            return ("q", e.num, e.den)
+        elif cls is EBoolean:
+            return ("b", e.val)
+        elif cls is EString:
+            return ("s", e.val)
+        elif cls is EId:
+            return ("i", e.id)
+        elif cls is EIf:
+            return ("?", self.exp(e.ec), self.exp(e.et), self.exp(e.ee))
+        elif cls is EApply:
+            return ("a", self.exp(e.fn), [self.exp(arg) for arg in e.args])
+        elif cls is EProcedure:
+            return ("l", e.recName, list(e.params), self.exp(e.body))
+        elif cls is EDistribution:
+            return ("d", e.name, list(e.params), self.exp(e.body))
+        elif cls is ELoop:
+            return ("o", e.name, [(n, self.exp(init)) for (n, init) in e.init], self.exp(e.body))
+        elif cls is EDefine:
+            return ("=", e.name, self.exp(e.exp))
+        elif cls is EMultiple:
+            return ("m", [self.exp(body) for body in e.bodies], operName(e.oper))
+        elif cls is EPrimitive:
+            if e.family is not None:
+                return ("pd", e.family, self.familyArgs(e.familyArgs))
+            return ("p", operName(e.val))
+        runtimeError("Cannot serialize the expression " + truncate(str(e)))
+    def familyArgs(self, args):
+        '''
+        Encodes the parameters of a primitive distribution: numbers, numpy
+        arrays, and lists of numbers or of values (e.g. the elements of randelm)
+        '''
+        args = [arg.tolist() if isinstance(arg, np.ndarray) else arg for arg in args]
+        return [[self.value(x) if isinstance(x, Value) else x for x in arg] if isinstance(arg, list) else arg for arg in args]
+    def captured(self, fn, name):
+        '''
+        Returns the (name, value) pairs of the free variables of the body of
+        the procedure or distribution fn. Primitives are left out, they are
+        found again in the global table of the loading side
+        '''
+        key = id(fn.body)
+        if key not in self.freeVars:
+            found = set()
+            freeVariables(fn.body, set(fn.params) | {name}, found)
+            self.freeVars[key] = sorted(found)
+            self.keep.append(fn.body)
+        pairs = []
+        for var in self.freeVars[key]:
+            try:
+                v = fn.env.lookup(var)
+            except UnboundIdentifierError:
+                # only an error if the body ever looks it up
+                continue
+            if isinstance(v, VPrimitive) and var in primitives:
+                continue
+            pairs.append((var, self.value(v)))
+        return pairs
+    def value(self, v):
+        cls = type(v)
+        if cls is VFloat:
+            return ("F", v.val)
+        elif cls is VRational:
+            return ("Q", v.num, v.den)
+        elif cls is VBoolean:
+            return ("B", v.getBoolean())
+        elif cls is VString:
+            return ("S", v.getString())
+        elif cls is VNil:
+            return ("N",)
+        elif cls is VVector:
+            floats = v.getFloats()
+            if floats is not None:
+                return ("A", np.ascontiguousarray(floats, dtype=float).tobytes())
+            return ("V", [self.value(elm) for elm in v.getList()])
+        elif cls is VMatrix:
+            array = np.ascontiguousarray(v.getMatrix(), dtype=float)
+            return ("M", array.shape, array.tobytes())
+        elif cls is VPrimitive:
+            return ("O", operName(v.oper))
+        elif cls is VLoop:
+            return ("W", v.name)
+        elif cls is VRefCell:
+            n, seen = self.share(v)
+            if seen:
+                return ("R", n)
+            return ("C", n, self.value(v.getRefContent()))
+        elif cls is VProcedure:
+            n, seen = self.share(v)
+            if seen:
+                return ("R", n)
+            return ("P", n, v.name, list(v.params), self.exp(v.body), self.captured(v, v.name))
+        elif cls is VDistribution:
+            if v.family in familyConstructors and isinstance(v.body, EPrimitive):
+                return ("DF", v.family, self.familyArgs(v.familyArgs))
+            n, seen = self.share(v)
+            if seen:
+                return ("R", n)
+            return ("D", n, v.name, list(v.params), self.exp(v.body), self.captured(v, v.name))
+        elif cls is VAccumulator:
+            acc = v.getAccumulator()
+            state = {}
+            for attr, x in vars(acc).items():
+                # the random source is not kept, loaded accumulators use numpy's
+                state[attr] = None if attr == "random" else self.data(x)
+            return ("X", type(acc).__name__, state)
+        runtimeError("Cannot serialize the value " + describeValue(v))
+    def data(self, x):
+        '''
+        Encodes the python numbers, lists and numpy arrays inside accumulators
+        '''
+        if isinstance(x, np.ndarray):
+            return ("nd", x.dtype.str, x.shape, x.tobytes())
+        elif isinstance(x, list):
+            return ("ls", [self.data(y) for y in x])
+        return x
+
+class Decoder:
+    '''
+    The Decoder class turns the nested tuples of an Encoder back into
+    expressions and values. Closures are given an environment holding their
+    captured variables on top of the global table globals
+    '''
+    def __init__(self, globals):
+        self.globals = globals
+        self.objects = {}
+    def exp(self, t):
+        tag = t[0]
+        if tag == "f":
+            return EFloat(t[1])
+        elif tag == "q":
+            return ERational(t[1], t[2])
+        elif tag == "b":
+            return EBoolean(t[1])
+        elif tag == "s":
+            return EString(t[1])
+        elif tag == "i":
+            return EId(t[1])
+        elif tag == "?":
+            return EIf(self.exp(t[1]), self.exp(t[2]), self.exp(t[3]))
+        elif tag == "a":
+            return EApply(self.exp(t[1]), [self.exp(arg) for arg in t[2]])
+        elif tag == "l":
+            return EProcedure(t[1], t[2], self.exp(t[3]))
+        elif tag == "d":
+            return EDistribution(t[1], t[2], self.exp(t[3]))
+        elif tag == "o":
+            return ELoop(t[1], [(n, self.exp(init)) for (n, init) in t[2]], self.exp(t[3]))
+        elif tag == "=":
+            return EDefine(t[1], self.exp(t[2]))
+        elif tag == "m":
+            return EMultiple([self.exp(body) for body in t[1]], getattr(shellModule, t[2]))
+        elif tag == "pd":
+            return self.distribution(t[1], t[2]).body
+        elif tag == "p":
+            return EPrimitive(getattr(shellModule, t[1]))
+        runtimeError("Cannot load an expression tagged " + str(tag))
+    def distribution(self, family, args):
+        args = [[self.value(x) if isinstance(x, tuple) else x for x in arg] if isinstance(arg, list) else arg for arg in args]
+        return familyConstructors[family](*args)
+    def closure(self, v, captured):
+        v.env = Env([(name, self.value(x)) for (name, x) in captured], self.globals)
+        return v
+    def value(self, t):
+        tag = t[0]
+        if tag == "F":
+            return VFloat(t[1])
+        elif tag == "Q":
+            return VRational(t[1], t[2])
+        elif tag == "B":
+            return VBoolean(t[1])
+        elif tag == "S":
+            return VString(t[1])
+        elif tag == "N":
+            return VNil()
+        elif tag == "A":
+            return VVector.fromFloats(np.frombuffer(t[1], dtype=float).copy())
+        elif tag == "V":
+            return VVector([self.value(elm) for elm in t[1]])
+        elif tag == "M":
+            return VMatrix(np.frombuffer(t[2], dtype=float).reshape(t[1]).copy())
+        elif tag == "O":
+            return VPrimitive(getattr(shellModule, t[1]))
+        elif tag == "W":
+            return VLoop(t[1])
+        elif tag == "R":
+            return self.objects[t[1]]
+        elif tag == "C":
+            # registered before its content is loaded, which may refer back to it
+            v = VRefCell(None)
+            self.objects[t[1]] = v
+            v.putRefContent(self.value(t[2]))
+            return v
+        elif tag == "P":
+            v = VProcedure(t[2], t[3], self.exp(t[4]), None)
+            self.objects[t[1]] = v
+            return self.closure(v, t[5])
+        elif tag == "D":
+            v = VDistribution(t[2], t[3], self.exp(t[4]), None)
+            self.objects[t[1]] = v
+            return self.closure(v, t[5])
+        elif tag == "DF":
+            return self.distribution(t[1], t[2])
+        elif tag == "X":
+            cls = getattr(stats, t[1])
+            acc = cls.__new__(cls)
+            for attr, x in t[2].items():
+                setattr(acc, attr, self.data(x))
+            return VAccumulator(acc)
+        runtimeError("Cannot load a value tagged " + str(tag))
+    def data(self, x):
+        if isinstance(x, tuple) and x and x[0] == "nd":
+            return np.frombuffer(x[3], dtype=np.dtype(x[1])).reshape(x[2]).copy()
+        elif isinstance(x, tuple) and x and x[0] == "ls":
+            return [self.data(y) for y in x[1]]
+        return x
+
+def dumps(x):
+    '''
+    Returns the bytes encoding the expression or value x
+    '''
+    encoder = Encoder()
+    if isinstance(x, Exp):
+        return marshal.dumps((formatVersion, "exp", encoder.exp(x)))
+    return marshal.dumps((formatVersion, "value", encoder.value(x)))
+
+def loads(data, globals=None):
+    '''
+    Returns the expression or value encoded in the bytes data. Closures look
+    up their globals, e.g. primitives, in the dictionary globals, by default
+    a fresh copy of the primitives table
+    '''
+    version, kind, tree = marshal.loads(data)
+    if version != formatVersion:
+        runtimeError("Cannot load serialization format " + str(version) + ", expected " + str(formatVersion))
+    if globals is None:
+        globals = dict(primitives)
+    decoder = Decoder(globals)
+    if kind == "exp":
+        return decoder.exp(tree)
+    return decoder.value(tree)
+
+def dump(x, filename):
+    '''
+    Writes the encoding of the expression or value x to the file filename
+    '''
+    f = open(filename, "wb")
+    f.write(dumps(x))
+    f.close()
+
+def load(filename, globals=None):
+    '''
+    Reads an expression or value written by dump from the file filename
+    '''
+    f = open(filename, "rb")
+    data = f.read()
+    f.close()
+    return loads(data, globals)
@@ -0,0 +1,314 @@
+'''
+This script contains our local evaluation server. Clients send one JSON
+request per line, e.g. {"id": 1, "source": "(sample (normal 0, 1))",
+"samples": 1000, "seed": 7}, over a unix socket or localhost TCP, and get back
+one JSON line per chunk of results followed by a "done" line. Run it with
+`python server.py --port 8765` or `python server.py --unix /tmp/fa.sock`
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+from interpreter import *
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+# The interpreter of each worker process, created by its first request
+worker = None
+
+class ChunkTimeout(BaseException):
+    '''
+    ChunkTimeout is raised in a worker process when the deadline of the
+    request it is evaluating passes. It is not an Exception, so that no
+    handler around the evaluation of the program can swallow it
+    '''
+    def __str__(self):
+        return "timed out"
+
+def onDeadline(signum, frame):
+    raise ChunkTimeout()
+
+class RequestTooLong(Exception):
+    '''
+    RequestTooLong is raised when a request line is longer than the line
+    limit of the server. The rest of the line has been skipped
+    '''
+    def __str__(self):
+        return "request line too long"
+
+async def readRequest(reader):
+    '''
+    Returns the next request line of reader, or b"" at the end of the
+    stream. A line over the limit of the reader is skipped up to its newline,
+    so that the requests after it are still read, and RequestTooLong is raised
+    '''
+    try:
+        return await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        consumed = e.consumed
+    while True:
+        await reader.readexactly(consumed)
+        try:
+            await reader.readuntil(b"\n")
+            break
+        except asyncio.IncompleteReadError:
+            break
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+    raise RequestTooLong()
+
+def toJson(v):
+    '''
+    Converts a value to something the json module can write
+    '''
+    if v.isFloat():
+        return v.getFloat()
+    elif v.isBoolean():
+        return v.getBoolean()
+    elif v.isString():
+        return v.getString()
+    elif v.isRational():
+        return v.getNumerator() / v.getDenominator()
+    elif v.isNil():
+        return None
+    elif v.isVector():
+        return [toJson(elm) for elm in v.getList()]
+    return v.toDisplay()
+
+def evalChunk(source, seed, count, deadline=None):
+    '''
+    Evaluates source count times with the interpreter of a worker process,
+    which keeps parsed programs cached, and returns json-ready results. Each
+    chunk starts from a fresh environment, so the defines of one request are
+    never seen by another. Evaluation is interrupted with a ChunkTimeout once
+    the time.time() deadline passes
+    '''
+    global worker
+    if worker is None:
+        worker = Interpreter()
+    worker.seed(seed)
+    worker.env = newEnv()
+    try:
+        e = worker.parse(source)
+        if deadline is None or not hasattr(signal, "setitimer"):
+            return [toJson(worker.evalExp(e)) for i in range(count)]
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ChunkTimeout()
+        signal.signal(signal.SIGALRM, onDeadline)
+        # the timer fires again every 0.1 s, in case an evaluation catches it
+        signal.setitimer(signal.ITIMER_REAL, remaining, 0.1)
+        try:
+            return [toJson(worker.evalExp(e)) for i in range(count)]
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except LanguageError as err:
+        # errors keep references to values, only their message is sent back
+        raise RuntimeError(str(err)) from None
+
+class EvalServer:
+    '''
+    The EvalServer class accepts requests on a socket and dispatches their
+    evaluation to a pool of worker processes. At most maxPending requests are
+    in flight; beyond that the server stops reading from its connections so
+    that clients feel the backpressure
+    '''
+    def __init__(self, workers=None, maxPending=32, timeout=30.0, chunkSize=256, lineLimit=64 * 2**20):
+        self.pool = ProcessPoolExecutor(workers)
+        self.maxPending = maxPending
+        self.lineLimit = lineLimit
+        self.timeout = timeout
+        self.chunkSize = chunkSize
+        self.slots = None
+        self.server = None
+        self.latencies = deque(maxlen=10000)
+        self.completed = 0
+        self.failed = 0
+        self.timedOut = 0
+        self.pending = 0
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        '''
+        Starts listening on the unix socket path if given, otherwise on
+        host:port. Returns the address actually bound
+        '''
+        self.slots = asyncio.Semaphore(self.maxPending)
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handleConnection, path=path, limit=self.lineLimit)
+        else:
+            self.server = await asyncio.start_server(self.handleConnection, host, port, limit=self.lineLimit)
+        return self.server.sockets[0].getsockname()
+    async def close(self):
+        '''
+        Stops accepting connections and shuts the worker pool down
+        '''
+        self.server.close()
+        await self.server.wait_closed()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+    def stats(self):
+        '''
+        Returns the request counters and latency percentiles in seconds
+        '''
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timedOut,
+            "pending": self.pending,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "latency_p50": percentile(0.50),
+            "latency_p95": percentile(0.95),
+            "latency_p99": percentile(0.99),
+        }
+    async def handleConnection(self, reader, writer):
+        '''
+        Reads the requests of one connection line by line and handles them
+        concurrently. A request slot is taken before each read, so a busy
+        server leaves further requests unread in the socket. The slot goes
+        back when the read fails or the line is not handed to a request
+        '''
+        lock = asyncio.Lock()
+        tasks = set()
+        async def send(message):
+            async with lock:
+                writer.write((json.dumps(message) + "\n").encode())
+                await writer.drain()
+        try:
+            while True:
+                await self.slots.acquire()
+                handled = False
+                try:
+                    line = await readRequest(reader)
+                    if not line:
+                        break
+                    task = asyncio.ensure_future(self.handleRequest(line, send))
+                    handled = True
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                except RequestTooLong as e:
+                    self.failed += 1
+                    await send({"id": None, "type": "error", "error": str(e)})
+                except ConnectionError:
+                    break
+                finally:
+                    if not handled:
+                        self.slots.release()
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+    async def handleRequest(self, line, send):
+        '''
+        Handles one request line, streaming its results through send, and
+        records its latency or failure
+        '''
+        start = time.perf_counter()
+        request_id = None
+        self.pending += 1
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            if request.get("op") == "stats":
+                await send({"id": request_id, "type": "stats", "stats": self.stats()})
+                return
+            timeout = request.get("timeout", self.timeout)
+            await asyncio.wait_for(self.stream(request, send, time.time() + timeout), timeout)
+            latency = time.perf_counter() - start
+            self.latencies.append(latency)
+            self.completed += 1
+            await send({"id": request_id, "type": "done", "latency": latency})
+        except (asyncio.TimeoutError, ChunkTimeout):
+            self.timedOut += 1
+            await send({"id": request_id, "type": "error", "error": "timed out"})
+        except Exception as e:
+            self.failed += 1
+            await send({"id": request_id, "type": "error", "error": str(e)})
+        finally:
+            self.pending -= 1
+            self.slots.release()
+    async def stream(self, request, send, deadline):
+        '''
+        Splits a request into chunks of samples, evaluates them in the pool
+        and sends each chunk of results back in order as it completes. The
+        workers stop evaluating the chunks by themselves at the deadline,
+        which cancelling their futures could not do once they have started
+        '''
+        source = request["source"]
+        samples = int(request.get("samples", 1))
+        seed = request.get("seed")
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), "little")
+        loop = asyncio.get_running_loop()
+        futures = []
+        for i, offset in enumerate(range(0, samples, self.chunkSize)):
+            count = min(self.chunkSize, samples - offset)
+            futures.append(loop.run_in_executor(self.pool, evalChunk, source, (seed + i) % 2**32, count, deadline))
+        try:
+            for future in futures:
+                values = await future
+                await send({"id": request.get("id"), "type": "result", "values": values})
+        finally:
+            for future in futures:
+                future.cancel()
+
+def request(message, host="127.0.0.1", port=None, path=None):
+    '''
+    Sends one request to a running server and returns the list of responses
+    up to its "done" or "error" line. Mostly useful for tests and scripts
+    '''
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port))
+    stream = sock.makefile("rwb")
+    stream.write((json.dumps(message) + "\n").encode())
+    stream.flush()
+    responses = []
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        response = json.loads(line)
+        responses.append(response)
+        if response["type"] in ("done", "error", "stats"):
+            break
+    stream.close()
+    sock.close()
+    return responses
+
+async def serve(host, port, path, workers):
+    '''
+    Runs an EvalServer until the process is interrupted
+    '''
+    server = EvalServer(workers)
+    address = await server.start(host, port, path)
+    print("listening on " + str(address))
+    sys.stdout.flush()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Fake Anglican evaluation server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="listen on this unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers))
+    except KeyboardInterrupt:
+        pass
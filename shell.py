@@ -5,77 +5,88 @@ from helper import *
 from exp import *
 from value import *
 from env import *
-from parsita import *
-from parsita.util import constant
-import string
-import random
 from our_parser import *
+from collections import OrderedDict
+from types import MappingProxyType
+import bisect
 import math
-import numpy as np
-import re
+import sys
+import threading
+import time
+
+# numpy is only needed once something is sampled, so it is imported lazily
+np = LazyModule("numpy")
+stats = LazyModule("stats")
 
 def checkNumberArgs(vs, num):
     '''
     Throws an error if the length of vs is not the same as num
     '''
     if len(vs) != num:
-        runtimeError("Wrong number of arguments " + str(len(vs)) + " - expected " + str(num))
+        arityError(len(vs), num)
 
 def checkFloat(v):
     '''
     Throws an error if v is not a VFloat
     '''
     if not v.isFloat():
-        runtimeError("Value " + str(v) + " is not of type FLOAT")
+        typeError(v, "FLOAT")
 
 def checkRational(v):
     '''
     Throws an error if v is not a VRational
     '''
     if not v.isRational():
-        runtimeError("Value " + str(v) + " is not of type RATIONAL")
+        typeError(v, "RATIONAL")
 
 def checkBoolean(v):
     '''
     Throws an error if v is not a VBoolean
     '''
     if not v.isBoolean():
-        runtimeError("Value " + str(v) + " is not of type BOOLEAN")
+        typeError(v, "BOOLEAN")
 
 def checkString(v):
     '''
     Throws an error if v is not a VString
     '''
     if not v.isString():
-        runtimeError("Value " + str(v) + " is not of type STRING")
+        typeError(v, "STRING")
 
 def checkProcedure(v):
     '''
     Throws an error if v is not a VProcedure
     '''
     if not v.isProcedure():
-        runtimeError("Value " + str(v) + " is not of type PROCEDURE")
+        typeError(v, "PROCEDURE")
 
 def checkRefCell(v):
     '''
     Throws an error if v is not a VRefCell
     '''
     if not v.isRefCell():
-        runtimeError("Value " + str(v) + " is not of type REFCELL")
+        typeError(v, "REFCELL")
 
 def checkVector(v):
     '''
     Throws an error if v is not a VVector
     '''
     if not v.isVector():
-        runtimeError("Value " + str(v) + " is not of type VECTOR")
+        typeError(v, "VECTOR")
+
+def checkMatrix(v):
+    '''
+    Throws an error if v is not a VMatrix
+    '''
+    if not v.isMatrix():
+        typeError(v, "MATRIX")
 
 def checkDistribution(v):
     '''
     Throws an error if v is not a VDistribution
     '''
     if not v.isDistribution():
-        runtimeError("Value " + str(v) + " is not of type DISTRIBUTION")
+        typeError(v, "DISTRIBUTION")
 
 def convertFloat(v):
     '''
@@ -87,14 +98,200 @@ def convertFloat(v):
     elif v.isRational():
         rational_float_v = float(v.getNumerator()/v.getDenominator())
     else:
-        runtimeError("Value " + str(v) + " is not of type RATIONAL or FLOAT")
+        typeError(v, "RATIONAL or FLOAT")
     return rational_float_v
 
+def isArray(v):
+    '''
+    Returns true if v is a vector or a matrix, which arithmetic applies to
+    elementwise
+    '''
+    return v.isVector() or v.isMatrix()
+
+def numericArray(v):
+    '''
+    Returns the numpy array of the numbers in the vector or matrix v, or
+    throws an error if one of its elements is not a VRational or VFloat
+    '''
+    if v.isMatrix():
+        return v.getMatrix()
+    floats = v.getFloats()
+    if floats is not None:
+        return floats
+    return np.array([convertFloat(elm) for elm in v.getList()], dtype=float)
+
+def arrayValue(array):
+    '''
+    Returns the value of a numpy array of floats: a VMatrix if it has two
+    dimensions, a VVector if it has one and a VFloat if it is a scalar
+    '''
+    array = np.asarray(array, dtype=float)
+    if array.ndim == 2:
+        return VMatrix(array)
+    elif array.ndim == 1:
+        return VVector.fromFloats(array)
+    return VFloat(float(array))
+
+def broadcast(ufunc, *vs):
+    '''
+    Applies the numpy function ufunc to the numbers, numeric vectors and
+    matrices vs in one array operation, numbers and vectors being broadcast
+    as in numpy, and returns the resulting vector or matrix. Domain errors
+    give nan or inf elementwise instead of an error
+    '''
+    arrays = [numericArray(v) if isArray(v) else convertFloat(v) for v in vs]
+    try:
+        with np.errstate(all="ignore"):
+            result = ufunc(*arrays)
+    except ValueError:
+        runtimeError("Cannot broadcast arrays of shapes " + " and ".join(str(np.shape(a)) for a in arrays if isinstance(a, np.ndarray)))
+    return arrayValue(result)
+
+def convertCount(v):
+    '''
+    If v is a VRational or VFloat holding a non-negative integer, we convert
+    it to a python int and return it
+    '''
+    rational_float_v = convertFloat(v)
+    if not rational_float_v.is_integer() or rational_float_v < 0:
+        runtimeError("Value " + str(v) + " is not a non-negative integer")
+    return int(rational_float_v)
+
+def valuesEqual(v1, v2):
+    '''
+    Returns true if v1 and v2 are equal for the = primitive: numbers are
+    compared with a relative tolerance, vectors element by element and other
+    values structurally. Hash-based primitives use the exact == of values
+    '''
+    if (v1.isFloat() or v1.isRational()) and (v2.isFloat() or v2.isRational()):
+        return math.isclose(convertFloat(v1), convertFloat(v2))
+    elif v1.isVector() and v2.isVector():
+        l1 = v1.getList()
+        l2 = v2.getList()
+        return len(l1) == len(l2) and all(valuesEqual(x, y) for x, y in zip(l1, l2))
+    return v1 == v2
+
+# Closed-form distribution algebra
+def composeDistributions(v1, v2, oper):
+    '''
+    Builds a VDistribution whose body samples v1 and/or v2 and combines the
+    results with oper. This is the fallback used when no closed form is known
+    '''
+    if v1.isDistribution() and v2.isDistribution():
+        # new distribution should have combined params and env of v1 & v2
+        new_env = Env(v1.env.content+v2.env.content, v1.env.globals or v2.env.globals)
+        body = EMultiple([v1.body, v2.body], oper)
+        return VDistribution("", v1.params+v2.params, body, new_env)
+    elif v1.isDistribution() and (v2.isRational() or v2.isFloat()):
+        v2_float = convertFloat(v2)
+        body = EMultiple([v1.body, EFloat(v2_float)], oper)
+        return VDistribution("", v1.params, body, v1.env)
+    elif v2.isDistribution() and (v1.isRational() or v1.isFloat()):
+        v1_float = convertFloat(v1)
+        body = EMultiple([EFloat(v1_float), v2.body], oper)
+        return VDistribution("", v2.params, body, v2.env)
+    else:
+        typeError([v1, v2], "RATIONAL or FLOAT or DISTRIBUTION")
+
+def binomialArgs(v):
+    '''
+    Returns the (n, p) parameters of a bernoulli or binomial distribution,
+    or None if v is not one of them
+    '''
+    if v.family == "bernoulli":
+        return (1, v.familyArgs[0])
+    elif v.family == "binomial":
+        return (v.familyArgs[0], v.familyArgs[1])
+    return None
+
+def shiftDistribution(v, c):
+    '''
+    Returns the closed form of v + c for a constant float c, or None
+    '''
+    if v.family == "normal":
+        return makeNormal(v.familyArgs[0] + c, v.familyArgs[1])
+    elif v.family == "uniform":
+        return makeUniform(v.familyArgs[0] + c, v.familyArgs[1] + c)
+    return None
+
+def scaleDistribution(v, c):
+    '''
+    Returns the closed form of v * c for a constant float c, or None
+    '''
+    if v.family == "normal":
+        return makeNormal(v.familyArgs[0] * c, abs(c) * v.familyArgs[1])
+    elif v.family == "uniform":
+        lo = v.familyArgs[0] * c
+        hi = v.familyArgs[1] * c
+        return makeUniform(min(lo, hi), max(lo, hi))
+    elif v.family == "exponential" and c > 0:
+        return makeExponential(v.familyArgs[0] * c)
+    return None
+
+def closedFormMinus(v1):
+    '''
+    Returns a primitive distribution for the negation of v1, or None if
+    there is no closed form
+    '''
+    if v1.family == "normal":
+        return makeNormal(-v1.familyArgs[0], v1.familyArgs[1])
+    elif v1.family == "uniform":
+        return makeUniform(-v1.familyArgs[1], -v1.familyArgs[0])
+    return None
+
+def closedFormPlus(v1, v2):
+    '''
+    Returns a primitive distribution for v1 + v2 when at least one of them
+    is a distribution and the sum has a known closed form, or None otherwise
+    e.g. (+ (normal 0, 1), (normal 2, 3)) is (normal 2, (sqrt 10))
+    '''
+    if not v1.isDistribution():
+        v1, v2 = v2, v1
+    if v2.isDistribution():
+        if v1.family == "normal" and v2.family == "normal":
+            m1, s1 = v1.familyArgs
+            m2, s2 = v2.familyArgs
+            return makeNormal(m1 + m2, math.sqrt(s1*s1 + s2*s2))
+        elif v1.family == "poisson" and v2.family == "poisson":
+            return makePoisson(v1.familyArgs[0] + v2.familyArgs[0])
+        b1 = binomialArgs(v1)
+        b2 = binomialArgs(v2)
+        if b1 is not None and b2 is not None and b1[1] == b2[1]:
+            return makeBinomial(b1[0] + b2[0], b1[1])
+        return None
+    elif v2.isRational() or v2.isFloat():
+        return shiftDistribution(v1, convertFloat(v2))
+    return None
+
+def closedFormTimes(v1, v2):
+    '''
+    Returns a primitive distribution for v1 * v2 when one of them is a
+    distribution and the other a constant with a known closed form, or None
+    e.g. (* 2, (uniform 0, 1)) is (uniform 0, 2)
+    '''
+    if not v1.isDistribution():
+        v1, v2 = v2, v1
+    if v2.isRational() or v2.isFloat():
+        return scaleDistribution(v1, convertFloat(v2))
+    return None
+
+def closedFormDiv(v1, v2):
+    '''
+    Returns a primitive distribution for v1 / v2 when v1 is a distribution
+    and v2 a non-zero constant with a known closed form, or None
+    '''
+    if v1.isDistribution() and (v2.isRational() or v2.isFloat()):
+        c = convertFloat(v2)
+        if c != 0:
+            return scaleDistribution(v1, 1/c)
+    return None
+
 def operMinus(vs):
     '''
     operMinus is a primitive operation that takes one argument and
     evaluates to the negative form of that argument
-    e.g. (- 5) evaluates to -5, (- (- 5)) evaluates to 5
+    e.g. (- 5) evaluates to -5, (- (- 5)) evaluates to 5, (- (vector 1, 2))
+    evaluates to (-1, -2)
     '''
     checkNumberArgs(vs, 1)
     v1 = vs[0]
@@ -103,16 +300,22 @@ def operMinus(vs):
     elif v1.isFloat():
         return VFloat(-1*v1.getFloat())
     elif v1.isDistribution():
+        closed = closedFormMinus(v1)
+        if closed is not None:
+            return closed
         body = EMultiple([v1.body], operMinus)
         return VDistribution("", v1.params, body, v1.env)
+    elif isArray(v1):
+        return broadcast(np.negative, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operPlus(vs):
     '''
     operPlus is a primitive operation that takes two arguments and
     evaluates to the sum of those two arguments
-    e.g. (+ 1, 2) evaluates to 3
+    e.g. (+ 1, 2) evaluates to 3. Vectors are added elementwise, numbers
+    being broadcast over them, e.g. (+ (vector 1, 2), 1) evaluates to (2, 3)
     '''
     checkNumberArgs(vs, 2)
     v1 = vs[0]
@@ -133,27 +336,22 @@ def operPlus(vs):
         n1 = v1.getNumerator()
         d1 = v1.getDenominator()
         return VFloat(v2.getFloat()+float(n1/d1))
-    elif v1.isDistribution() and v2.isDistribution():
-        # new distribution should have combined params and env of v1 & v2
-        new_env = Env(v1.env.content+v2.env.content)
-        body = EMultiple([v1.body, v2.body], operPlus)
-        return VDistribution("", v1.params+v2.params, body, new_env)
-    elif v1.isDistribution() and (v2.isRational() or v2.isFloat()):
-        v2_float = convertFloat(v2)
-        body = EMultiple([v1.body, EFloat(v2_float)], operPlus)
-        return VDistribution("", v1.params, body, v1.env)
-    elif v2.isDistribution() and (v1.isRational() or v1.isFloat()):
-        v1_float = convertFloat(v1)
-        body = EMultiple([v2.body, EFloat(v1_float)], operPlus)
-        return VDistribution("", v2.params, body, v2.env)
+    elif v1.isDistribution() or v2.isDistribution():
+        closed = closedFormPlus(v1, v2)
+        if closed is not None:
+            return closed
+        return composeDistributions(v1, v2, operPlus)
+    elif isArray(v1) or isArray(v2):
+        return broadcast(np.add, v1, v2)
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " is not of type RATIONAL or FLOAT or PRIMITIVE or DISTRIBUTION")
+        typeError([v1, v2], "RATIONAL or FLOAT or VECTOR or MATRIX or PRIMITIVE or DISTRIBUTION")
 
 def operTimes(vs):
     '''
     operTimes is a primitive operation that takes two arguments and
     evaluates to the product of those two arguments
-    e.g. (* 2, 3) evaluates to 6
+    e.g. (* 2, 3) evaluates to 6. Vectors are multiplied elementwise, numbers
+    being broadcast over them, e.g. (* (vector 1, 2), 2) evaluates to (2, 4)
     '''
     checkNumberArgs(vs, 2)
     v1 = vs[0]
@@ -174,28 +372,23 @@ def operTimes(vs):
         n1 = v1.getNumerator()
         d1 = v1.getDenominator()
         return VFloat(v2.getFloat()*float(n1/d1))
-    elif v1.isDistribution() and v2.isDistribution():
-        # new distribution should have combined params and env of v1 & v2
-        new_env = Env(v1.env.content+v2.env.content)
-        body = EMultiple([v1.body, v2.body], operTimes)
-        return VDistribution("", v1.params+v2.params, body, new_env)
-    elif v1.isDistribution() and (v2.isRational() or v2.isFloat()):
-        v2_float = convertFloat(v2)
-        body = EMultiple([v1.body, EFloat(v2_float)], operTimes)
-        return VDistribution("", v1.params, body, v1.env)
-    elif v2.isDistribution() and (v1.isRational() or v1.isFloat()):
-        v1_float = convertFloat(v1)
-        body = EMultiple([v2.body, EFloat(v1_float)], operTimes)
-        return VDistribution("", v2.params, body, v2.env)
+    elif v1.isDistribution() or v2.isDistribution():
+        closed = closedFormTimes(v1, v2)
+        if closed is not None:
+            return closed
+        return composeDistributions(v1, v2, operTimes)
+    elif isArray(v1) or isArray(v2):
+        return broadcast(np.multiply, v1, v2)
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " is not of type RATIONAL or FLOAT")
+        typeError([v1, v2], "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operDiv(vs):
     '''
     operDiv is a primitive operation that takes two arguments and
     evaluates to the quotient resulting from dividing the first argument
     by the second argument
-    e.g. (/ 6, 3) evaluates to 2
+    e.g. (/ 6, 3) evaluates to 2. Vectors are divided elementwise, numbers
+    being broadcast over them, e.g. (/ 1, (vector 1, 2)) evaluates to (1, 0.5)
     '''
     checkNumberArgs(vs, 2)
     v1 = vs[0]
@@ -216,21 +409,15 @@ def operDiv(vs):
         n1 = v1.getNumerator()
         d1 = v1.getDenominator()
         return VFloat(float(n1/d1)/v2.getFloat())
-    elif v1.isDistribution() and v2.isDistribution():
-        # new distribution should have combined params and env of v1 & v2
-        new_env = Env(v1.env.content+v2.env.content)
-        body = EMultiple([v1.body, v2.body], operDiv)
-        return VDistribution("", v1.params+v2.params, body, new_env)
-    elif v1.isDistribution() and (v2.isRational() or v2.isFloat()):
-        v2_float = convertFloat(v2)
-        body = EMultiple([v1.body, EFloat(v2_float)], operDiv)
-        return VDistribution("", v1.params, body, v1.env)
-    elif v2.isDistribution() and (v1.isRational() or v1.isFloat()):
-        v1_float = convertFloat(v1)
-        body = EMultiple([v2.body, EFloat(v1_float)], operDiv)
-        return VDistribution("", v2.params, body, v2.env)
+    elif v1.isDistribution() or v2.isDistribution():
+        closed = closedFormDiv(v1, v2)
+        if closed is not None:
+            return closed
+        return composeDistributions(v1, v2, operDiv)
+    elif isArray(v1) or isArray(v2):
+        return broadcast(np.divide, v1, v2)
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " is not of type RATIONAL or FLOAT")
+        typeError([v1, v2], "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operEqual(vs):
     '''
@@ -241,7 +428,7 @@ def operEqual(vs):
     checkNumberArgs(vs, 2)
     v1 = vs[0]
     v2 = vs[1]
-    if v1 == v2:
+    if valuesEqual(v1, v2):
         return VBoolean(True)
     return VBoolean(False)
 
@@ -254,7 +441,7 @@ def operNotEqual(vs):
     checkNumberArgs(vs, 2)
     v1 = vs[0]
     v2 = vs[1]
-    if v1 == v2:
+    if valuesEqual(v1, v2):
         return VBoolean(False)
     return VBoolean(True)
 
@@ -284,7 +471,7 @@ def operLess(vs):
         d1 = v1.getDenominator()
         return VFloat(float(n1/d1) < v2.getFloat())
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " is not of type RATIONAL or FLOAT")
+        typeError([v1, v2], "RATIONAL or FLOAT")
 
 def operGreater(vs):
     '''
@@ -312,7 +499,7 @@ def operGreater(vs):
         d1 = v1.getDenominator()
         return VFloat(float(n1/d1) > v2.getFloat())
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " is not of type RATIONAL or FLOAT")
+        typeError([v1, v2], "RATIONAL or FLOAT")
 
 def operLessEq(vs):
     '''
@@ -341,7 +528,7 @@ def operLessEq(vs):
         d1 = v1.getDenominator()
         return VFloat(float(n1/d1) <= v2.getFloat())
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " is not of type RATIONAL or FLOAT")
+        typeError([v1, v2], "RATIONAL or FLOAT")
 
 def operGreaterEq(vs):
     '''
@@ -370,7 +557,7 @@ def operGreaterEq(vs):
         d1 = v1.getDenominator()
         return VFloat(float(n1/d1) >= v2.getFloat())
     else:
-        runtimeError("Value " + str(v1) + " and/or " + str(v2) + " are not of type RATIONAL or FLOAT")
+        typeError([v1, v2], "RATIONAL or FLOAT")
 
 def operRefCell(vs):
     '''
@@ -458,11 +645,11 @@ def operSubstring(vs):
     rational_float_v2 = convertFloat(v2)
     rational_float_v3 = convertFloat(v3)
     if not rational_float_v2.is_integer() or not rational_float_v3.is_integer():
-        runtimeError(f"Values {str(v2)} and/or {str(v3)} are not integers")
+        runtimeError("Values " + describeValue(v2) + " and/or " + describeValue(v3) + " are not integers")
     try:
         return VString(v1.getString()[int(rational_float_v2): int(rational_float_v3)]) # kinda weird!
     except:
-        runtimeError(f"Values {str(v2)} and {str(v3)} are invalid indices")
+        runtimeError("Values " + describeValue(v2) + " and " + describeValue(v3) + " are invalid indices")
 
 def operEven(vs):
     '''
@@ -477,7 +664,7 @@ def operEven(vs):
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VBoolean(rational_float % 2 == float(0))
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT")
 
 def operOdd(vs):
     '''
@@ -492,7 +679,7 @@ def operOdd(vs):
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VBoolean(rational_float % 2 == float(1))
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT")
 
 
 def operLog(vs):
@@ -507,8 +694,10 @@ def operLog(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.log(rational_float))
+    elif isArray(v1):
+        return broadcast(np.log, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operLog10(vs):
     '''
@@ -522,8 +711,10 @@ def operLog10(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.log(rational_float, 10))
+    elif isArray(v1):
+        return broadcast(np.log10, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operExp(vs):
     '''
@@ -537,8 +728,10 @@ def operExp(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.exp(rational_float))
+    elif isArray(v1):
+        return broadcast(np.exp, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operPow(vs):
     '''
@@ -548,6 +741,8 @@ def operPow(vs):
     checkNumberArgs(vs, 2)
     v1 = vs[0]
     v2 = vs[1]
+    if isArray(v1) or isArray(v2):
+        return broadcast(np.power, v1, v2)
     rational_float_v1 = convertFloat(v1)
     rational_float_v2 = convertFloat(v2)
     return VFloat(pow(rational_float_v1, rational_float_v2))
@@ -564,8 +759,10 @@ def operSqrt(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.sqrt(rational_float))
+    elif isArray(v1):
+        return broadcast(np.sqrt, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operCbrt(vs):
     '''
@@ -579,8 +776,10 @@ def operCbrt(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat((rational_float)**(1/3))
+    elif isArray(v1):
+        return broadcast(np.cbrt, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operFloor(vs):
     '''
@@ -594,8 +793,10 @@ def operFloor(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.floor(rational_float))
+    elif isArray(v1):
+        return broadcast(np.floor, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operCeil(vs):
     '''
@@ -609,8 +810,10 @@ def operCeil(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.ceil(rational_float))
+    elif isArray(v1):
+        return broadcast(np.ceil, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operRound(vs):
     '''
@@ -620,8 +823,10 @@ def operRound(vs):
     checkNumberArgs(vs, 2)
     v1 = vs[0] # should be float
     v2 = vs[1] # should be integer
-    rational_float_v1 = convertFloat(v1)
     rational_float_v2 = convertFloat(v2)
+    if isArray(v1) and rational_float_v2.is_integer():
+        return arrayValue(np.round(numericArray(v1), int(rational_float_v2)))
+    rational_float_v1 = convertFloat(v1)
     if rational_float_v2.is_integer():
         return VFloat(round(rational_float_v1, int(rational_float_v2)))
     else:
@@ -634,6 +839,8 @@ def operRint(vs):
     '''
     checkNumberArgs(vs, 1)
     v1 = vs[0]
+    if isArray(v1):
+        return broadcast(np.rint, v1)
     rational_float_v1 = convertFloat(v1)
     return VFloat(int(round(rational_float_v1)))
 
@@ -651,8 +858,10 @@ def operAbs(vs):
         num = abs(v1.getNumerator())
         den = abs(v1.getDenominator())
         return VRational(num, den)
+    elif isArray(v1):
+        return broadcast(np.abs, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operSignum(vs):
     '''
@@ -666,8 +875,10 @@ def operSignum(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.copysign(1, rational_float))
+    elif isArray(v1):
+        return broadcast(lambda x: np.copysign(1.0, x), v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operSin(vs):
     '''
@@ -681,8 +892,10 @@ def operSin(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.sin(rational_float))
+    elif isArray(v1):
+        return broadcast(np.sin, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operCos(vs):
     '''
@@ -696,8 +909,10 @@ def operCos(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.cos(rational_float))
+    elif isArray(v1):
+        return broadcast(np.cos, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operTan(vs):
     '''
@@ -711,8 +926,10 @@ def operTan(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.tan(rational_float))
+    elif isArray(v1):
+        return broadcast(np.tan, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operAsin(vs):
     '''
@@ -726,8 +943,10 @@ def operAsin(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.asin(rational_float))
+    elif isArray(v1):
+        return broadcast(np.arcsin, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operAcos(vs):
     '''
@@ -741,8 +960,10 @@ def operAcos(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.acos(rational_float))
+    elif isArray(v1):
+        return broadcast(np.arccos, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operAtan(vs):
     '''
@@ -756,8 +977,10 @@ def operAtan(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.atan(rational_float))
+    elif isArray(v1):
+        return broadcast(np.arctan, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operSinh(vs):
     '''
@@ -771,8 +994,10 @@ def operSinh(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.sinh(rational_float))
+    elif isArray(v1):
+        return broadcast(np.sinh, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operCosh(vs):
     '''
@@ -786,8 +1011,10 @@ def operCosh(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.cosh(rational_float))
+    elif isArray(v1):
+        return broadcast(np.cosh, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operTanh(vs):
     '''
@@ -801,8 +1028,10 @@ def operTanh(vs):
     elif v1.isRational():
         rational_float = float(v1.getNumerator()/v1.getDenominator())
         return VFloat(math.tanh(rational_float))
+    elif isArray(v1):
+        return broadcast(np.tanh, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operInc(vs):
     '''
@@ -815,8 +1044,10 @@ def operInc(vs):
         return VFloat(v1.getFloat()+1)
     elif v1.isRational():
         return VRational(v1.getNumerator()+v1.getDenominator(), v1.getDenominator()).simplify()
+    elif isArray(v1):
+        return broadcast(lambda x: x + 1, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operDec(vs):
     '''
@@ -829,8 +1060,10 @@ def operDec(vs):
         return VFloat(v1.getFloat()-1)
     elif v1.isRational():
         return VRational(v1.getNumerator()-v1.getDenominator(), v1.getDenominator()).simplify()
+    elif isArray(v1):
+        return broadcast(lambda x: x - 1, v1)
     else:
-        runtimeError("Value " + str(v1) + " is not of type RATIONAL or FLOAT")
+        typeError(v1, "RATIONAL or FLOAT or VECTOR or MATRIX")
 
 def operMod(vs):
     '''
@@ -840,6 +1073,8 @@ def operMod(vs):
     checkNumberArgs(vs, 2)
     v1 = vs[0]
     v2 = vs[1]
+    if isArray(v1) or isArray(v2):
+        return broadcast(np.mod, v1, v2)
     rational_float_v1 = convertFloat(v1)
     rational_float_v2 = convertFloat(v2)
     return VFloat(rational_float_v1 % rational_float_v2)
@@ -851,7 +1086,14 @@ def operSum(vs):
     '''
     checkNumberArgs(vs, 1)
     v1 = vs[0]
+    if v1.isStream():
+        total = 0.0
+        for block in finiteBlocks(v1):
+            total += operSum([block]).getFloat()
+        return VFloat(total)
     checkVector(v1)
+    if v1.getFloats() is not None:
+        return VFloat(v1.getFloats().sum())
     l = v1.getList()
     sum = 0
     for elm in l:
@@ -860,7 +1102,7 @@ def operSum(vs):
         elif elm.isRational():
             sum += float(elm.getNumerator()/ elm.getDenominator())
         else:
-            runtimeError("Value " + str(elm) + " is not of type RATIONAL or FLOAT")
+            typeError(elm, "RATIONAL or FLOAT")
     return VFloat(sum)
 
 def operCumsum(vs):
@@ -872,6 +1114,8 @@ def operCumsum(vs):
     checkNumberArgs(vs, 1)
     v1 = vs[0]
     checkVector(v1)
+    if v1.getFloats() is not None:
+        return VVector.fromFloats(np.cumsum(v1.getFloats()))
     l = v1.getList()
     newl = []
     for elm in l:
@@ -880,7 +1124,7 @@ def operCumsum(vs):
         elif elm.isRational():
             newl.append(float(elm.getNumerator()/ elm.getDenominator()))
         else:
-            runtimeError("Value " + str(elm) + " is not of type RATIONAL or FLOAT")
+            typeError(elm, "RATIONAL or FLOAT")
     cumsum = np.cumsum(newl)
     output = []
     for elm in cumsum:
@@ -894,7 +1138,18 @@ def operMean(vs):
     '''
     checkNumberArgs(vs, 1)
     v1 = vs[0]
+    if v1.isStream():
+        total = 0.0
+        count = 0
+        for block in finiteBlocks(v1):
+            total += operSum([block]).getFloat()
+            count += block.getLength()
+        if count == 0:
+            runtimeError("Cannot take the mean of an empty stream")
+        return VFloat(total / count)
     checkVector(v1)
+    if v1.getFloats() is not None and v1.getLength() > 0:
+        return VFloat(v1.getFloats().mean())
     l = v1.getList()
     floats = []
     for elm in l:
@@ -903,7 +1158,7 @@ def operMean(vs):
         elif elm.isRational():
             floats.append(float(elm.getNumerator()/elm.getDenominator()))
         else:
-            runtimeError("Value " + str(elm) + " is not of type RATIONAL or FLOAT")
+            typeError(elm, "RATIONAL or FLOAT")
     return VFloat(sum(floats)/len(floats))
 
 def operNormalize(vs):
@@ -922,7 +1177,7 @@ def operNormalize(vs):
         elif elm.isRational():
             floats.append(float(elm.getNumerator()/elm.getDenominator()))
         else:
-            runtimeError("Value " + str(elm) + " is not of type RATIONAL or FLOAT")
+            typeError(elm, "RATIONAL or FLOAT")
     norm = [float(i)/sum(floats) for i in floats]
     output = []
     for elm in norm:
@@ -1009,9 +1264,10 @@ def operCount(vs):
     '''
     checkNumberArgs(vs, 1)
     v1 = vs[0]
+    if v1.isStream():
+        return VFloat(sum(block.getLength() for block in finiteBlocks(v1)))
     checkVector(v1)
-    l = v1.getList()
-    return VFloat(len(l))
+    return VFloat(v1.getLength())
 
 def operEmptyP(vs):
     '''
@@ -1022,26 +1278,773 @@ def operEmptyP(vs):
     checkNumberArgs(vs, 1)
     v1 = vs[0]
     checkVector(v1)
-    return VBoolean(len(v1.getList()) < 1)
+    return VBoolean(v1.getLength() < 1)
+
+# Bulk vector operations
+def operRange(vs):
+    '''
+    operRange is a primitive operation that takes one to three numerical
+    arguments, (range end), (range start, end) or (range start, end, step),
+    and returns a vector of the floats from start (0 by default) up to but
+    excluding end, step (1 by default) apart
+    '''
+    if len(vs) < 1 or len(vs) > 3:
+        arityError(len(vs), "1 to 3")
+    bounds = [convertFloat(v) for v in vs]
+    if len(bounds) == 1:
+        bounds = [0.0] + bounds
+    if len(bounds) == 3 and bounds[2] == 0:
+        runtimeError("cannot apply range with a step of 0")
+    return VVector.fromFloats(np.arange(*bounds, dtype=float))
+
+def operRepeat(vs):
+    '''
+    operRepeat is a primitive operation that takes 2 arguments: a count n and
+    a value, and returns a vector containing the value n times
+    '''
+    checkNumberArgs(vs, 2)
+    n = convertCount(vs[0])
+    v2 = vs[1]
+    if v2.isFloat():
+        return VVector.fromFloats(np.full(n, v2.getFloat()))
+    return VVector([v2] * n)
+
+def operReduce(vs):
+    '''
+    operReduce is a primitive operation that takes a procedure of two
+    arguments, an optional initial value and a vector, and folds the procedure
+    over the elements of the vector from left to right, without building any
+    intermediate vector. Without an initial value the first element is used
+    '''
+    if len(vs) == 2:
+        v1, v3 = vs
+        if v3.isStream():
+            return reduceStream(v1, None, v3)
+        checkVector(v3)
+        if v3.getLength() < 1:
+            runtimeError("cannot apply reduce to an empty VECTOR without an initial value")
+        return reduceVector(v1, None, v3)
+    checkNumberArgs(vs, 3)
+    v1, v2, v3 = vs
+    if v3.isStream():
+        return reduceStream(v1, v2, v3)
+    checkVector(v3)
+    return reduceVector(v1, v2, v3)
+
+def operFold(vs):
+    '''
+    operFold is a primitive operation that takes a procedure of two arguments,
+    an initial value and a vector, and folds the procedure over the elements
+    of the vector from left to right
+    '''
+    checkNumberArgs(vs, 3)
+    return operReduce(vs)
+
+def reduceVector(v1, init, v2):
+    '''
+    Folds the procedure v1 over the vector v2 starting from init, or from the
+    first element of v2 if init is None. Adding or multiplying the floats of
+    an array-backed vector is done by numpy in one call
+    '''
+    checkProcedure(v1)
+    floats = v2.getFloats()
+    if floats is not None:
+        if isinstance(v1, VPrimitive) and v1.oper in (operPlus, operTimes) and (init is None or init.isFloat()):
+            total = floats.sum() if v1.oper is operPlus else floats.prod()
+            if init is None:
+                return VFloat(total)
+            return VFloat(init.getFloat() + total if v1.oper is operPlus else init.getFloat() * total)
+        elements = (VFloat(x) for x in floats.tolist())
+    else:
+        elements = iter(v2.getList())
+    acc = next(elements) if init is None else init
+    for elm in elements:
+        acc = v1.apply([acc, elm])
+    return acc
+
+def operZip(vs):
+    '''
+    operZip is a primitive operation that takes one or more vectors and
+    returns a vector of vectors, the ith holding the ith element of each
+    argument. The result is as long as the shortest argument
+    '''
+    if len(vs) < 1:
+        arityError(0, "at least 1")
+    for v in vs:
+        checkVector(v)
+    return VVector([VVector(list(elms)) for elms in zip(*[v.getList() for v in vs])])
+
+def operTake(vs):
+    '''
+    operTake is a primitive operation that takes 2 arguments: a count n and a
+    vector, and returns a vector of the first n elements of the vector
+    '''
+    checkNumberArgs(vs, 2)
+    n = convertCount(vs[0])
+    v2 = vs[1]
+    if v2.isStream():
+        return takeStream(n, v2)
+    checkVector(v2)
+    if v2.getFloats() is not None:
+        return VVector.fromFloats(v2.getFloats()[:n])
+    return VVector(v2.getList()[:n])
+
+def operDrop(vs):
+    '''
+    operDrop is a primitive operation that takes 2 arguments: a count n and a
+    vector, and returns a vector of all but the first n elements of the vector
+    '''
+    checkNumberArgs(vs, 2)
+    n = convertCount(vs[0])
+    v2 = vs[1]
+    if v2.isStream():
+        return dropStream(n, v2)
+    checkVector(v2)
+    if v2.getFloats() is not None:
+        return VVector.fromFloats(v2.getFloats()[n:])
+    return VVector(v2.getList()[n:])
+
+# Sample streams
+def operSamples(vs):
+    '''
+    operSamples is a primitive operation that takes a distribution and
+    returns the unbounded stream of its samples. Samples are drawn in blocks
+    that grow from 64 up to blockSize as the stream is consumed
+    '''
+    checkNumberArgs(vs, 1)
+    v1 = vs[0]
+    checkDistribution(v1)
+    def blocks():
+        size = 64
+        while True:
+            if v1.family in blockSamplers and choiceHandler.current is None:
+                yield VVector.fromFloats(blockSamplers[v1.family](getRandom(), v1.familyArgs, size))
+            else:
+                yield VVector([operSample([v1]) for i in range(size)])
+            size = min(2 * size, blockSize)
+    return VStream(blocks)
+
+def finiteBlocks(v):
+    '''
+    Returns an iterator over the blocks of the stream v, which has to be finite
+    '''
+    if not v.finite:
+        runtimeError("cannot consume all of an unbounded STREAM, use take first")
+    return v.getBlocks()
+
+def takeStream(n, v):
+    '''
+    Returns the finite stream of the first n elements of the stream v
+    '''
+    def blocks():
+        left = n
+        if left == 0:
+            return
+        for block in v.getBlocks():
+            if block.getLength() >= left:
+                yield operTake([VFloat(left), block])
+                return
+            left -= block.getLength()
+            yield block
+    return VStream(blocks, True)
+
+def dropStream(n, v):
+    '''
+    Returns the stream of all but the first n elements of the stream v
+    '''
+    def blocks():
+        left = n
+        for block in v.getBlocks():
+            if left >= block.getLength():
+                left -= block.getLength()
+                continue
+            if left > 0:
+                block = operDrop([VFloat(left), block])
+                left = 0
+            yield block
+    return VStream(blocks, v.finite)
+
+def reduceStream(v1, init, v2):
+    '''
+    Folds the procedure v1 over the finite stream v2 block by block, starting
+    from init or, if init is None, from the first element of the stream
+    '''
+    acc = init
+    for block in finiteBlocks(v2):
+        if block.getLength() > 0:
+            acc = reduceVector(v1, acc, block)
+    if acc is None:
+        runtimeError("cannot apply reduce to an empty STREAM without an initial value")
+    return acc
+
+def operCollect(vs):
+    '''
+    operCollect is a primitive operation that takes a finite stream and
+    returns a vector of its elements
+    '''
+    checkNumberArgs(vs, 1)
+    v1 = vs[0]
+    if not v1.isStream():
+        typeError(v1, "STREAM")
+    blocks = list(finiteBlocks(v1))
+    if blocks and all(block.getFloats() is not None for block in blocks):
+        return VVector.fromFloats(np.concatenate([block.getFloats() for block in blocks]))
+    return VVector([elm for block in blocks for elm in block.getList()])
+
+# Streaming statistics
+def checkAccumulator(v):
+    '''
+    Throws an error if v is not a VAccumulator
+    '''
+    if not v.isAccumulator():
+        typeError(v, "ACCUMULATOR")
+
+def operMoments(vs):
+    '''
+    operMoments is a primitive operation that takes no arguments and returns
+    an accumulator of the count, mean, variance, minimum and maximum of the
+    samples added to it
+    '''
+    checkNumberArgs(vs, 0)
+    return VAccumulator(stats.Moments())
+
+def operHistogram(vs):
+    '''
+    operHistogram is a primitive operation that takes 3 arguments: the start
+    and end of a range and a number of bins, and returns an accumulator
+    counting the samples added to it in equally spaced bins over the range
+    '''
+    checkNumberArgs(vs, 3)
+    lo = convertFloat(vs[0])
+    hi = convertFloat(vs[1])
+    bins = convertCount(vs[2])
+    if bins < 1:
+        runtimeError("cannot make a histogram with 0 bins")
+    return VAccumulator(stats.Histogram(lo, hi, bins))
+
+def operQuantileSketch(vs):
+    '''
+    operQuantileSketch is a primitive operation that takes an optional
+    capacity (256 by default) and returns an accumulator estimating the
+    quantiles of the samples added to it in bounded memory
+    '''
+    if len(vs) > 1:
+        arityError(len(vs), "0 or 1")
+    capacity = convertCount(vs[0]) if vs else 256
+    if capacity < 2:
+        runtimeError("cannot make a quantile sketch with a capacity below 2")
+    return VAccumulator(stats.QuantileSketch(capacity, getRandom()))
+
+def operReservoir(vs):
+    '''
+    operReservoir is a primitive operation that takes a size k and returns an
+    accumulator keeping a uniform random subsample of k of the samples added
+    to it
+    '''
+    checkNumberArgs(vs, 1)
+    return VAccumulator(stats.Reservoir(convertCount(vs[0]), getRandom()))
+
+def operAccumulate(vs):
+    '''
+    operAccumulate is a primitive operation that takes 2 arguments: an
+    accumulator and a number or vector of numbers, adds the number(s) to the
+    accumulator and returns it
+    '''
+    checkNumberArgs(vs, 2)
+    v1 = vs[0]
+    v2 = vs[1]
+    checkAccumulator(v1)
+    if v2.isStream():
+        for block in finiteBlocks(v2):
+            operAccumulate([v1, block])
+    elif v2.isVector():
+        floats = v2.getFloats()
+        if floats is None:
+            floats = np.array([convertFloat(elm) for elm in v2.getList()])
+        v1.getAccumulator().addMany(floats)
+    else:
+        v1.getAccumulator().add(convertFloat(v2))
+    return v1
+
+def operAccumulateSamples(vs):
+    '''
+    operAccumulateSamples is a primitive operation that takes 3 arguments: an
+    accumulator, a distribution and a number of samples n, adds n samples of
+    the distribution to the accumulator block by block and returns it
+    '''
+    checkNumberArgs(vs, 3)
+    v1 = vs[0]
+    v2 = vs[1]
+    checkAccumulator(v1)
+    checkDistribution(v2)
+    acc = v1.getAccumulator()
+    for block in sampleBlocks(v2, convertCount(vs[2])):
+        acc.addMany(block)
+    return v1
+
+def operSummary(vs):
+    '''
+    operSummary is a primitive operation that takes an accumulator and
+    returns what it has gathered: the vector (count, mean, variance, min, max)
+    for moments, the vector of bin counts for a histogram, the vector of kept
+    samples for a reservoir and the median for a quantile sketch
+    '''
+    checkNumberArgs(vs, 1)
+    v1 = vs[0]
+    checkAccumulator(v1)
+    acc = v1.getAccumulator()
+    if isinstance(acc, stats.Moments):
+        return VVector.fromFloats(np.array([acc.count, acc.mean, acc.variance(), acc.min, acc.max], dtype=float))
+    elif isinstance(acc, stats.Histogram):
+        return VVector.fromFloats(acc.counts.astype(float))
+    elif isinstance(acc, stats.Reservoir):
+        return VVector.fromFloats(acc.sample())
+    return VFloat(acc.quantile(0.5))
+
+def operQuantile(vs):
+    '''
+    operQuantile is a primitive operation that takes 2 arguments: a quantile
+    sketch or a vector of numbers, and a probability p, and returns the
+    p-quantile of the sketch (estimated) or of the vector (exact)
+    '''
+    checkNumberArgs(vs, 2)
+    v1 = vs[0]
+    p = convertFloat(vs[1])
+    if p < 0 or p > 1:
+        runtimeError("Value " + str(vs[1]) + " is not a probability")
+    if v1.isVector():
+        floats = v1.getFloats()
+        if floats is None:
+            floats = np.array([convertFloat(elm) for elm in v1.getList()])
+        if len(floats) == 0:
+            runtimeError("cannot apply quantile to an empty VECTOR")
+        return VFloat(np.quantile(floats, p))
+    checkAccumulator(v1)
+    acc = v1.getAccumulator()
+    if not isinstance(acc, stats.QuantileSketch):
+        typeError(v1, "quantile sketch ACCUMULATOR")
+    return VFloat(acc.quantile(p))
+
+# Hash-based vector operations
+def numericFloats(v):
+    '''
+    Returns the numpy array of the floats of the vector v, or None if v holds
+    anything but floats
+    '''
+    floats = v.getFloats()
+    if floats is None:
+        l = v.getList()
+        if not l or not all(elm.isFloat() for elm in l):
+            return None
+        floats = np.array([elm.getFloat() for elm in l])
+    return floats
+
+def uniqueFloats(floats):
+    '''
+    Returns the distinct values of the numpy array floats in the order they
+    first appear, along with the number of times each appears
+    '''
+    values, first, counts = np.unique(floats, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    return values[order], counts[order]
+
+def operFrequencies(vs):
+    '''
+    operFrequencies is a primitive operation that takes 1 vector argument and
+    returns a vector of (value, count) pairs, one for each distinct element
+    of the vector in the order they first appear
+    '''
+    checkNumberArgs(vs, 1)
+    v1 = vs[0]
+    checkVector(v1)
+    floats = numericFloats(v1)
+    if floats is not None:
+        values, counts = uniqueFloats(floats)
+        return VVector([VVector([VFloat(x), VFloat(n)]) for x, n in zip(values.tolist(), counts.tolist())])
+    counts = {}
+    for elm in v1.getList():
+        counts[elm] = counts.get(elm, 0) + 1
+    return VVector([VVector([elm, VFloat(n)]) for elm, n in counts.items()])
+
+def operUnique(vs):
+    '''
+    operUnique is a primitive operation that takes 1 vector argument and
+    returns a vector of its distinct elements in the order they first appear
+    '''
+    checkNumberArgs(vs, 1)
+    v1 = vs[0]
+    checkVector(v1)
+    floats = numericFloats(v1)
+    if floats is not None:
+        return VVector.fromFloats(uniqueFloats(floats)[0])
+    return VVector(list(dict.fromkeys(v1.getList())))
+
+def operGroupBy(vs):
+    '''
+    operGroupBy is a primitive operation that takes 2 arguments: a procedure
+    and a vector, and returns a vector of (key, elements) pairs grouping the
+    elements of the vector by the value of the procedure on them, with the
+    keys in the order they first appear
+    '''
+    checkNumberArgs(vs, 2)
+    v1 = vs[0]
+    checkProcedure(v1)
+    v2 = vs[1]
+    checkVector(v2)
+    groups = {}
+    keys = applyVectorized(v1, v2)
+    if keys is not None:
+        keys = [VFloat(k) if keys.dtype != bool else VBoolean(k) for k in keys.tolist()]
+    else:
+        keys = [v1.apply([elm]) for elm in v2.getList()]
+    for key, elm in zip(keys, v2.getList()):
+        if key in groups:
+            groups[key].append(elm)
+        else:
+            groups[key] = [elm]
+    return VVector([VVector([key, VVector(elms)]) for key, elms in groups.items()])
+
+def sampleDistribution(v1, args):
+    '''
+    Draws a value from the VDistribution v1 by calling its apply method with
+    args and returning its result
+    '''
+    result = v1.apply(args)
+    if result.isProcedure(): # it is a VPrimitive and probably a lambda function
+        return result.apply([])
+    else:
+        return result
 
 def operSample(vs):
     '''
     operSample samples a VDistribution by calling its apply method and
     returning its result. It can take in any number of arguments depending
     on how many arguments the VDistribution requires, but the first arg
-    needs to be a VDistribution
+    needs to be a VDistribution. During inference the draw is handed to the
+    current ChoiceHandler instead
     '''
     if len(vs) > 0:
         v1 = vs[0]
         checkDistribution(v1)
-        result = v1.apply(vs[1:])
-        if result.isProcedure(): # it is a VPrimitive and probably a lambda function
-            return result.apply([])
-        else:
-            return result
+        handler = choiceHandler.current
+        if handler is not None:
+            return handler.sample(v1, vs[1:])
+        return sampleDistribution(v1, vs[1:])
     else:
         runtimeError("0 arguments applied to sample")
 
+def operObserve(vs):
+    '''
+    operObserve is a primitive operation that takes a VDistribution and a value
+    and conditions the program on the value having been drawn from the
+    distribution. Outside of an inference engine it only checks its arguments
+    '''
+    checkNumberArgs(vs, 2)
+    v1 = vs[0]
+    v2 = vs[1]
+    checkDistribution(v1)
+    handler = choiceHandler.current
+    if handler is not None:
+        handler.observe(v1, v2)
+    return VBoolean(True)
+
+def logProbNormal(args, x):
+    '''
+    Returns the log probability of x under a normal distribution with parameters args
+    '''
+    mu, sigma = args
+    z = (convertFloat(x) - mu) / sigma
+    return -0.5*z*z - math.log(sigma) - 0.5*math.log(2*math.pi)
+
+def logProbPoisson(args, x):
+    '''
+    Returns the log probability of x under a poisson distribution with parameters args
+    '''
+    k = convertFloat(x)
+    if k < 0 or not k.is_integer():
+        return -math.inf
+    return k*math.log(args[0]) - args[0] - math.lgamma(k+1)
+
+def logProbExponential(args, x):
+    '''
+    Returns the log probability of x under an exponential distribution with parameters args
+    '''
+    t = convertFloat(x)
+    if t < 0:
+        return -math.inf
+    return -math.log(args[0]) - t/args[0]
+
+def logProbBeta(args, x):
+    '''
+    Returns the log probability of x under a beta distribution with parameters args
+    '''
+    a, b = args
+    t = convertFloat(x)
+    if t <= 0 or t >= 1:
+        return -math.inf
+    return (a-1)*math.log(t) + (b-1)*math.log(1-t) + math.lgamma(a+b) - math.lgamma(a) - math.lgamma(b)
+
+def logProbUniform(args, x):
+    '''
+    Returns the log probability of x under a continuous uniform distribution with parameters args
+    '''
+    start, end = args
+    t = convertFloat(x)
+    if t < start or t >= end:
+        return -math.inf
+    return -math.log(end - start)
+
+def logProbRandelm(args, x):
+    '''
+    Returns the log probability of x under a randelm distribution with parameters args
+    '''
+    elms = args[0]
+    hits = len([elm for elm in elms if elm == x])
+    if hits == 0:
+        return -math.inf
+    return math.log(hits / len(elms))
+
+def logProbBinomial(args, x):
+    '''
+    Returns the log probability of x under a binomial distribution with parameters args
+    '''
+    n, p = args
+    k = convertFloat(x)
+    if k < 0 or k > n or not k.is_integer():
+        return -math.inf
+    if p == 0 or p == 1:
+        return 0.0 if k == n*p else -math.inf
+    return math.lgamma(n+1) - math.lgamma(k+1) - math.lgamma(n-k+1) + k*math.log(p) + (n-k)*math.log(1-p)
+
+def logProbBernoulli(args, x):
+    '''
+    Returns the log probability of x under a bernoulli distribution with parameters args
+    '''
+    return logProbBinomial([1, args[0]], x)
+
+def logProbCategorical(args, x):
+    '''
+    Returns the log probability of x under a categorical distribution with parameters args
+    '''
+    elms, probs = args
+    p = sum([prob for elm, prob in zip(elms, probs) if elm == x])
+    if p == 0:
+        return -math.inf
+    return math.log(p)
+
+def logProbMvnormal(args, x):
+    '''
+    Returns the log density of the vector x under a multivariate normal
+    distribution with parameters args, whose cholesky factor was computed
+    when the distribution was built
+    '''
+    mean, cov, factor = args
+    if not x.isVector() or x.getLength() != len(mean):
+        return -math.inf
+    z = np.linalg.solve(factor, numericArray(x) - mean)
+    return float(-0.5 * (z @ z) - np.log(np.diag(factor)).sum() - 0.5 * len(mean) * math.log(2 * math.pi))
+
+# Log densities (or log masses) of the primitive distribution families
+logDensities = {
+    "normal": logProbNormal,
+    "poisson": logProbPoisson,
+    "exponential": logProbExponential,
+    "beta": logProbBeta,
+    "uniform": logProbUniform,
+    "randelm": logProbRandelm,
+    "bernoulli": logProbBernoulli,
+    "binomial": logProbBinomial,
+    "categorical": logProbCategorical,
+    "mvnormal": logProbMvnormal,
+}
+
+def distLogProb(v, x):
+    '''
+    Returns the log density of value x under the VDistribution v, or None if
+    v is not a primitive distribution with a known density
+    '''
+    if v.family not in logDensities:
+        return None
+    if not (x.isFloat() or x.isRational() or v.family in ("randelm", "mvnormal")):
+        return -math.inf
+    return logDensities[v.family](v.familyArgs, x)
+
+def getRandom():
+    '''
+    Returns the random number generator that sampling should draw from: the
+    one of the current thread's randomSource, or numpy's global one
+    '''
+    r = randomSource.current
+    if r is None:
+        return np.random
+    return r.randomState()
+
+# Draw a block of n samples of a primitive distribution family as a numpy
+# array of floats, given the random number generator and the parameters
+blockSamplers = {
+    "normal": lambda random, args, n: random.normal(args[0], args[1], n),
+    "poisson": lambda random, args, n: random.poisson(args[0], n).astype(float),
+    "exponential": lambda random, args, n: random.exponential(args[0], n),
+    "beta": lambda random, args, n: random.beta(args[0], args[1], n),
+    "uniform": lambda random, args, n: random.uniform(args[0], args[1], n),
+    "bernoulli": lambda random, args, n: random.binomial(1, args[0], n).astype(float),
+    "binomial": lambda random, args, n: random.binomial(args[0], args[1], n).astype(float),
+}
+
+# The number of samples drawn at once when streaming a distribution
+blockSize = 65536
+
+def sampleBlocks(v1, n):
+    '''
+    Yields n samples of the distribution v1 as numpy arrays of at most
+    blockSize floats, so that they never all have to be held at once.
+    Primitive families are drawn a whole block at a time by numpy; other
+    distributions, or any distribution while an inference engine is running,
+    are sampled one draw at a time
+    '''
+    sampler = blockSamplers.get(v1.family)
+    for start in range(0, n, blockSize):
+        size = min(blockSize, n - start)
+        if sampler is not None and choiceHandler.current is None:
+            yield sampler(getRandom(), v1.familyArgs, size)
+        else:
+            yield np.array([convertFloat(operSample([v1])) for i in range(size)])
+
+# Primitive distributions already built, by (family, parameters), least
+# recently used first. Distributions are never mutated, so a loop sampling
+# (bernoulli p) with an unchanging p keeps getting the same object
+distributionCache = OrderedDict()
+distributionCacheSize = 1024
+distributionCacheLock = threading.Lock()
+
+def cachedDistribution(family, args):
+    '''
+    Returns the cached distribution of family with the python number
+    parameters args, or None if it has not been built recently
+    '''
+    key = (family,) + args
+    dist = distributionCache.get(key)
+    if dist is not None:
+        try:
+            distributionCache.move_to_end(key)
+        except KeyError:
+            # another thread evicted it in between, it is still a valid result
+            pass
+    return dist
+
+def mkDistribution(family, args, python_func):
+    '''
+    Wraps a python sampling function as a primitive VDistribution that
+    remembers its family name and (python float) parameters. Distributions
+    whose parameters are all numbers are cached for cachedDistribution
+    '''
+    dist = VDistribution("", [], EPrimitive(python_func, family, list(args)), Env(), family, list(args))
+    if all(isinstance(arg, (int, float)) for arg in args):
+        with distributionCacheLock:
+            distributionCache[(family,) + tuple(args)] = dist
+            if len(distributionCache) > distributionCacheSize:
+                distributionCache.popitem(last=False)
+    return dist
+
+def makeNormal(mu, sigma):
+    '''
+    Returns a normal distribution with mean mu and standard deviation sigma
+    '''
+    dist = cachedDistribution("normal", (mu, sigma))
+    if dist is not None:
+        return dist
+    python_func = lambda x : VFloat(getRandom().normal(mu, sigma))
+    return mkDistribution("normal", [mu, sigma], python_func)
+
+def makePoisson(lam):
+    '''
+    Returns a poisson distribution with rate lam
+    '''
+    dist = cachedDistribution("poisson", (lam,))
+    if dist is not None:
+        return dist
+    python_func = lambda x : VFloat(getRandom().poisson(lam))
+    return mkDistribution("poisson", [lam], python_func)
+
+def makeExponential(scale):
+    '''
+    Returns an exponential distribution with the given scale (1 / rate)
+    '''
+    dist = cachedDistribution("exponential", (scale,))
+    if dist is not None:
+        return dist
+    python_func = lambda x: VFloat(getRandom().exponential(scale))
+    return mkDistribution("exponential", [scale], python_func)
+
+def makeBeta(a, b):
+    '''
+    Returns a beta distribution with shape parameters a and b
+    '''
+    dist = cachedDistribution("beta", (a, b))
+    if dist is not None:
+        return dist
+    python_func = lambda x : VFloat(getRandom().beta(a, b))
+    return mkDistribution("beta", [a, b], python_func)
+
+def makeUniform(start, end):
+    '''
+    Returns a continuous uniform distribution over [start, end)
+    '''
+    dist = cachedDistribution("uniform", (start, end))
+    if dist is not None:
+        return dist
+    python_func = lambda x: VFloat(getRandom().uniform(start, end))
+    return mkDistribution("uniform", [start, end], python_func)
+
+def makeRandelm(elms):
+    '''
+    Returns a distribution picking an element of the python list elms uniformly
+    '''
+    python_func = lambda x: elms[getRandom().randint(0, len(elms))]
+    return mkDistribution("randelm", [elms], python_func)
+
+def makeBernoulli(p):
+    '''
+    Returns a bernoulli distribution with probability of success p
+    '''
+    dist = cachedDistribution("bernoulli", (p,))
+    if dist is not None:
+        return dist
+    python_func = lambda x: VFloat(getRandom().binomial(1, p))
+    return mkDistribution("bernoulli", [p], python_func)
+
+def makeBinomial(n, p):
+    '''
+    Returns a binomial distribution counting the successes of n bernoulli trials
+    '''
+    dist = cachedDistribution("binomial", (n, p))
+    if dist is not None:
+        return dist
+    python_func = lambda x: VFloat(getRandom().binomial(n, p))
+    return mkDistribution("binomial", [n, p], python_func)
+
+def makeCategorical(elms, probs):
+    '''
+    Returns a distribution picking the ith element of the python list elms
+    with the ith probability of the python list probs
+    '''
+    cumulative = [sum(probs[:i + 1]) for i in range(len(probs))]
+    python_func = lambda x: elms[min(bisect.bisect_right(cumulative, getRandom().uniform() * cumulative[-1]), len(elms) - 1)]
+    return mkDistribution("categorical", [elms, probs], python_func)
+
+def makeMvnormal(mean, cov, factor=None):
+    '''
+    Returns a multivariate normal distribution over vectors with mean the
+    python list (or numpy array) mean and covariance matrix cov. The cholesky
+    factor of cov is computed unless it is given, and kept in the parameters
+    for the log density. The parameters are numpy arrays
+    '''
+    mean = np.asarray(mean, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    factor = choleskyFactor(cov) if factor is None else np.asarray(factor, dtype=float)
+    python_func = lambda x: VVector.fromFloats(mean + factor @ getRandom().standard_normal(len(mean)))
+    return mkDistribution("mvnormal", [mean, cov, factor], python_func)
+
 def operNormal(vs):
     '''
     operNormal is a primitive operation that takes two float arguments
@@ -1054,8 +2057,22 @@ def operNormal(vs):
     v2 = vs[1]
     rational_float_v1 = convertFloat(v1)
     rational_float_v2 = convertFloat(v2)
-    python_func = lambda x : VFloat(np.random.normal(rational_float_v1, rational_float_v2))
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makeNormal(rational_float_v1, rational_float_v2)
+
+def operMvnormal(vs):
+    '''
+    operMvnormal is a primitive operation that takes a numeric vector of
+    means and a covariance matrix and returns a VDistribution over vectors.
+    Samples are drawn with the cholesky factor of the covariance, which is
+    computed once when the distribution is built
+    '''
+    checkNumberArgs(vs, 2)
+    mean = vectorArray(vs[0])
+    checkMatrix(vs[1])
+    cov = vs[1].getMatrix()
+    if cov.shape != (len(mean), len(mean)):
+        runtimeError("Cannot use a covariance matrix of shape " + str(cov.shape) + " with " + str(len(mean)) + " means")
+    return makeMvnormal(mean, cov)
 
 def operPoisson(vs):
     '''
@@ -1067,8 +2084,7 @@ def operPoisson(vs):
     checkNumberArgs(vs, 1)
     v1 = vs[0]
     rational_float_v1 = convertFloat(v1)
-    python_func = lambda x : VFloat(np.random.poisson(rational_float_v1))
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makePoisson(rational_float_v1)
 
 def operExponential(vs):
     '''
@@ -1080,8 +2096,7 @@ def operExponential(vs):
     checkNumberArgs(vs, 1)
     v1 = vs[0]
     rational_float_v1 = convertFloat(v1)
-    python_func = lambda x: VFloat(np.random.exponential(rational_float_v1))
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makeExponential(rational_float_v1)
 
 def operBeta(vs):
     '''
@@ -1095,8 +2110,7 @@ def operBeta(vs):
     v2 = vs[1]
     rational_float_v1 = convertFloat(v1)
     rational_float_v2 = convertFloat(v2)
-    python_func = lambda x : VFloat(np.random.beta(rational_float_v1, rational_float_v2))
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makeBeta(rational_float_v1, rational_float_v2)
 
 def operUniformContinuous(vs):
     '''
@@ -1112,8 +2126,7 @@ def operUniformContinuous(vs):
     v2 = vs[1]
     rational_float_v1 = convertFloat(v1)
     rational_float_v2 = convertFloat(v2)
-    python_func = lambda x: VFloat(np.random.uniform(rational_float_v1, rational_float_v2))
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makeUniform(rational_float_v1, rational_float_v2)
 
 def operUniformDiscrete(vs):
     '''
@@ -1125,9 +2138,7 @@ def operUniformDiscrete(vs):
     checkNumberArgs(vs, 1)
     v1 = vs[0]
     checkVector(v1)
-    elms = v1.getList()
-    python_func = lambda x: elms[np.random.randint(0, len(elms))]
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makeRandelm(v1.getList())
 
 def operBernoulli(vs):
     '''
@@ -1139,8 +2150,43 @@ def operBernoulli(vs):
     checkNumberArgs(vs, 1)
     v1 = vs[0]
     rational_float_v1 = convertFloat(v1)
-    python_func = lambda x: VFloat(np.random.binomial(1, rational_float_v1))
-    return VDistribution("", [], EPrimitive(python_func), Env())
+    return makeBernoulli(rational_float_v1)
+
+def operCategorical(vs):
+    '''
+    operCategorical is a primitive operation that takes two vectors of the
+    same length, values and their probabilities, and returns a VDistribution
+    picking each value with its probability (the probabilities are normalized)
+    '''
+    checkNumberArgs(vs, 2)
+    v1 = vs[0]
+    v2 = vs[1]
+    checkVector(v1)
+    checkVector(v2)
+    elms = v1.getList()
+    probs = [convertFloat(v) for v in v2.getList()]
+    if len(elms) != len(probs) or len(elms) == 0:
+        runtimeError("categorical needs as many probabilities as values, and at least one value")
+    if any(p < 0 for p in probs) or sum(probs) <= 0:
+        runtimeError("Value " + describeValue(v2) + " does not hold valid probabilities")
+    total = sum(probs)
+    return makeCategorical(elms, [p / total for p in probs])
+
+def operBinomial(vs):
+    '''
+    operBinomial is a primitive operation that takes two arguments, a number of
+    trials n and a probability of success p, and returns a VDistribution.
+    The body is a EPrimitive, which is a wrapper for a python lambda function
+    that calls Numpy's random.binomial function
+    '''
+    checkNumberArgs(vs, 2)
+    v1 = vs[0]
+    v2 = vs[1]
+    rational_float_v1 = convertFloat(v1)
+    rational_float_v2 = convertFloat(v2)
+    if not rational_float_v1.is_integer():
+        runtimeError("Value " + str(v1) + " is not a integer")
+    return makeBinomial(int(rational_float_v1), rational_float_v2)
 
 def operVector(vs):
     '''
@@ -1159,7 +2205,14 @@ def operMap(vs):
     v1 = vs[0]
     checkProcedure(v1)
     v2 = vs[1]
+    if v2.isStream():
+        return VStream(lambda: (operMap([v1, block]) for block in v2.getBlocks()), v2.finite)
     checkVector(v2)
+    result = applyVectorized(v1, v2)
+    if result is not None:
+        if result.dtype == bool:
+            return VVector([VBoolean(b) for b in result.tolist()])
+        return VVector.fromFloats(result)
     vec2 = []
     for elm in v2.getList():
         vec2.append(v1.apply([elm]))
@@ -1175,15 +2228,287 @@ def operFilter(vs):
     v1 = vs[0]
     checkProcedure(v1)
     v2 = vs[1]
+    if v2.isStream():
+        return VStream(lambda: (operFilter([v1, block]) for block in v2.getBlocks()), v2.finite)
     checkVector(v2)
+    mask = applyVectorized(v1, v2)
+    if mask is not None and mask.dtype == bool:
+        if v2.getFloats() is not None:
+            return VVector.fromFloats(v2.getFloats()[mask])
+        return VVector([elm for elm, keep in zip(v2.getList(), mask.tolist()) if keep])
     vec2 = []
     for elm in v2.getList():
         if v1.apply([elm]).getBoolean():
             vec2.append(elm)
     return VVector(vec2)
 
-# Define the initial environment as a list of primitive operations
-initEnv = Env([
+# Matrices and linear algebra
+def vectorArray(v):
+    '''
+    Returns the numpy array of the numeric vector v, or throws an error
+    '''
+    checkVector(v)
+    return numericArray(v)
+
+def linearArray(v):
+    '''
+    Returns the numpy array of the matrix or numeric vector v, or throws an error
+    '''
+    if v.isMatrix():
+        return v.getMatrix()
+    return vectorArray(v)
+
+def choleskyFactor(a):
+    '''
+    Returns the lower triangular factor L of the numpy matrix a = L L^T, or
+    throws an error if a is not symmetric positive definite
+    '''
+    if a.ndim != 2 or a.shape[0] != a.shape[1]:
+        runtimeError("Cannot factor a matrix of shape " + str(a.shape) + ", it is not square")
+    if not np.allclose(a, a.T):
+        # numpy would only read the lower triangle
+        runtimeError("Cannot factor a matrix that is not symmetric")
+    try:
+        return np.linalg.cholesky(a)
+    except np.linalg.LinAlgError:
+        runtimeError("Cannot factor a matrix that is not positive definite")
+
+def operMatrix(vs):
+    '''
+    operMatrix is a primitive operation that takes a vector of rows, each a
+    vector of numbers of the same length, and returns a VMatrix, or takes a
+    vector of numbers and a number of rows and of columns and fills a VMatrix
+    row by row
+    e.g. (matrix (vector (vector 1, 2), (vector 3, 4))) and
+    (matrix (vector 1, 2, 3, 4), 2, 2) evaluate to ((1, 2), (3, 4))
+    '''
+    if len(vs) == 3:
+        elms = vectorArray(vs[0])
+        rows = convertCount(vs[1])
+        cols = convertCount(vs[2])
+        if len(elms) != rows * cols:
+            runtimeError("Cannot fill a " + str(rows) + "x" + str(cols) + " matrix with " + str(len(elms)) + " elements")
+        return VMatrix(elms.reshape(rows, cols).copy())
+    checkNumberArgs(vs, 1)
+    v1 = vs[0]
+    checkVector(v1)
+    rows = [vectorArray(row) for row in v1.getList()]
+    if len(rows) == 0 or any(len(row) != len(rows[0]) for row in rows):
+        runtimeError("A matrix needs at least one row and rows of the same length")
+    return VMatrix(np.array(rows, dtype=float))
+
+def operIdentity(vs):
+    '''
+    operIdentity is a primitive operation that takes a number n and returns
+    the n by n identity VMatrix
+    '''
+    checkNumberArgs(vs, 1)
+    return VMatrix(np.eye(convertCount(vs[0])))
+
+def operDot(vs):
+    '''
+    operDot is a primitive operation that takes two numeric vectors of the
+    same length and returns their dot product
+    e.g. (dot (vector 1, 2), (vector 3, 4)) evaluates to 11
+    '''
+    checkNumberArgs(vs, 2)
+    x = vectorArray(vs[0])
+    y = vectorArray(vs[1])
+    if len(x) != len(y):
+        runtimeError("Cannot take the dot product of vectors of lengths " + str(len(x)) + " and " + str(len(y)))
+    return VFloat(float(np.dot(x, y)))
+
+def operMatmul(vs):
+    '''
+    operMatmul is a primitive operation that takes two matrices, or a matrix
+    and a numeric vector, and returns their product: a VMatrix, or a VVector
+    when one of them is a vector
+    '''
+    checkNumberArgs(vs, 2)
+    a = linearArray(vs[0])
+    b = linearArray(vs[1])
+    if a.shape[-1] != b.shape[0]:
+        runtimeError("Cannot multiply arrays of shapes " + str(a.shape) + " and " + str(b.shape))
+    return arrayValue(a @ b)
+
+def operTranspose(vs):
+    '''
+    operTranspose is a primitive operation that takes a matrix and returns
+    its transpose
+    '''
+    checkNumberArgs(vs, 1)
+    checkMatrix(vs[0])
+    return VMatrix(vs[0].getMatrix().T)
+
+def operSolve(vs):
+    '''
+    operSolve is a primitive operation that takes a square matrix a and a
+    vector or matrix b and returns the x such that (matmul a, x) is b
+    '''
+    checkNumberArgs(vs, 2)
+    checkMatrix(vs[0])
+    a = vs[0].getMatrix()
+    b = linearArray(vs[1])
+    if a.shape[0] != a.shape[1] or a.shape[0] != b.shape[0]:
+        runtimeError("Cannot solve a system of shapes " + str(a.shape) + " and " + str(b.shape))
+    try:
+        return arrayValue(np.linalg.solve(a, b))
+    except np.linalg.LinAlgError:
+        runtimeError("Cannot solve a system whose matrix is singular")
+
+def operCholesky(vs):
+    '''
+    operCholesky is a primitive operation that takes a symmetric positive
+    definite matrix a and returns the lower triangular matrix l such that
+    (matmul l, (transpose l)) is a
+    '''
+    checkNumberArgs(vs, 1)
+    checkMatrix(vs[0])
+    return VMatrix(choleskyFactor(vs[0].getMatrix()))
+
+# Vectorized procedures
+class CannotVectorize(Exception):
+    '''
+    CannotVectorize is raised while building or running the numpy form of a
+    procedure that has to be applied element by element instead
+    '''
+    def __str__(self):
+        return "CannotVectorize has been raised"
+
+# The primitive operations a vectorized procedure may call, with the numpy
+# operation computing the same thing on whole arrays of floats
+vectorizedPrimitives = {
+    operMinus: lambda a: -a,
+    operPlus: lambda a, b: a + b,
+    operTimes: lambda a, b: a * b,
+    operDiv: lambda a, b: a / b,
+    operMod: lambda a, b: np.mod(a, b),
+    operPow: lambda a, b: np.power(a, b),
+    operInc: lambda a: a + 1,
+    operDec: lambda a: a - 1,
+    operEqual: lambda a, b: np.abs(a - b) <= 1e-09 * np.maximum(np.abs(a), np.abs(b)),
+    operNotEqual: lambda a, b: np.abs(a - b) > 1e-09 * np.maximum(np.abs(a), np.abs(b)),
+    operLess: lambda a, b: a < b,
+    operGreater: lambda a, b: a > b,
+    operLessEq: lambda a, b: a <= b,
+    operGreaterEq: lambda a, b: a >= b,
+    operLog: lambda a: np.log(a),
+    operLog10: lambda a: np.log10(a),
+    operExp: lambda a: np.exp(a),
+    operSqrt: lambda a: np.sqrt(a),
+    operFloor: lambda a: np.floor(a),
+    operCeil: lambda a: np.ceil(a),
+    operRint: lambda a: np.rint(a),
+    operAbs: lambda a: np.abs(a),
+    operSignum: lambda a: np.copysign(1.0, a),
+    operSin: lambda a: np.sin(a),
+    operCos: lambda a: np.cos(a),
+    operTan: lambda a: np.tan(a),
+    operAsin: lambda a: np.arcsin(a),
+    operAcos: lambda a: np.arccos(a),
+    operAtan: lambda a: np.arctan(a),
+    operSinh: lambda a: np.sinh(a),
+    operCosh: lambda a: np.cosh(a),
+    operTanh: lambda a: np.tanh(a),
+}
+
+# Vectors shorter than this are mapped element by element, which is faster
+# than going through numpy
+vectorizeThreshold = 16
+
+def vectorizeExp(e, proc):
+    '''
+    Returns a python function computing the expression e of the body of the
+    one-parameter procedure proc on a numpy array x of values of its
+    parameter. Raises CannotVectorize if e uses anything but numbers,
+    booleans, if, the parameter, captured numbers and vectorizable primitives.
+    Identifiers are looked up when the function runs, so that it keeps
+    seeing the current value of redefined globals
+    '''
+    e = e.unwrapped()
+    if isinstance(e, EFloat):
+        val = e.val
+        return lambda x: val
+    elif isinstance(e, EBoolean):
+        val = e.val
+        return lambda x: val
+    elif isinstance(e, EId):
+        if e.id == proc.params[0]:
+            return lambda x: x
+        if e.id == proc.name:
+            raise CannotVectorize()
+        env, id = proc.env, e.id
+        def lookupFloat(x):
+            v = env.lookup(id)
+            if v.isFloat():
+                return v.getFloat()
+            elif v.isBoolean():
+                return v.getBoolean()
+            raise CannotVectorize()
+        return lookupFloat
+    elif isinstance(e, EIf):
+        cond = vectorizeExp(e.ec, proc)
+        then = vectorizeExp(e.et, proc)
+        otherwise = vectorizeExp(e.ee, proc)
+        def vectorIf(x):
+            c = np.asarray(cond(x))
+            if c.dtype != bool:
+                raise CannotVectorize()
+            return np.where(c, then(x), otherwise(x))
+        return vectorIf
+    elif isinstance(e, EApply) and isinstance(e.fn.unwrapped(), EId) and e.fn.unwrapped().id not in (proc.params[0], proc.name):
+        env, id = proc.env, e.fn.unwrapped().id
+        v = env.lookup(id)
+        if not isinstance(v, VPrimitive) or v.oper not in vectorizedPrimitives:
+            raise CannotVectorize()
+        args = [vectorizeExp(arg, proc) for arg in e.args]
+        def vectorApply(x):
+            v = env.lookup(id)
+            if not isinstance(v, VPrimitive) or v.oper not in vectorizedPrimitives:
+                raise CannotVectorize()
+            vals = [arg(x) for arg in args]
+            # the primitives only take numbers, booleans are left to them to reject
+            if any(np.asarray(val).dtype == bool for val in vals):
+                raise CannotVectorize()
+            return vectorizedPrimitives[v.oper](*vals)
+        return vectorApply
+    raise CannotVectorize()
+
+def applyVectorized(v1, v2):
+    '''
+    Applies the procedure v1 to every element of the vector v2 at once with
+    numpy and returns the array of results, or None if it has to be applied
+    element by element: v1 is not pure arithmetic, v2 does not only hold
+    floats, or numpy hit an error the element-wise application will report
+    '''
+    if not isinstance(v1, VProcedure) or len(v1.params) != 1 or v2.getLength() < vectorizeThreshold:
+        return None
+    if v1.vectorized is None:
+        try:
+            v1.vectorized = vectorizeExp(v1.body, v1)
+        except Exception:
+            v1.vectorized = False
+    if v1.vectorized is False:
+        return None
+    floats = v2.getFloats()
+    if floats is None:
+        l = v2.getList()
+        if not all(elm.isFloat() for elm in l):
+            return None
+        floats = np.array([elm.getFloat() for elm in l])
+    try:
+        with np.errstate(all="raise", under="ignore"):
+            result = np.broadcast_to(v1.vectorized(floats), floats.shape)
+    except Exception:
+        return None
+    if result.dtype == bool:
+        return result
+    elif result.dtype.kind in "fi":
+        return result.astype(float)
+    return None
+
+# The table of primitive operations, built once when the module is loaded
+primitives = dict([
     ("-", VPrimitive(operMinus)), # (- 5)
     ("*", VPrimitive(operTimes)), # (* 2, 7)
     ("+", VPrimitive(operPlus)), # (+ 2, 4), (+ (poisson 5), (poisson 10))
@@ -1239,10 +2564,33 @@ initEnv = Env([
     ("rest", VPrimitive(operRest)), # (rest (vector 1, 2, 3, 4))
     ("count", VPrimitive(operCount)), # (count (vector 1, 2, 3, 4))
     ("empty?", VPrimitive(operEmptyP)), # (empty? (vector)) (empty? (vector 1))
+    ("range", VPrimitive(operRange)), # (range 5) (range 1, 11) (range 0, 1, 0.25)
+    ("repeat", VPrimitive(operRepeat)), # (repeat 3, "a")
+    ("reduce", VPrimitive(operReduce)), # (reduce +, (range 1, 101)) (reduce (lambda (acc, a) (+ acc, (* a, a))), 0, (range 10))
+    ("fold", VPrimitive(operFold)), # (fold *, 1, (range 1, 6))
+    ("zip", VPrimitive(operZip)), # (zip (vector 1, 2, 3), (vector "a", "b", "c"))
+    ("take", VPrimitive(operTake)), # (take 2, (vector 1, 2, 3, 4))
+    ("drop", VPrimitive(operDrop)), # (drop 2, (vector 1, 2, 3, 4))
+    ("frequencies", VPrimitive(operFrequencies)), # (frequencies (vector "a", "b", "a"))
+    ("unique", VPrimitive(operUnique)), # (unique (vector 3, 1, 3, 2, 1))
+    ("group-by", VPrimitive(operGroupBy)), # (group-by (lambda (a) (% a, 3)), (range 10))
+    ("samples", VPrimitive(operSamples)), # (take 5, (samples (normal 0, 1))) (mean (take 1000000, (samples (poisson 3))))
+    ("collect", VPrimitive(operCollect)), # (collect (take 3, (samples (bernoulli 1_2))))
+    ("moments", VPrimitive(operMoments)), # (summary (accumulate-samples (moments), (normal 0, 1), 1000000))
+    ("histogram", VPrimitive(operHistogram)), # (summary (accumulate (histogram 0, 10, 5), (range 10)))
+    ("quantile-sketch", VPrimitive(operQuantileSketch)), # (quantile (accumulate-samples (quantile-sketch), (exponential 1), 1000000), 0.99)
+    ("reservoir", VPrimitive(operReservoir)), # (summary (accumulate-samples (reservoir 10), (uniform 0, 1), 1000000))
+    ("accumulate", VPrimitive(operAccumulate)), # (accumulate (moments), 2.5) (accumulate (moments), (vector 1, 2, 3))
+    ("accumulate-samples", VPrimitive(operAccumulateSamples)), # (accumulate-samples (moments), (poisson 4), 100000)
+    ("summary", VPrimitive(operSummary)), # (summary (accumulate (moments), (range 10)))
+    ("quantile", VPrimitive(operQuantile)), # (quantile (range 101), 0.9)
     ("beta", VPrimitive(operBeta)), # (sample (beta 2, 3))
     ("bernoulli", VPrimitive(operBernoulli)), # (sample (bernoulli 1_2))
+    ("binomial", VPrimitive(operBinomial)), # (sample (binomial 10, 1_2))
+    ("categorical", VPrimitive(operCategorical)), # (sample (categorical (vector "a", "b"), (vector 0.9, 0.1)))
     ("exponential", VPrimitive(operExponential)), # (sample (exponential 1_250))
     ("normal", VPrimitive(operNormal)), # (sample (normal 0, 0.1))
+    ("mvnormal", VPrimitive(operMvnormal)), # (sample (mvnormal (vector 0, 0), (identity 2)))
     ("poisson", VPrimitive(operPoisson)), # (sample (poisson 5))
     ("uniform", VPrimitive(operUniformContinuous)), # (sample (uniform 0, 100))
     ("randelm", VPrimitive(operUniformDiscrete)), # (sample (randelm (vector 5, 6, 7, 8))), (sample (randelm (vector "this", "is", "a", "vector")))
@@ -1250,20 +2598,92 @@ initEnv = Env([
     ("vector", VPrimitive(operVector)), # (vector (+ 1, 2), (+ 3, 4), (+ 4, 5))
     ("map", VPrimitive(operMap)), # (map (lambda (a) (* a, a)), (vector 1, 2, 3, 4))
     ("filter", VPrimitive(operFilter)), # (filter (lambda (a) (not (< a, 0))), (vector 1, -2, 3, -4, 5, -6, 7))
+    ("matrix", VPrimitive(operMatrix)), # (matrix (vector (vector 1, 2), (vector 3, 4))) (matrix (range 6), 2, 3)
+    ("identity", VPrimitive(operIdentity)), # (identity 3)
+    ("dot", VPrimitive(operDot)), # (dot (vector 1, 2), (vector 3, 4))
+    ("matmul", VPrimitive(operMatmul)), # (matmul (matrix (range 4), 2, 2), (vector 1, 1))
+    ("transpose", VPrimitive(operTranspose)), # (transpose (matrix (range 6), 2, 3))
+    ("solve", VPrimitive(operSolve)), # (solve (matrix (vector 2, 0, 0, 4), 2, 2), (vector 2, 4))
+    ("cholesky", VPrimitive(operCholesky)), # (cholesky (matrix (vector 4, 2, 2, 3), 2, 2))
     ("empty", VVector([])),
     ("sample", VPrimitive(operSample)),
+    ("observe", VPrimitive(operObserve)), # (observe (normal 0, 1), 0.5)
 ])
 
+def newEnv():
+    '''
+    Returns a fresh top-level environment, whose global table starts with the
+    primitive operations and receives the defines of one session or run only
+    '''
+    return Env([], dict(primitives))
+
+# The initial environment, read-only so that no run can leave definitions in
+# it for the next one. Sessions and runs define into their own newEnv()
+initEnv = Env([], MappingProxyType(primitives))
+
+def warmUp():
+    '''
+    Imports the grammar and numpy, which the first parse and the first sample
+    would otherwise have to wait for
+    '''
+    getGrammar()
+    np.random
+
+def readFile(filename):
+    '''
+    Reads the content of a .func file. Newlines are kept so that the
+    spans of the parsed expressions give real line numbers
+    '''
+    f = open(filename, "r")
+    content = f.read()
+    f.close()
+    return content
+
+def streamStats(e, env, n):
+    '''
+    Gathers the moments and a quantile sketch of n values of the expression
+    e: n samples if it evaluates to a distribution, n evaluations otherwise.
+    Values are handled in blocks, so memory stays bounded for any n
+    '''
+    moments = stats.Moments()
+    sketch = stats.QuantileSketch(1024, getRandom())
+    if n < 1:
+        return moments, sketch
+    v = e.eval(env)
+    if v.isDistribution():
+        blocks = sampleBlocks(v, n)
+    else:
+        def evalBlocks():
+            block = [convertFloat(v)]
+            for i in range(n - 1):
+                if len(block) == blockSize:
+                    yield np.array(block)
+                    block = []
+                block.append(convertFloat(e.eval(env)))
+            yield np.array(block)
+        blocks = evalBlocks()
+    for block in blocks:
+        moments.addMany(block)
+        sketch.addMany(block)
+    return moments, sketch
+
 def shell():
     '''
     The shell keeps asking for user input, parses the input into an expression,
-    evaluates the expression to a value using the initEnv, and displays the value
-    in a human readable format
+    evaluates the expression to a value in the session's own environment, and
+    displays the value in a human readable format
     '''
-    env = initEnv
+    env = newEnv()
+    # load the heavy modules while the user types the first input
+    threading.Thread(target=warmUp, daemon=True).start()
     print("Type #quit to quit")
     print("Type #parse in front of expression to print its abstract representation")
     print("Type #file in front of filename to read and evaluate content of file")
+    print("Type #lmh followed by a number of steps in front of expression to run Metropolis-Hastings on it")
+    print("Type #smc followed by a number of particles in front of expression to run a particle filter on it")
+    print("Type #profile in front of expression or #file command to time its evaluation")
+    print("Type #stats followed by a number of samples in front of expression to summarize its samples")
+    print("Type #enumerate in front of expression to compute its exact distribution")
     while True:
         user_input = input("PROB> ")
         try:
@@ -1271,17 +2691,59 @@ def shell():
                 return
             elif user_input.startswith("#file"): # '../test-loop-sum-squares.func'
                 filename = user_input[6:]
-                f = open(filename, "r")
-                content_list = f.read().splitlines()
-                content = ''
-                for i in content_list:
-                    content += i
-                f.close()
-                content = re.sub(' +', ' ', content)
-                e = parse(content)
+                content = readFile(filename)
+                e = parse(content, filename)
                 print(e)
                 v = e.eval(env)
                 print(v.toDisplay())
+            elif user_input.startswith("#lmh"): # #lmh 1000 (let ((mu (sample (normal 0, 1)))) ...)
+                from inference import lmh
+                num_steps, valid_input = user_input[5:].split(" ", 1)
+                e = parse(valid_input)
+                chain = lmh(e, env, int(num_steps))
+                print("acceptance rate: " + str(chain.acceptanceRate()))
+                print(chain.getVector().toDisplay())
+            elif user_input.startswith("#smc"): # #smc 1000 (let ((mu (sample (normal 0, 1)))) ...)
+                from smc import smc
+                num_particles, valid_input = user_input[5:].split(" ", 1)
+                e = parse(valid_input)
+                result = smc(e, env, int(num_particles))
+                print("log evidence: " + str(result.logEvidence))
+                print(result.getVector().toDisplay())
+            elif user_input.startswith("#enumerate"): # #enumerate [--max-states N] (sample (binomial 10, 0.5))
+                from enumeration import enumerateModel
+                valid_input = user_input[11:]
+                max_states = 100000
+                if valid_input.startswith("--max-states "):
+                    _, max_states, valid_input = valid_input.split(" ", 2)
+                e = parse(valid_input)
+                for v, p in enumerateModel(e, env, int(max_states)):
+                    print(v.toDisplay() + "\t" + str(p))
+            elif user_input.startswith("#stats"): # #stats 100000000 (normal 0, 1)
+                num_samples, valid_input = user_input[7:].split(" ", 1)
+                e = parse(valid_input)
+                moments, sketch = streamStats(e, env, int(num_samples))
+                print(moments.describe())
+                print(", ".join(["q" + str(p) + ": " + str(sketch.quantile(p)) for p in (0.05, 0.25, 0.5, 0.75, 0.95)]))
+            elif user_input.startswith("#profile"): # #profile [--folded out.txt] (expr) or #profile #file x.func
+                from profiler import Profiler
+                valid_input = user_input[9:]
+                folded_file = None
+                if valid_input.startswith("--folded "):
+                    _, folded_file, valid_input = valid_input.split(" ", 2)
+                source_name = "<input>"
+                if valid_input.startswith("#file"):
+                    source_name = valid_input[6:]
+                    valid_input = readFile(source_name)
+                e = parse(valid_input, source_name)
+                profiler = Profiler()
+                v = profiler.run(e, env)
+                print(v.toDisplay())
+                print(profiler.report())
+                if folded_file is not None:
+                    f = open(folded_file, "w")
+                    f.write(profiler.foldedStacks() + "\n")
+                    f.close()
             elif user_input.startswith("#parse"):
                 valid_input = user_input[7:]
                 e = parse(valid_input)
@@ -1293,10 +2755,77 @@ def shell():
         except Exception as e:
             print(str(e))
 
+def runCEK(e, env):
+    '''
+    Evaluates e in env with the explicit-stack machine of cek.py, which
+    does not use the python stack for deep or long-running programs
+    '''
+    from cek import evaluate
+    return evaluate(e, env)
+
+# Evaluators a program can be run with from the command line
+backends = {
+    "tree": lambda e, env: e.eval(env),
+    "cek": runCEK,
+}
+
+def runFile(args):
+    '''
+    Evaluates the file args.file without the interactive shell, args.repeat
+    times with the same parsed program, printing each result and, with
+    args.time, the time of each run and aggregate timings
+    '''
+    from interpreter import Interpreter
+    interpreter = Interpreter(args.seed, args.backend)
+    start = time.perf_counter()
+    e = interpreter.parse(readFile(args.file), args.file)
+    parse_time = time.perf_counter() - start
+    times = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        v = interpreter.evalExp(e)
+        times.append(time.perf_counter() - start)
+        if not args.quiet:
+            print(v.toDisplay())
+        if args.time:
+            print("run " + str(i + 1) + ": " + "%.6f" % times[-1] + " s", file=sys.stderr)
+    if args.time:
+        print("parse: " + "%.6f" % parse_time + " s", file=sys.stderr)
+        print("total: " + "%.6f" % sum(times) + " s, mean: " + "%.6f" % (sum(times) / len(times))
+              + " s, min: " + "%.6f" % min(times) + " s, max: " + "%.6f" % max(times) + " s", file=sys.stderr)
+
+def main(argv):
+    '''
+    The command line entry point. With no arguments it starts the interactive
+    shell, and `run model.func` evaluates a file non-interactively. Returns
+    the exit status
+    '''
+    if not argv:
+        shell()
+        return 0
+    import argparse
+    parser = argparse.ArgumentParser(prog="shell.py", description="Fake Anglican")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="evaluate a .func file")
+    run.add_argument("file", help="the .func file to evaluate")
+    run.add_argument("--repeat", type=int, default=1, help="number of times to evaluate the program")
+    run.add_argument("--seed", type=int, default=None, help="seed of the random number generator")
+    run.add_argument("--backend", default="tree", help="evaluator to use: " + ", ".join(sorted(backends)))
+    run.add_argument("--time", action="store_true", help="print per-run and aggregate timings to stderr")
+    run.add_argument("--quiet", action="store_true", help="do not print the results")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    try:
+        runFile(args)
+    except Exception as e:
+        print("error: " + str(e), file=sys.stderr)
+        return 1
+    return 0
 
 if __name__ == "__main__":
-    # starts the interactive shell
-    shell()
+    # starts the interactive shell, or runs a file given on the command line
+    sys.exit(main(sys.argv[1:]))
 
     # More test cases
     # (- (beta 2, 3))
@@ -1313,4 +2842,4 @@ if __name__ == "__main__":
     # (if true (+ 2, 3) (* 2, 3))
     # (let ((stop 5)) (loop smsquares ((i 0), (sm 0)) (if (= i, stop) sm (begin (print i, sm), (smsquares (+ i, 1), (+ sm, (* i, i)))))))
     # #file binomial_test.func
-    # #file sum_squares_loop.func 
+    # #file sum_squares_loop.func
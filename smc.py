@@ -0,0 +1,136 @@
+'''
+This script contains our sequential Monte Carlo (particle filter) inference engine
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+from shell import *
+import math
+import numpy as np
+
+class SMCHandler:
+    '''
+    SMCHandler receives the choices that the machine does not suspend at,
+    i.e. samples and the observes made inside primitive operations (e.g. in
+    the procedure given to map). Samples are drawn from the prior and those
+    observes are added to the log-weight of the particle being run
+    '''
+    def __init__(self):
+        self.logWeight = 0.0
+    def sample(self, dist, args):
+        return sampleDistribution(dist, args)
+    def observe(self, dist, value):
+        self.logWeight += observeLogProb(dist, value)
+
+def observeLogProb(dist, value):
+    '''
+    Returns the log probability of observing value from dist
+    '''
+    logProb = distLogProb(dist, value)
+    if logProb is None:
+        runtimeError("Cannot observe a distribution without a known density")
+    return logProb
+
+def systematicResample(weights):
+    '''
+    Returns the indices of the particles picked by systematic resampling from
+    the normalized weights, using one uniform draw for all particles
+    '''
+    n = len(weights)
+    positions = (getRandom().uniform() + np.arange(n)) / n
+    return np.minimum(np.searchsorted(np.cumsum(weights), positions), n - 1)
+
+def stratifiedResample(weights):
+    '''
+    Returns the indices of the particles picked by stratified resampling from
+    the normalized weights, using one uniform draw per stratum
+    '''
+    n = len(weights)
+    positions = (getRandom().uniform(size=n) + np.arange(n)) / n
+    return np.minimum(np.searchsorted(np.cumsum(weights), positions), n - 1)
+
+resamplers = {
+    "systematic": systematicResample,
+    "stratified": stratifiedResample,
+}
+
+def logSumExp(logWeights):
+    '''
+    Returns log(sum(exp(logWeights))) computed without overflow
+    '''
+    m = np.max(logWeights)
+    if m == -math.inf:
+        return -math.inf
+    return m + math.log(np.sum(np.exp(logWeights - m)))
+
+def effectiveSampleSize(logWeights):
+    '''
+    Returns the effective sample size 1 / sum(w^2) of the normalized weights
+    '''
+    weights = np.exp(logWeights - logSumExp(logWeights))
+    return 1.0 / np.sum(weights * weights)
+
+class SMCResult:
+    '''
+    The SMCResult class holds the final particles of a run: their results,
+    their log-weights and the estimate of the log marginal likelihood
+    '''
+    def __init__(self, results, logWeights, logEvidence):
+        self.results = results
+        self.logWeights = logWeights
+        self.logEvidence = logEvidence
+    def getWeights(self):
+        return np.exp(self.logWeights - logSumExp(self.logWeights))
+    def getVector(self):
+        '''
+        Returns an equally weighted VVector of results, resampled by weight
+        '''
+        indices = systematicResample(self.getWeights())
+        return VVector([self.results[i] for i in indices])
+
+def smc(exp, env, numParticles, resampler="systematic", essThreshold=0.5):
+    '''
+    Runs numParticles executions of exp in lockstep from one observe to the
+    next, weighting each particle by its observe and resampling whenever the
+    effective sample size falls below essThreshold * numParticles. Particles
+    are executions of the explicit-stack machine suspended at their observe,
+    so each step resumes them where they stopped. Resampled copies of a
+    particle share its suspended state, including any reference cell
+    '''
+    from cek import Suspension, start
+    if resampler not in resamplers:
+        runtimeError("Unknown resampler " + resampler)
+    resample = resamplers[resampler]
+    handler = SMCHandler()
+    saved = choiceHandler.current
+    choiceHandler.current = handler
+    try:
+        states = []
+        logWeights = np.zeros(numParticles)
+        for i in range(numParticles):
+            handler.logWeight = 0.0
+            states.append(start(exp, env, ("observe",)))
+            logWeights[i] = handler.logWeight
+        logEvidence = 0.0
+        while True:
+            suspended = [i for i in range(numParticles) if isinstance(states[i], Suspension)]
+            for i in suspended:
+                logWeights[i] += observeLogProb(states[i].dist, states[i].args)
+            if not suspended:
+                break
+            if effectiveSampleSize(logWeights) < essThreshold * numParticles:
+                total = logSumExp(logWeights)
+                logEvidence += total - math.log(numParticles)
+                indices = resample(np.exp(logWeights - total))
+                states = [states[i] for i in indices]
+                logWeights = np.zeros(numParticles)
+                suspended = [i for i in range(numParticles) if isinstance(states[i], Suspension)]
+            for i in suspended:
+                handler.logWeight = 0.0
+                states[i] = states[i].resume()
+                logWeights[i] += handler.logWeight
+    finally:
+        choiceHandler.current = saved
+    logEvidence += logSumExp(logWeights) - math.log(numParticles)
+    return SMCResult(states, logWeights, logEvidence)
@@ -0,0 +1,238 @@
+'''
+This script contains our float specializer. It infers, for the body of a loop
+or of a self-recursive procedure, whether every loop variable (or parameter)
+and intermediate value is a float or a boolean. Such a body is compiled to a
+python function working on raw floats, which only boxes its result
+'''
+from helper import *
+from exp import *
+from value import *
+from env import *
+import math
+
+class CannotSpecialize(Exception):
+    '''
+    CannotSpecialize is raised while compiling a region that uses something
+    other than floats, booleans and the float operations below
+    '''
+
+# The primitive operations of a region, by name of their python function: the
+# number of arguments (all floats), the python code and the type of the result
+floatOperations = {
+    "operPlus": (2, "({0} + {1})", "float"),
+    "operTimes": (2, "({0} * {1})", "float"),
+    "operDiv": (2, "({0} / {1})", "float"),
+    "operMinus": (1, "(-{0})", "float"),
+    "operAbs": (1, "abs({0})", "float"),
+    "operSqrt": (1, "sqrt({0})", "float"),
+    "operExp": (1, "exp({0})", "float"),
+    "operLog": (1, "log({0})", "float"),
+    "operEqual": (2, "isclose({0}, {1})", "bool"),
+    "operNotEqual": (2, "(not isclose({0}, {1}))", "bool"),
+    "operLess": (2, "({0} < {1})", "bool"),
+    "operGreater": (2, "({0} > {1})", "bool"),
+    "operLessEq": (2, "({0} <= {1})", "bool"),
+    "operGreaterEq": (2, "({0} >= {1})", "bool"),
+}
+
+class RegionCompiler:
+    '''
+    The RegionCompiler class generates the python code of a region: a loop
+    over its variables whose body either jumps back with new values, by
+    calling selfName in tail position, or returns a boxed result. Identifiers
+    of the language are renamed to python locals; identifiers bound outside
+    the region are passed in as floats and operators are checked on entry
+    '''
+    def __init__(self, selfName, variables, env):
+        self.selfName = selfName
+        self.variables = variables
+        self.env = env
+        self.free = {}
+        self.operators = {}
+        self.bound = set(variables) | {selfName}
+        self.count = 0
+        self.lines = []
+    def local(self):
+        self.count += 1
+        return "v" + str(self.count)
+    def operation(self, name, scope):
+        '''
+        Returns the float operation an identifier in function position refers to
+        '''
+        if name in scope or name == self.selfName:
+            raise CannotSpecialize()
+        try:
+            v = self.env.lookup(name)
+        except LanguageError:
+            raise CannotSpecialize()
+        oper = getattr(getattr(v, "oper", None), "__name__", None)
+        if oper not in floatOperations:
+            raise CannotSpecialize()
+        self.operators[name] = oper
+        return floatOperations[oper]
+    def expr(self, e, scope):
+        '''
+        Returns the python code and type of the expression e, in which the
+        identifiers of scope are python locals
+        '''
+        e = e.unwrapped()
+        cls = type(e)
+        if cls is EFloat:
+            if not math.isfinite(e.val):
+                raise CannotSpecialize()
+            return repr(e.val), "float"
+        elif cls is EBoolean:
+            return repr(bool(e.val)), "bool"
+        elif cls is EId:
+            if e.id in scope:
+                return scope[e.id]
+            if e.id == self.selfName:
+                raise CannotSpecialize()
+            if e.id not in self.free:
+                self.free[e.id] = "f" + str(len(self.free))
+            return self.free[e.id], "float"
+        elif cls is EIf:
+            cond, condType = self.expr(e.ec, scope)
+            then, thenType = self.expr(e.et, scope)
+            other, otherType = self.expr(e.ee, scope)
+            if condType != "bool" or thenType != otherType:
+                raise CannotSpecialize()
+            return "(" + then + " if " + cond + " else " + other + ")", thenType
+        elif cls is EApply and type(e.fn.unwrapped()) is EId:
+            arity, code, resultType = self.operation(e.fn.unwrapped().id, scope)
+            if len(e.args) != arity:
+                raise CannotSpecialize()
+            args = []
+            for arg in e.args:
+                argCode, argType = self.expr(arg, scope)
+                if argType != "float":
+                    raise CannotSpecialize()
+                args.append(argCode)
+            return code.format(*args), resultType
+        raise CannotSpecialize()
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+    def tail(self, e, scope, indent):
+        '''
+        Emits the statements of e in tail position: a branch, a let, a jump
+        back to the start of the region or the return of a boxed value
+        '''
+        e = e.unwrapped()
+        cls = type(e)
+        fn = e.fn.unwrapped() if cls is EApply else None
+        if cls is EIf:
+            cond, condType = self.expr(e.ec, scope)
+            if condType != "bool":
+                raise CannotSpecialize()
+            self.emit(indent, "if " + cond + ":")
+            self.tail(e.et, scope, indent + 1)
+            self.emit(indent, "else:")
+            self.tail(e.ee, scope, indent + 1)
+        elif type(fn) is EId and fn.id == self.selfName and fn.id not in scope:
+            if len(e.args) != len(self.variables):
+                raise CannotSpecialize()
+            args = []
+            for arg in e.args:
+                argCode, argType = self.expr(arg, scope)
+                if argType != "float":
+                    raise CannotSpecialize()
+                args.append(argCode)
+            names = [scope[v][0] for v in self.variables]
+            self.emit(indent, ", ".join(names) + " = " + ", ".join(args))
+            self.emit(indent, "continue")
+        elif type(fn) is EProcedure and len(fn.params) == len(e.args):
+            # a let: its variables become python locals of the region
+            inner = dict(scope)
+            for (name, arg) in zip(fn.params, e.args):
+                if name in self.bound or name in self.free:
+                    raise CannotSpecialize()
+                self.bound.add(name)
+                code, argType = self.expr(arg, scope)
+                local = self.local()
+                self.emit(indent, local + " = " + code)
+                inner[name] = (local, argType)
+            self.bound.add(fn.recName)
+            self.tail(fn.body, inner, indent)
+        else:
+            code, resultType = self.expr(e, scope)
+            self.emit(indent, "return " + ("VFloat(" if resultType == "float" else "VBoolean(") + code + ")")
+    def compile(self, body):
+        '''
+        Returns a Region running body, or raises CannotSpecialize
+        '''
+        scope = {}
+        for name in self.variables:
+            scope[name] = (self.local(), "float")
+        self.lines = []
+        self.tail(body, scope, 2)
+        if not any(line.strip() == "continue" for line in self.lines):
+            # without a jump back there is no loop worth specializing
+            raise CannotSpecialize()
+        params = [scope[name][0] for name in self.variables] + list(self.free.values())
+        source = "\n".join(["def region(" + ", ".join(params) + "):", "    while True:"] + self.lines)
+        namespace = {"VFloat": VFloat, "VBoolean": VBoolean, "isclose": math.isclose,
+                     "sqrt": math.sqrt, "exp": math.exp, "log": math.log}
+        exec(compile(source, "<specialized " + str(self.selfName) + ">", "exec"), namespace)
+        return Region(namespace["region"], source, list(self.free), self.operators, self.bound)
+
+class Region:
+    '''
+    The Region class is a compiled loop or procedure body. run checks on entry
+    that its variables and free identifiers are floats and that its operators
+    are the primitives it was compiled for, and returns None when they are not
+    so that the caller evaluates the body as usual
+    '''
+    def __init__(self, function, source, free, operators, names):
+        self.function = function
+        self.source = source
+        self.free = free
+        self.operators = list(operators.items())
+        # identifiers bound by or inside the region, which must not be bound in
+        # the environment it is entered from since lookups find older bindings first
+        self.names = names
+    def run(self, env, values):
+        for v in values:
+            if type(v) is not VFloat:
+                return None
+        for (name, _) in env.content:
+            if name in self.names:
+                return None
+        args = [v.val for v in values]
+        try:
+            for (name, oper) in self.operators:
+                v = env.lookup(name)
+                if type(v) is not VPrimitive or getattr(v.oper, "__name__", None) != oper:
+                    return None
+            for name in self.free:
+                v = env.lookup(name)
+                if type(v) is not VFloat:
+                    return None
+                args.append(v.val)
+        except LanguageError:
+            return None
+        return self.function(*args)
+
+def specializeLoop(eloop, env):
+    '''
+    Returns a Region for the body of the loop eloop, or None if it cannot be
+    specialized. Operators are resolved in env, where the loop is entered
+    '''
+    variables = [name for (name, _) in eloop.init]
+    if len(set(variables)) != len(variables) or eloop.name in variables:
+        return None
+    try:
+        return RegionCompiler(eloop.name, variables, env).compile(eloop.body)
+    except CannotSpecialize:
+        return None
+
+def specializeProcedure(fn):
+    '''
+    Returns a Region for the body of the procedure fn when it calls itself
+    by name in tail position, or None if it cannot be specialized
+    '''
+    if len(set(fn.params)) != len(fn.params) or fn.name in fn.params:
+        return None
+    try:
+        return RegionCompiler(fn.name, list(fn.params), fn.env).compile(fn.body)
+    except CannotSpecialize:
+        return None
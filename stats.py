@@ -0,0 +1,175 @@
+'''
+This script contains our streaming summary statistics. Each accumulator takes
+samples one at a time with add or a numpy array at a time with addMany, and
+keeps O(1) or bounded memory however many samples it sees
+'''
+from helper import *
+import math
+import numpy as np
+
+class Moments:
+    '''
+    The Moments class keeps the count, mean, sum of squared deviations (for the
+    variance), minimum and maximum of its samples. Single samples are added
+    with Welford's update and arrays are merged in with Chan's pairwise formula
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+    def addMany(self, xs):
+        if len(xs) == 0:
+            return
+        n = len(xs)
+        mean = float(xs.mean())
+        m2 = float(((xs - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.min = min(self.min, float(xs.min()))
+        self.max = max(self.max, float(xs.max()))
+    def variance(self):
+        '''
+        Returns the sample variance, or nan with fewer than two samples
+        '''
+        if self.count < 2:
+            return math.nan
+        return self.m2 / (self.count - 1)
+    def describe(self):
+        return ("count: " + str(self.count) + ", mean: " + str(self.mean) + ", sd: " + str(math.sqrt(self.variance()))
+                + ", min: " + str(self.min) + ", max: " + str(self.max))
+
+class Histogram:
+    '''
+    The Histogram class counts its samples in bins equally spaced bins over
+    [lo, hi), along with the samples falling below or above that range
+    '''
+    def __init__(self, lo, hi, bins):
+        if not lo < hi:
+            runtimeError("Histogram range [" + str(lo) + ", " + str(hi) + ") is empty")
+        self.lo = lo
+        self.hi = hi
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+        self.count = 0
+    def add(self, x):
+        self.addMany(np.array([x]))
+    def addMany(self, xs):
+        self.count += len(xs)
+        self.below += int(np.count_nonzero(xs < self.lo))
+        self.above += int(np.count_nonzero(xs >= self.hi))
+        inside = xs[(xs >= self.lo) & (xs < self.hi)]
+        bins = ((inside - self.lo) * (len(self.counts) / (self.hi - self.lo))).astype(np.int64)
+        self.counts += np.bincount(np.minimum(bins, len(self.counts) - 1), minlength=len(self.counts))
+    def describe(self):
+        return ("count: " + str(self.count) + ", bins: " + str(len(self.counts)) + " over [" + str(self.lo) + ", " + str(self.hi)
+                + "), below: " + str(self.below) + ", above: " + str(self.above))
+
+class QuantileSketch:
+    '''
+    The QuantileSketch class estimates quantiles in bounded memory with a
+    stack of compactors. Level i holds samples standing for 2^i samples each;
+    when a level holds more than capacity samples it is sorted and every other
+    one, from a random offset, is promoted to the next level. The rank error
+    shrinks as the capacity grows
+    '''
+    def __init__(self, capacity=256, random=None):
+        self.capacity = capacity
+        self.random = random
+        self.levels = [np.empty(0)]
+        self.buffer = []
+        self.count = 0
+    def add(self, x):
+        self.buffer.append(x)
+        self.count += 1
+        if len(self.buffer) >= self.capacity:
+            self.flush()
+    def addMany(self, xs):
+        self.flush()
+        self.count += len(xs)
+        self.levels[0] = np.concatenate((self.levels[0], xs))
+        self.compact()
+    def flush(self):
+        if self.buffer:
+            self.levels[0] = np.concatenate((self.levels[0], self.buffer))
+            self.buffer = []
+            self.compact()
+    def compact(self):
+        random = self.random or np.random
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity:
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # an odd item out stays at this level so that no weight is lost
+                kept = items[:len(items) % 2]
+                items = items[len(items) % 2:]
+                promoted = items[random.randint(0, 2)::2]
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate((self.levels[level + 1], promoted))
+            level += 1
+    def quantile(self, p):
+        '''
+        Returns the estimated p-quantile of the samples, for p in [0, 1]
+        '''
+        self.flush()
+        if self.count == 0:
+            return math.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** i) for i, level in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        ranks = np.cumsum(weights[order])
+        i = np.searchsorted(ranks, p * ranks[-1], side="left")
+        return float(items[order][min(i, len(items) - 1)])
+    def describe(self):
+        return ("count: " + str(self.count) + ", median: " + str(self.quantile(0.5))
+                + ", stored: " + str(sum(len(items) for items in self.levels) + len(self.buffer)))
+
+class Reservoir:
+    '''
+    The Reservoir class keeps a uniform random subsample of at most size of
+    its samples (Vitter's algorithm R). Arrays are handled by drawing all their
+    acceptances at once
+    '''
+    def __init__(self, size, random=None):
+        self.size = size
+        self.random = random
+        self.items = np.empty(size)
+        self.count = 0
+    def add(self, x):
+        self.addMany(np.array([x], dtype=float))
+    def addMany(self, xs):
+        random = self.random or np.random
+        fill = min(len(xs), self.size - min(self.count, self.size))
+        self.items[self.count:self.count + fill] = xs[:fill]
+        rest = xs[fill:]
+        if len(rest) > 0:
+            # sample number t (counting from 1) is kept with probability size / t
+            t = self.count + fill + np.arange(1, len(rest) + 1)
+            keep = random.uniform(size=len(rest)) * t < self.size
+            slots = random.randint(0, self.size, size=int(np.count_nonzero(keep)))
+            # later samples overwrite earlier ones in the same slot, as in sequence
+            for slot, x in zip(slots.tolist(), rest[keep].tolist()):
+                self.items[slot] = x
+        self.count += len(xs)
+    def sample(self):
+        '''
+        Returns the numpy array of samples kept so far
+        '''
+        return self.items[:min(self.count, self.size)].copy()
+    def describe(self):
+        return "count: " + str(self.count) + ", kept: " + str(min(self.count, self.size))
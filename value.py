@@ -4,6 +4,7 @@ This script contains our value classes
 from helper import *
 from env import *
 from exp import *
+from fractions import Fraction
 import math
 
 class NextIteration(Exception):
@@ -28,7 +29,20 @@ class Value:
     def __str__(self):
         pass
     def __eq__(self, other):
-        pass
+        '''
+        Values are equal only to themselves unless their class compares
+        them structurally, in which case it also hashes them structurally
+        '''
+        return self is other
+    def __hash__(self):
+        return id(self)
+    def __reduce__(self):
+        '''
+        Pickles values in the format of serialize.py, so that closures and
+        distributions can be sent to other processes
+        '''
+        from serialize import dumps, loads
+        return (loads, (dumps(self),))
     def isBoolean(self):
         return False
     def isRational(self):
@@ -45,26 +59,36 @@ class Value:
         return False
     def isVector(self):
         return False
+    def isMatrix(self):
+        return False
     def isDistribution(self):
         return False
+    def isAccumulator(self):
+        return False
+    def isStream(self):
+        return False
     def toDisplay(self):
         pass
     def getBoolean(self):
-        runtimeError("Value " + str(self) + " is not of type BOOLEAN")
+        typeError(self, "BOOLEAN")
     def getNumerator(self):
-        runtimeError("Value " + str(self) + " is not of type RATIONAL")
+        typeError(self, "RATIONAL")
     def getDenominator(self):
-        runtimeError("Value " + str(self) + " is not of type RATIONAL")
+        typeError(self, "RATIONAL")
     def getFloat(self):
-        runtimeError("Value " + str(self) + " is not of type FLOAT")
+        typeError(self, "FLOAT")
     def getString(self):
-        runtimeError("Value " + str(self) + " is not of type STRING")
+        typeError(self, "STRING")
     def getRefContent(self):
-        runtimeError("Value " + str(self) + " is not of type REFCELL")
+        typeError(self, "REFCELL")
     def putRefContent(self, v):
-        runtimeError("Value " + str(self) + " is not of type REFCELL")
+        typeError(self, "REFCELL")
     def apply(self, vs):
-        runtimeError("Value " + str(self) + " is not of type PROCEDURE")
+        typeError(self, "PROCEDURE")
+    def getAccumulator(self):
+        typeError(self, "ACCUMULATOR")
+    def getMatrix(self):
+        typeError(self, "MATRIX")
 
 class VBoolean(Value):
     '''
@@ -75,7 +99,9 @@ class VBoolean(Value):
     def __str__(self):
         return "VBoolean[" + str(self.val) + "]"
     def __eq__(self, other):
-        other.val == self.val
+        return isinstance(other, Value) and other.isBoolean() and other.val == self.val
+    def __hash__(self):
+        return hash(("boolean", self.val))
     def isBoolean(self):
         return True
     def getBoolean(self):
@@ -95,7 +121,18 @@ class VRational(Value):
     def __str__(self):
         return "VFraction[" + str(self.num) + ", " + str(self.den) + "]"
     def __eq__(self, other):
-        self.num == other.num and self.den == other.den
+        if not isinstance(other, Value):
+            return False
+        elif other.isRational():
+            return self.fraction() == other.fraction()
+        elif other.isFloat():
+            return self.fraction() == other.val
+        return False
+    def __hash__(self):
+        # equal to the hash of the float with the same value, like Fraction
+        return hash(self.fraction())
+    def fraction(self):
+        return Fraction(self.num) / Fraction(self.den)
     def isRational(self):
         return True
     def getNumerator(self):
@@ -139,7 +176,15 @@ class VFloat(Value):
     def __str__(self):
         return "VFloat[" + str(self.val) + "]"
     def __eq__(self, other):
-        return math.isclose(other.val, self.val)
+        if not isinstance(other, Value):
+            return False
+        elif other.isFloat():
+            return other.val == self.val
+        elif other.isRational():
+            return other == self
+        return False
+    def __hash__(self):
+        return hash(self.val)
     def isFloat(self):
         return True
     def toDisplay(self):
@@ -156,7 +201,9 @@ class VString(Value):
     def __str__(self):
         return "VString[" + self.val + "]"
     def __eq__(self, other):
-        other.val == self.val
+        return isinstance(other, Value) and other.isString() and other.val == self.val
+    def __hash__(self):
+        return hash(self.val)
     def isString(self):
         return True
     def toDisplay(self):
@@ -173,7 +220,9 @@ class VNil(Value):
     def __str__(self):
         return "VNil[" + str(self.val) + "]"
     def __eq__(self, other):
-        other.val == self.val
+        return isinstance(other, Value) and other.isNil()
+    def __hash__(self):
+        return hash(None)
     def isNil(self):
         return True
     def toDisplay(self):
@@ -188,17 +237,27 @@ class VProcedure(Value):
         self.params = params
         self.body = body
         self.env = env
+        # the numpy form of this procedure built by map and filter, or False
+        # once it is known that it cannot be vectorized
+        self.vectorized = None
     def __str__(self):
         return "VProcedure[" + self.name + "; " + ','.join([str(elm) for elm in self.params]) + "; " + str(self.body) + "; " + str(self.env) + "]"
-    def __eq__(self, other):
-        runtimeError("Equal for VProcedure not implemented yet")
+    def describe(self):
+        return "VProcedure[" + self.name + "; " + ','.join([str(elm) for elm in self.params]) + "]"
     def isProcedure(self):
         return True
     def toDisplay(self):
         return "#PROCEDURE"
     def apply(self, args):
         if len(self.params) != len(args):
-            runtimeError("wrong number of arguments\n  Function " + str(self))
+            arityError(len(args), len(self.params), self)
+        if self.body.specializedCall is None:
+            from specialize import specializeProcedure
+            self.body.specializedCall = specializeProcedure(self) or False
+        if self.body.specializedCall:
+            result = self.body.specializedCall.run(self.env, args)
+            if result is not None:
+                return result
         new_env = self.env
         for (p,v) in zip(self.params, args):
             new_env = new_env.push(p,v)
@@ -207,24 +266,39 @@ class VProcedure(Value):
 
 class VDistribution(Value):
     '''
-    The VDistribution class defines our primitive distributions before sampling
+    The VDistribution class defines our primitive distributions before sampling.
+    Distributions built by a primitive such as normal or poisson also remember
+    their family name and parameters so that they can be combined in closed form
     '''
-    def __init__(self, name, params, body, env):
+    def __init__(self, name, params, body, env, family=None, familyArgs=None):
         self.name = name
         self.params = params
         self.body = body
         self.env = env
+        self.family = family
+        self.familyArgs = familyArgs
     def __str__(self):
         return "VDistribution[" + self.name + "; " + ','.join([str(elm) for elm in self.params]) + "; " + str(self.body) + "; " + str(self.env) + "]"
-    def __eq__(self, other):
-        runtimeError("Equal for VDistribution not implemented yet")
+    def describe(self):
+        if self.family is not None:
+            args = []
+            for elm in self.familyArgs:
+                if isinstance(elm, Value):
+                    args.append(describeValue(elm, 20))
+                elif hasattr(elm, "tolist"):
+                    # the numpy arrays of mvnormal, on one line
+                    args.append(str(elm.tolist()))
+                else:
+                    args.append(str(elm))
+            return "VDistribution[" + self.family + "; " + ','.join(args) + "]"
+        return "VDistribution[" + self.name + "; " + ','.join([str(elm) for elm in self.params]) + "]"
     def isDistribution(self):
         return True
     def toDisplay(self):
         return str(self)
     def apply(self, args):
         if len(self.params) != len(args):
-            runtimeError("wrong number of arguments\n  Function " + str(self))
+            arityError(len(args), len(self.params), self)
         new_env = self.env
         for (p,v) in zip(self.params, args):
             new_env = new_env.push(p,v)
@@ -239,8 +313,8 @@ class VRefCell(Value):
         self.content = init
     def __str__(self):
         return "VRefCell[" + str(self.content) + "]"
-    def __eq__(self, other):
-        str(other.val) == str(self)
+    def describe(self):
+        return "VRefCell[" + describeValue(self.content, 40) + "]"
     def isRefCell(self):
         return True
     def toDisplay(self):
@@ -258,8 +332,6 @@ class VPrimitive(Value):
         self.oper = oper
     def __str__(self):
         return "VPrimitive[" + str(self.oper) + "]"
-    def __eq__(self, other):
-        runtimeError("Equal for VPrimitive not implemented yet")
     def isProcedure(self):
         return True
     def toDisplay(self):
@@ -269,27 +341,135 @@ class VPrimitive(Value):
 
 class VVector(Value):
     '''
-    The VVector class defines our vectors
+    The VVector class defines our vectors. A vector of floats built by a bulk
+    primitive can be backed by a numpy array instead of a list, in which case
+    its elements are only boxed into VFloats when the list is first needed
     '''
-    def __init__(self, l):
-        self.list = l
+    def __init__(self, l, floats=None):
+        self.elements = l
+        self.floats = floats
+    @property
+    def list(self):
+        if self.elements is None:
+            self.elements = [VFloat(x) for x in self.floats.tolist()]
+        return self.elements
+    @classmethod
+    def fromFloats(cls, floats):
+        '''
+        Returns a vector backed by the one-dimensional numpy array floats
+        '''
+        return cls(None, floats)
     def __str__(self):
         return "VVector[" + ', '.join([str(elm) for elm in self.list]) + "]"
+    def describe(self):
+        '''
+        Describes the vector by its length and first few elements only
+        '''
+        head = self.floats[:4].tolist() if self.floats is not None else self.elements[:4]
+        elms = [str(elm) if isinstance(elm, float) else describeValue(elm, 20) for elm in head]
+        if self.getLength() > len(head):
+            elms.append("... " + str(self.getLength()) + " elements")
+        return "VVector[" + ', '.join(elms) + "]"
     def __eq__(self, other):
-        if other.isVector():
+        if isinstance(other, Value) and other.isVector():
+            if self.floats is not None and other.floats is not None:
+                return self.floats.shape == other.floats.shape and bool((self.floats == other.floats).all())
             if len(other.getList()) == len(self.list):
                 for index, elm in enumerate(self.list):
                     if elm != other.getList()[index]:
                         return False
                 return True
         return False
+    def __hash__(self):
+        # the hash of a tuple of floats is the hash of the tuple of their VFloats
+        if self.floats is not None:
+            return hash(tuple(self.floats.tolist()))
+        return hash(tuple(self.list))
     def isVector(self):
         return True
     def getList(self):
         return self.list
+    def getFloats(self):
+        '''
+        Returns the numpy array backing this vector, or None if it is a list
+        '''
+        return self.floats
+    def getLength(self):
+        if self.elements is None:
+            return len(self.floats)
+        return len(self.elements)
     def toDisplay(self):
         return "(" + ', '.join([elm.toDisplay() for elm in self.list]) + ")"
 
+class VMatrix(Value):
+    '''
+    The VMatrix class defines our matrices, backed by a two-dimensional numpy
+    array of floats. Like vectors of floats, their elements are never boxed
+    '''
+    def __init__(self, array):
+        self.array = array
+    def __str__(self):
+        return "VMatrix[" + '; '.join([', '.join([str(x) for x in row]) for row in self.array.tolist()]) + "]"
+    def describe(self):
+        '''
+        Describes the matrix by its shape and first row only
+        '''
+        rows, cols = self.array.shape
+        head = ', '.join([str(x) for x in self.array[0, :4].tolist()]) if rows > 0 else ""
+        return "VMatrix[" + str(rows) + "x" + str(cols) + "; " + head + (", ..." if rows > 1 or cols > 4 else "") + "]"
+    def __eq__(self, other):
+        if isinstance(other, VMatrix):
+            return self.array.shape == other.array.shape and bool((self.array == other.array).all())
+        return False
+    def __hash__(self):
+        return hash((self.array.shape, tuple(self.array.ravel().tolist())))
+    def isMatrix(self):
+        return True
+    def getMatrix(self):
+        '''
+        Returns the numpy array backing this matrix
+        '''
+        return self.array
+    def toDisplay(self):
+        return "(" + ', '.join(["(" + ', '.join([str(x) for x in row]) + ")" for row in self.array.tolist()]) + ")"
+
+class VAccumulator(Value):
+    '''
+    The VAccumulator class wraps one of the streaming statistics of stats.py.
+    Like a reference cell it is updated in place as samples are added
+    '''
+    def __init__(self, acc):
+        self.acc = acc
+    def __str__(self):
+        return "VAccumulator[" + type(self.acc).__name__ + "; " + self.acc.describe() + "]"
+    def isAccumulator(self):
+        return True
+    def getAccumulator(self):
+        return self.acc
+    def toDisplay(self):
+        return "#ACCUMULATOR[" + type(self.acc).__name__ + "; " + self.acc.describe() + "]"
+
+class VStream(Value):
+    '''
+    The VStream class defines our lazy sequences. blocks is a function
+    returning a fresh iterator over VVector blocks of elements, so every
+    traversal of a stream of samples draws new samples. finite tells whether
+    the iterator ends, e.g. after a take
+    '''
+    def __init__(self, blocks, finite=False):
+        self.blocks = blocks
+        self.finite = finite
+    def __str__(self):
+        return "VStream[" + ("finite" if self.finite else "unbounded") + "]"
+    def isStream(self):
+        return True
+    def getBlocks(self):
+        return self.blocks()
+    def toDisplay(self):
+        if not self.finite:
+            return "#STREAM"
+        return "(" + ', '.join([elm.toDisplay() for block in self.blocks() for elm in block.getList()]) + ")"
+
 class VLoop(Value):
     '''
     The VLoop class defines our loops
@@ -298,8 +478,6 @@ class VLoop(Value):
         self.name = name
     def __str__(self):
         return "VLoop[" + str(self.name) + "]"
-    def __eq__(self, other):
-        runtimeError("Equal for VLoop not implemented yet")
     def toDisplay(self):
         return "#LOOP[" + str(self.name) + "]"
     def apply(self, args):